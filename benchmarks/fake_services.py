@@ -0,0 +1,544 @@
+"""Local stand-ins for Azure AD, Microsoft Graph, OpenAI and Business Central OData
+
+One HTTP server with a path prefix per service, so load tests go through the
+real HTTP clients of the app (throttling, retries, sessions, $batch parsing):
+
+    python benchmarks/fake_services.py --port 8400 --mailbox path/to/archive \\
+        --latency graph=0.1 openai=0.8 navision=0.2 --throttle-rate openai=0.05 --record requests.jsonl
+
+and point the app at it:
+
+    AZURE_AD_AUTHORITY=http://127.0.0.1:8400/aad
+    GRAPH_API_BASE_URL=http://127.0.0.1:8400/graph/v1.0
+    OPENAI_API_URL=http://127.0.0.1:8400/openai/v1/chat/completions
+    NAVISION_API_URL=http://127.0.0.1:8400/navision/ODataV4/
+
+Control endpoints:
+    GET/POST /_fake/config     latency, jitter, throttle_rate, retry_after and error_rate of each service
+    GET/DELETE /_fake/requests the recorded requests, optionally ?service=graph
+    POST /_fake/messages       adds Graph messages to the mailbox
+    POST /_fake/notify         sends change notifications for the new messages (or {"ids": [...]}) to the subscriptions
+    GET /_fake/state           messages, subscriptions, sent mail and posted invoices
+
+Business Central is served without NTLM: requests_ntlm only negotiates
+when the server answers 401, so the app's session works unchanged.
+"""
+from email.parser import BytesParser
+from flask import Flask, request, jsonify, Response, g
+import threading
+import argparse
+import requests
+import logging
+import base64
+import random
+import uuid
+import json
+import time
+import sys
+import os
+import re
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+
+SERVICES = {
+    "/aad/": "azure_ad",
+    "/graph/": "graph",
+    "/openai/": "openai",
+    "/navision/": "navision"
+}
+DEFAULT_BEHAVIOUR = {"latency": 0.0, "jitter": 0.0, "throttle_rate": 0.0, "retry_after": 1.0, "error_rate": 0.0}
+GRAPH_BATCH_LIMIT = 20
+ACCOUNTS_SECTION = re.compile(r"### 📊 Contas Disponíveis:\n(.+)")
+
+
+class FakeState:
+    """The mailbox, subscriptions, invoices and recorded requests of the fake services"""
+
+    def __init__(self, behaviour=None, record_file=None, seed=None):
+        """
+        Args:
+            behaviour (dict): Overrides of DEFAULT_BEHAVIOUR per service, e.g. {"openai": {"latency": 0.8}}
+            record_file (str): JSON lines file where every request is also appended
+            seed (int): Seed of the throttling and error injection
+        """
+        self.behaviour = {service: dict(DEFAULT_BEHAVIOUR) for service in SERVICES.values()}
+        for service, values in (behaviour or {}).items():
+            self.behaviour[service].update(values)
+        self.record_file = record_file
+        self.random = random.Random(seed)
+        self.messages = {}
+        self.notified = set()
+        self.subscriptions = {}
+        self.sent_mail = []
+        self.invoices = {}
+        self.lines = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def add_message(self, message):
+        """This function adds a Graph message, with its attachments, to the mailbox
+        Args:
+            message (dict): The message, in the format of the Graph API
+        Returns:
+            str: The ID of the message
+        """
+        message = dict(message)
+        message.setdefault("id", uuid.uuid4().hex)
+        with self.lock:
+            self.messages[message["id"]] = message
+        return message["id"]
+
+    def record(self, entry):
+        with self.lock:
+            self.requests.append(entry)
+            if self.record_file:
+                with open(self.record_file, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(entry) + "\n")
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+
+def email_details_to_message(email_details):
+    """This function converts email details, as read by ProcessingData.local_files, into a Graph message
+    Args:
+        email_details (dict): The details of the email, with the attachment bytes in "content"
+    Returns:
+        dict: The message, in the format of the Graph API
+    """
+    return {
+        "id": email_details["id"],
+        "internetMessageId": email_details.get("internetMessageId", ""),
+        "subject": email_details.get("subject", ""),
+        "sender": {"emailAddress": email_details.get("sender", {})},
+        "body": {"contentType": "html", "content": email_details.get("body", "")},
+        "receivedDateTime": email_details.get("receivedDateTime") or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "hasAttachments": bool(email_details.get("attachments")),
+        "attachments": [
+            {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "id": uuid.uuid4().hex,
+                "name": attachment["name"],
+                "contentType": attachment["contentType"],
+                "size": attachment.get("size") or len(attachment["content"] or b""),
+                "contentBytes": base64.b64encode(attachment["content"] or b"").decode()
+            }
+            for attachment in email_details.get("attachments", [])
+        ]
+    }
+
+
+def choose_accounts(prompt):
+    """This function answers a classification prompt with the most used account of each invoice
+    Args:
+        prompt (str): The prompt built by prompt_builder
+    Returns:
+        str: The account, or a JSON array of accounts when the prompt holds several invoices
+    """
+    accounts = [line.split(" - ")[0].strip() for line in ACCOUNTS_SECTION.findall(prompt)]
+    if "## Fatura" in prompt:
+        return json.dumps(accounts)
+    return accounts[0] if accounts else ""
+
+
+def _graph_error(status, code, message):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def create_app(state):
+    """This function creates the Flask app of the fake services
+    Args:
+        state (FakeState): The state shared by the services
+    Returns:
+        Flask: The app
+    """
+    app = Flask(__name__)
+
+    @app.before_request
+    def simulate():
+        g.started_at = time.perf_counter()
+        g.service = next((service for prefix, service in SERVICES.items() if request.path.startswith(prefix)), None)
+        if g.service is None or request.headers.get("X-Fake-Batch-Part"):
+            return None
+
+        behaviour = state.behaviour[g.service]
+        delay = behaviour["latency"] + state.draw() * behaviour["jitter"]
+        if delay > 0:
+            time.sleep(delay)
+
+        if state.draw() < behaviour["throttle_rate"]:
+            retry_after = behaviour["retry_after"]
+            response = jsonify({"error": {"code": "TooManyRequests", "message": "Rate limit is exceeded"}})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(int(max(1, round(retry_after))))
+            if g.service == "openai":
+                response.headers["retry-after-ms"] = str(int(retry_after * 1000))
+            return response
+
+        if state.draw() < behaviour["error_rate"]:
+            return _graph_error(500, "InternalServerError", "Injected failure")
+        return None
+
+    @app.after_request
+    def record(response):
+        if g.get("service") and not request.headers.get("X-Fake-Batch-Part"):
+            state.record({
+                "time": time.time(),
+                "service": g.service,
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "status": response.status_code,
+                "seconds": round(time.perf_counter() - g.started_at, 4),
+                "request_bytes": request.content_length or 0,
+                "response_bytes": response.calculate_content_length() or 0
+            })
+        return response
+
+    # Azure AD
+    @app.route("/aad/<tenant>/oauth2/v2.0/token", methods=["POST"])
+    def token(tenant):
+        if request.form.get("grant_type") != "client_credentials":
+            return jsonify({"error": "unsupported_grant_type"}), 400
+        return jsonify({"token_type": "Bearer", "expires_in": 3599, "access_token": f"fake-{uuid.uuid4().hex}"})
+
+    # Microsoft Graph
+    def _message_view(message, expand):
+        view = {key: value for key, value in message.items() if key != "attachments"}
+        if expand:
+            view["attachments"] = message.get("attachments", [])
+        return view
+
+    @app.route("/graph/v1.0/users/<user>/messages", methods=["GET"])
+    def list_messages(user):
+        top = int(request.args.get("$top", 10))
+        with state.lock:
+            messages = list(state.messages.values())[:top]
+        return jsonify({"value": [_message_view(message, False) for message in messages]})
+
+    @app.route("/graph/v1.0/users/<user>/messages/delta", methods=["GET"])
+    @app.route("/graph/v1.0/users/<user>/mailFolders/<folder>/messages/delta", methods=["GET"])
+    def delta(user, folder="inbox"):
+        # The delta token is the number of messages already returned
+        position = int(request.args.get("$deltatoken", 0))
+        with state.lock:
+            messages = list(state.messages.values())
+        changes = [_message_view(message, False) for message in messages[position:]]
+        return jsonify({
+            "value": changes,
+            "@odata.deltaLink": f"{request.base_url}?$deltatoken={len(messages)}"
+        })
+
+    @app.route("/graph/v1.0/users/<user>/messages/<message_id>", methods=["GET"])
+    def get_message(user, message_id):
+        with state.lock:
+            message = state.messages.get(message_id)
+        if message is None:
+            return _graph_error(404, "ErrorItemNotFound", "The specified object was not found in the store.")
+        return jsonify(_message_view(message, "attachments" in request.args.get("$expand", "")))
+
+    @app.route("/graph/v1.0/users/<user>/messages/<message_id>/attachments", methods=["GET"])
+    def get_attachments(user, message_id):
+        with state.lock:
+            message = state.messages.get(message_id)
+        if message is None:
+            return _graph_error(404, "ErrorItemNotFound", "The specified object was not found in the store.")
+        return jsonify({"value": message.get("attachments", [])})
+
+    @app.route("/graph/v1.0/users/<user>/sendMail", methods=["POST"])
+    def send_mail(user):
+        body = request.get_json(silent=True) or {}
+        if "message" not in body:
+            return _graph_error(400, "ErrorInvalidRequest", "The message is missing.")
+        with state.lock:
+            state.sent_mail.append({"user": user, "message": body["message"]})
+        return "", 202
+
+    @app.route("/graph/v1.0/subscriptions", methods=["POST"])
+    def create_subscription():
+        body = request.get_json(silent=True) or {}
+        notification_url = body.get("notificationUrl")
+        if not notification_url:
+            return _graph_error(400, "InvalidRequest", "notificationUrl is required.")
+
+        # Graph validates the notification URL before creating the subscription
+        validation_token = uuid.uuid4().hex
+        try:
+            answer = requests.post(notification_url, params={"validationToken": validation_token}, timeout=10)
+            valid = answer.status_code == 200 and answer.text == validation_token
+        except requests.exceptions.RequestException:
+            valid = False
+        if not valid:
+            return _graph_error(400, "InvalidRequest", "Subscription validation request failed.")
+
+        subscription = dict(body, id=uuid.uuid4().hex)
+        with state.lock:
+            state.subscriptions[subscription["id"]] = subscription
+        return jsonify(subscription), 201
+
+    @app.route("/graph/v1.0/subscriptions", methods=["GET"])
+    def list_subscriptions():
+        with state.lock:
+            return jsonify({"value": list(state.subscriptions.values())})
+
+    @app.route("/graph/v1.0/subscriptions/<subscription_id>", methods=["PATCH", "DELETE"])
+    def change_subscription(subscription_id):
+        with state.lock:
+            subscription = state.subscriptions.get(subscription_id)
+            if subscription is None:
+                return _graph_error(404, "ResourceNotFound", "The object was not found.")
+            if request.method == "DELETE":
+                del state.subscriptions[subscription_id]
+                return "", 204
+            subscription.update(request.get_json(silent=True) or {})
+            return jsonify(subscription)
+
+    @app.route("/graph/v1.0/$batch", methods=["POST"])
+    def graph_batch():
+        batch = (request.get_json(silent=True) or {}).get("requests", [])
+        if len(batch) > GRAPH_BATCH_LIMIT:
+            return _graph_error(400, "BadRequest", f"A batch holds at most {GRAPH_BATCH_LIMIT} requests.")
+
+        responses = []
+        client = app.test_client()
+        for part in batch:
+            headers = dict(part.get("headers", {}), **{"X-Fake-Batch-Part": "1"})
+            answer = client.open(
+                "/graph/v1.0/" + part.get("url", "").lstrip("/"),
+                method=part.get("method", "GET"),
+                headers=headers,
+                json=part.get("body")
+            )
+            responses.append({
+                "id": part.get("id"),
+                "status": answer.status_code,
+                "headers": {"Content-Type": answer.headers.get("Content-Type", "")},
+                "body": answer.get_json(silent=True)
+            })
+        return jsonify({"responses": responses})
+
+    # OpenAI
+    @app.route("/openai/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        body = request.get_json(silent=True) or {}
+        messages = body.get("messages") or []
+        if not messages:
+            return jsonify({"error": {"message": "messages is required", "type": "invalid_request_error"}}), 400
+
+        prompt = messages[-1].get("content", "")
+        prompt_tokens = sum(len(message.get("content", "")) for message in messages) // 4
+        answer = choose_accounts(prompt)
+        return jsonify({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 5, "total_tokens": prompt_tokens + 5}
+        })
+
+    # Business Central OData
+    def _post_entity(entity, payload):
+        """Stores a header or a line and returns its (status, body)"""
+        if entity.endswith("/Fatura_Compra"):
+            with state.lock:
+                if payload.get("No") in state.invoices:
+                    return 400, {"error": {"code": "Internal_EntityWithSameKeyExists",
+                                           "message": f"The record already exists: {payload.get('No')}"}}
+                state.invoices[payload.get("No")] = payload
+            return 201, dict(payload, **{"@odata.etag": f"W/\"{uuid.uuid4().hex}\""})
+        if entity.endswith("/Linhas_Fatura_Compra"):
+            with state.lock:
+                if payload.get("Document_No") not in state.invoices:
+                    return 400, {"error": {"code": "Internal_RecordNotFound",
+                                           "message": f"The invoice does not exist: {payload.get('Document_No')}"}}
+                state.lines.append(payload)
+            return 201, dict(payload, **{"@odata.etag": f"W/\"{uuid.uuid4().hex}\""})
+        return 404, {"error": {"code": "BadRequest_NotFound", "message": f"No entity {entity}"}}
+
+    def _navision_batch():
+        message = BytesParser().parsebytes(
+            f"Content-Type: {request.headers.get('Content-Type', '')}\r\n\r\n".encode() + request.get_data()
+        )
+        if not message.is_multipart():
+            return jsonify({"error": {"code": "BadRequest", "message": "Expected multipart/mixed"}}), 400
+
+        batch_boundary = f"batchresponse_{uuid.uuid4()}"
+        parts = []
+        for changeset in message.get_payload():
+            changeset_boundary = f"changesetresponse_{uuid.uuid4()}"
+            answers = []
+            for operation in changeset.get_payload():
+                raw = operation.get_payload(decode=True) or b""
+                head, _, body = raw.partition(b"\r\n\r\n")
+                entity = head.split(b"\r\n")[0].decode().split(" ")[1]
+                status, answer = _post_entity(entity, json.loads(body or b"{}"))
+                answers.append((operation.get("Content-ID"), status, answer))
+                if status >= 300:
+                    # A failed operation rolls back the changeset and is its only response
+                    answers = [answers[-1]]
+                    break
+
+            parts.append(f"--{batch_boundary}\r\nContent-Type: multipart/mixed; boundary={changeset_boundary}\r\n\r\n")
+            for content_id, status, answer in answers:
+                parts.append(
+                    f"--{changeset_boundary}\r\n"
+                    "Content-Type: application/http\r\n"
+                    "Content-Transfer-Encoding: binary\r\n"
+                    f"Content-ID: {content_id}\r\n\r\n"
+                    f"HTTP/1.1 {status} {'Created' if status == 201 else 'Bad Request'}\r\n"
+                    "Content-Type: application/json\r\n\r\n"
+                    f"{json.dumps(answer)}\r\n"
+                )
+            parts.append(f"--{changeset_boundary}--\r\n")
+        parts.append(f"--{batch_boundary}--\r\n")
+        return Response("".join(parts), status=200, content_type=f"multipart/mixed; boundary={batch_boundary}")
+
+    @app.route("/navision/<path:entity>", methods=["POST"])
+    def navision(entity):
+        if entity.endswith("$batch"):
+            return _navision_batch()
+        status, answer = _post_entity(entity, request.get_json(force=True, silent=True) or {})
+        return jsonify(answer), status
+
+    # Control
+    @app.route("/_fake/config", methods=["GET", "POST"])
+    def config():
+        if request.method == "POST":
+            for service, values in (request.get_json(silent=True) or {}).items():
+                if service in state.behaviour:
+                    state.behaviour[service].update({key: float(value) for key, value in values.items()})
+        return jsonify(state.behaviour)
+
+    @app.route("/_fake/requests", methods=["GET", "DELETE"])
+    def recorded_requests():
+        with state.lock:
+            if request.method == "DELETE":
+                state.requests.clear()
+                return "", 204
+            entries = list(state.requests)
+        service = request.args.get("service")
+        return jsonify([entry for entry in entries if service is None or entry["service"] == service])
+
+    @app.route("/_fake/messages", methods=["POST"])
+    def add_messages():
+        body = request.get_json(silent=True)
+        messages = body if isinstance(body, list) else [body or {}]
+        return jsonify({"ids": [state.add_message(message) for message in messages]}), 201
+
+    @app.route("/_fake/notify", methods=["POST"])
+    def notify():
+        with state.lock:
+            ids = (request.get_json(silent=True) or {}).get("ids") or [
+                message_id for message_id in state.messages if message_id not in state.notified
+            ]
+            state.notified.update(ids)
+            subscriptions = list(state.subscriptions.values())
+
+        delivered = 0
+        for subscription in subscriptions:
+            user = subscription.get("resource", "").split("/")[1] if "/" in subscription.get("resource", "") else ""
+            notification = {"value": [
+                {
+                    "subscriptionId": subscription["id"],
+                    "changeType": "created",
+                    "clientState": subscription.get("clientState"),
+                    "resource": f"Users/{user}/Messages/{message_id}",
+                    "resourceData": {"id": message_id}
+                }
+                for message_id in ids
+            ]}
+            try:
+                requests.post(subscription["notificationUrl"], json=notification, timeout=10)
+                delivered += 1
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Notification to {subscription['notificationUrl']} failed: {str(e)}")
+        return jsonify({"messages": len(ids), "subscriptions": delivered})
+
+    @app.route("/_fake/state", methods=["GET"])
+    def show_state():
+        with state.lock:
+            return jsonify({
+                "messages": len(state.messages),
+                "subscriptions": len(state.subscriptions),
+                "sent_mail": len(state.sent_mail),
+                "invoices": len(state.invoices),
+                "lines": len(state.lines),
+                "requests": len(state.requests)
+            })
+
+    return app
+
+
+def _parse_settings(values):
+    """Parses service=value arguments, e.g. ["graph=0.1", "openai=0.8"]"""
+    settings = {}
+    for value in values or []:
+        service, _, number = value.partition("=")
+        settings[service] = float(number)
+    return settings
+
+
+def load_mailbox(state, directory):
+    """This function adds the .eml, .msg and .pdf files of a directory to the mailbox"""
+    sys.path.insert(0, SRC_DIR)
+    from ProcessingData.local_files import find_files, load_email_file
+
+    for path in find_files(directory):
+        email_details = load_email_file(path)
+        if email_details is not None:
+            state.add_message(email_details_to_message(email_details))
+
+
+def load_synthetic(state, count, pages):
+    """This function adds synthetic invoices, the same the benchmarks use, to the mailbox"""
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from synthetic import make_vendors, make_email
+
+    vendors = make_vendors()
+    for index in range(count):
+        state.add_message(email_details_to_message(make_email(index, vendors[index % len(vendors)], pages)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Azure AD, Graph, OpenAI and Business Central services")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8400)
+    parser.add_argument("--latency", nargs="*", help="Seconds per service, e.g. graph=0.1 openai=0.8")
+    parser.add_argument("--jitter", nargs="*", help="Extra random seconds per service, e.g. openai=0.5")
+    parser.add_argument("--throttle-rate", nargs="*", help="Share of requests answered 429, e.g. openai=0.05")
+    parser.add_argument("--retry-after", nargs="*", help="Retry-After seconds of the 429 answers, e.g. graph=2")
+    parser.add_argument("--error-rate", nargs="*", help="Share of requests answered 500, e.g. navision=0.01")
+    parser.add_argument("--record", help="JSON lines file where every request is appended")
+    parser.add_argument("--mailbox", help="Directory of .eml, .msg and .pdf files served as Graph messages")
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic invoices added to the mailbox")
+    parser.add_argument("--pages", type=int, default=1, help="Pages of the synthetic invoices")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    behaviour = {}
+    for key, values in (("latency", args.latency), ("jitter", args.jitter), ("throttle_rate", args.throttle_rate),
+                        ("retry_after", args.retry_after), ("error_rate", args.error_rate)):
+        for service, number in _parse_settings(values).items():
+            behaviour.setdefault(service, {})[key] = number
+
+    state = FakeState(behaviour, args.record, args.seed)
+    if args.mailbox:
+        load_mailbox(state, args.mailbox)
+    if args.synthetic:
+        load_synthetic(state, args.synthetic, args.pages)
+
+    base = f"http://{args.host}:{args.port}"
+    print(f"{len(state.messages)} messages in the mailbox. Point the app at the fakes with:")
+    print(f"  AZURE_AD_AUTHORITY={base}/aad")
+    print(f"  GRAPH_API_BASE_URL={base}/graph/v1.0")
+    print(f"  OPENAI_API_URL={base}/openai/v1/chat/completions")
+    print(f"  NAVISION_API_URL={base}/navision/ODataV4/")
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    create_app(state).run(host=args.host, port=args.port, threaded=True, debug=False, use_reloader=False)
+
+
+if __name__ == "__main__":
+    main()
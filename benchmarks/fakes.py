@@ -0,0 +1,118 @@
+from unittest import mock
+import threading
+import types
+import time
+import sys
+
+
+# Simulated latency of the external services, in seconds
+LATENCY = {
+    "graph": 0.08,
+    "db": 0.01,
+    "chatgpt": 0.6,
+    "navision": 0.15
+}
+
+
+class FakeServices:
+    """Local stand-ins for Graph, SQL Server, ChatGPT and Navision
+
+    The pipeline code runs unchanged: only the functions that leave the
+    process are replaced, each sleeping for its LATENCY before answering.
+    The calls made to each service are counted.
+    """
+
+    def __init__(self, emails, reference_tables, account_histories, latency=None):
+        """
+        Args:
+            emails (dict): The email details, by email ID
+            reference_tables (dict): The reference DataFrames, by database table name
+            account_histories (dict): The account history DataFrames, by vendor number
+            latency (dict): Overrides of LATENCY
+        """
+        self.emails = emails
+        self.reference_tables = reference_tables
+        self.account_histories = account_histories
+        self.latency = dict(LATENCY, **(latency or {}))
+        self.calls = {name: 0 for name in self.latency}
+        self._lock = threading.Lock()
+        self._patches = []
+
+    def _call(self, service):
+        with self._lock:
+            self.calls[service] += 1
+        time.sleep(self.latency[service])
+
+    # SQL Server (ProcessingData.DB.conection)
+    def fetch_table_changes(self, table, schema, since_row_version=0):
+        self._call("db")
+        df = self.reference_tables[table]
+        return df[df["Row Version"] > since_row_version].copy(), max(int(df["Row Version"].max()), since_row_version)
+
+    def fetch_table_keys(self, table, schema, key_columns):
+        self._call("db")
+        return self.reference_tables[table][key_columns].copy()
+
+    def fetch_account_history(self, vendor_id, since_row_version=0):
+        self._call("db")
+        df = self.account_histories[vendor_id]
+        return df[df["Row Version"] > since_row_version].copy(), max(int(df["Row Version"].max()), since_row_version)
+
+    def fetch_from_table(self, table, schema):
+        self._call("db")
+        return self.reference_tables[table].copy()
+
+    def fetch_account_vendor(self, vendor_id):
+        self._call("db")
+        return self.account_histories[vendor_id][["No_", "Description"]].copy()
+
+    # Graph
+    def fetch_email_details(self, email_id):
+        self._call("graph")
+        return self.emails.get(email_id)
+
+    # ChatGPT
+    def classify_account(self, email_details, account_vendor, pdf_texts=None):
+        self._call("chatgpt")
+        return str(account_vendor["No_"].iloc[0])
+
+    # Navision
+    def post_invoice_payloads(self, invoices, on_posted=None):
+        self._call("navision")
+        numbers = [header_payload["No"] for header_payload, _ in invoices]
+        for number in numbers:
+            if on_posted is not None:
+                on_posted(number)
+        return numbers, []
+
+    def install_database(self):
+        """This function replaces the SQL Server module, which connects when it is imported
+        Must be called before the pipeline modules are imported
+        """
+        module = types.ModuleType("ProcessingData.DB.conection")
+        for name in ("fetch_table_changes", "fetch_table_keys", "fetch_account_history",
+                     "fetch_from_table", "fetch_account_vendor"):
+            setattr(module, name, getattr(self, name))
+        sys.modules["ProcessingData.DB.conection"] = module
+
+    def install(self):
+        """This function replaces the Graph, ChatGPT and Navision calls of the imported pipeline"""
+        targets = {
+            "orchestration.fetch_email_details": self.fetch_email_details,
+            "ProcessingData.process_email.fetch_email_details": self.fetch_email_details,
+            "ProcessingData.DFprocess.classify_account": self.classify_account,
+            "orchestration.post_invoice_payloads": self.post_invoice_payloads
+        }
+        for target, replacement in targets.items():
+            patch = mock.patch(target, replacement)
+            patch.start()
+            self._patches.append(patch)
+
+        from ProcessingData.API.graph_api import set_alerts_enabled
+        set_alerts_enabled(False)
+
+    def uninstall(self):
+        """This function restores the patched calls"""
+        for patch in reversed(self._patches):
+            patch.stop()
+        self._patches = []
@@ -0,0 +1,284 @@
+"""Replays recorded webhook traffic against a running app
+
+Start the app with TRAFFIC_RECORD_DIR set to record the Graph notifications
+and the messages they pointed to (secrets scrubbed), then replay them:
+
+    python benchmarks/replay_traffic.py recordings/month-end --speed 10 --concurrency 32 --duplicates 0.2
+
+The recorded messages are served by benchmarks/fake_services.py, started in
+this process, so the app under test must point at it (the environment
+variables are printed at start). The notifications are posted to --target
+keeping their original spacing divided by --speed, and a share of them is
+delivered a second time, as Graph does, after --duplicate-delay seconds.
+
+Reports the acceptance latency of /webhook, the HTTP error rate and, polling
+/emails/<id>, the end-to-end completion time of each email.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, quote
+from werkzeug.serving import make_server
+import threading
+import argparse
+import requests
+import logging
+import random
+import json
+import time
+import sys
+
+from run_benchmarks import percentile, SRC_DIR
+from fake_services import FakeState, create_app
+
+sys.path.insert(0, SRC_DIR)
+from ProcessingData.traffic_recorder import load_recording
+
+
+POLL_INTERVAL = 0.5
+
+
+def email_ids_of(body):
+    """This function returns the email IDs of a notification, the same way the webhook reads them"""
+    return [event.get("resource", "").split('/')[-1] for event in (body or {}).get("value", [])]
+
+
+def build_schedule(notifications, speed, duplicates, duplicate_delay, seed=None):
+    """This function lists the deliveries of the replay
+    Args:
+        notifications (list): The recorded notifications, in arrival order
+        speed (float): Speed-up factor of the original spacing
+        duplicates (float): Share of the notifications delivered twice
+        duplicate_delay (float): Seconds between a delivery and its duplicate
+        seed (int): Seed of the choice of duplicates
+    Returns:
+        list: (offset in seconds, notification, is_duplicate) sorted by offset
+    """
+    if not notifications:
+        return []
+    rng = random.Random(seed)
+    first = notifications[0]["received_at"]
+    schedule = []
+    for notification in notifications:
+        offset = (notification["received_at"] - first) / speed
+        schedule.append((offset, notification, False))
+        if rng.random() < duplicates:
+            schedule.append((offset + duplicate_delay, notification, True))
+    schedule.sort(key=lambda delivery: delivery[0])
+    return schedule
+
+
+def start_fake_services(messages, host, port):
+    """This function serves the recorded messages from the fake services on a background thread
+    Returns:
+        The server, to shut down at the end
+    """
+    state = FakeState()
+    for message in messages.values():
+        state.add_message(message)
+    server = make_server(host, port, create_app(state), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Replay:
+    """Posts a schedule of notifications and collects what the app answered"""
+
+    def __init__(self, target, concurrency, timeout=30):
+        self.target = target
+        self.status_url = "{0.scheme}://{0.netloc}/emails/".format(urlsplit(target))
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.deliveries = []
+        self.first_sent = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def deliver(self, notification, is_duplicate, lag):
+        """This function posts one notification, to the mailbox it was recorded for, and stores its latency and outcome"""
+        mailbox = notification.get("mailbox")
+        params = {"mailbox": mailbox} if mailbox else None
+        sent_at = time.time()
+        with self.lock:
+            for email_id in email_ids_of(notification["body"]):
+                self.first_sent.setdefault((mailbox, email_id), sent_at)
+
+        started_at = time.perf_counter()
+        try:
+            response = self._session().post(self.target, params=params, json=notification["body"], timeout=self.timeout)
+            status = response.status_code
+            # The webhook answers 200 with status "error" when it fails to read a notification
+            error = status >= 400 or (response.headers.get("Content-Type", "").startswith("application/json")
+                                      and response.json().get("status") == "error")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Delivery failed: {str(e)}")
+            status, error = None, True
+        delivery = {
+            "duplicate": is_duplicate,
+            "status": status,
+            "error": error,
+            "seconds": time.perf_counter() - started_at,
+            "lag": lag
+        }
+        with self.lock:
+            self.deliveries.append(delivery)
+
+    def send(self, schedule):
+        """This function posts the schedule, keeping its spacing as far as the concurrency allows"""
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for offset, notification, is_duplicate in schedule:
+                wait = offset - (time.perf_counter() - started_at)
+                if wait > 0:
+                    time.sleep(wait)
+                pool.submit(self.deliver, notification, is_duplicate, max(0.0, -wait))
+        return time.perf_counter() - started_at
+
+    def wait_for_completion(self, timeout):
+        """This function polls /emails/<id> until every email finished or the timeout passed
+        Returns:
+            dict: The last status of each (mailbox, email ID), with the completion time seen by the client
+        """
+        session = requests.Session()
+        statuses = {}
+        pending = set(self.first_sent)
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            for key in list(pending):
+                mailbox, email_id = key
+                try:
+                    response = session.get(
+                        self.status_url + quote(email_id, safe=""),
+                        params={"mailbox": mailbox} if mailbox else None,
+                        timeout=self.timeout
+                    )
+                except requests.exceptions.RequestException as e:
+                    logging.error(f"Status of {email_id} failed: {str(e)}")
+                    continue
+                if response.status_code != 200:
+                    continue
+                status = response.json()
+                statuses[key] = status
+                if status["status"] == "finished":
+                    status["client_seconds"] = time.time() - self.first_sent[key]
+                    pending.discard(key)
+            if pending:
+                time.sleep(POLL_INTERVAL)
+        return statuses
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 0.5), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(max(values), 3)
+    }
+
+
+def build_report(replay, statuses, send_seconds):
+    """This function summarizes the deliveries and the completion of the emails
+    Args:
+        replay (Replay): The finished replay
+        statuses (dict): The result of wait_for_completion
+        send_seconds (float): Time taken to post the schedule
+    Returns:
+        dict: The report
+    """
+    deliveries = replay.deliveries
+    errors = sum(1 for delivery in deliveries if delivery["error"])
+    finished = [status for status in statuses.values() if status["status"] == "finished"]
+    makespan = None
+    if finished:
+        makespan = max(replay.first_sent[key] + status["client_seconds"]
+                       for key, status in statuses.items() if status["status"] == "finished")
+        makespan = round(makespan - min(replay.first_sent.values()), 3)
+    return {
+        "deliveries": len(deliveries),
+        "duplicates": sum(1 for delivery in deliveries if delivery["duplicate"]),
+        "send_seconds": round(send_seconds, 3),
+        "max_schedule_lag_seconds": round(max((delivery["lag"] for delivery in deliveries), default=0.0), 3),
+        "acceptance_seconds": _summary([delivery["seconds"] for delivery in deliveries]),
+        "http_errors": errors,
+        "http_error_rate": round(errors / len(deliveries), 4) if deliveries else 0.0,
+        "emails": len(replay.first_sent),
+        "completed": len(finished),
+        "succeeded": sum(1 for status in finished if status["succeeded"]),
+        "failed": sum(1 for status in finished if not status["succeeded"]),
+        "timed_out": len(replay.first_sent) - len(finished),
+        "completion_seconds": _summary([status["seconds"] for status in finished]),
+        "client_completion_seconds": _summary([status["client_seconds"] for status in finished]),
+        "makespan_seconds": makespan
+    }
+
+
+def print_report(report):
+    print(f"Deliveries: {report['deliveries']} ({report['duplicates']} duplicates) in {report['send_seconds']}s, "
+          f"max schedule lag {report['max_schedule_lag_seconds']}s")
+    print(f"HTTP errors: {report['http_errors']} ({report['http_error_rate']:.2%})")
+    for name in ("acceptance_seconds", "completion_seconds", "client_completion_seconds"):
+        summary = report[name]
+        if summary:
+            print(f"{name:<26} p50 {summary['p50']:>8.3f}  p95 {summary['p95']:>8.3f}  "
+                  f"p99 {summary['p99']:>8.3f}  max {summary['max']:>8.3f}")
+    print(f"Emails: {report['emails']}, completed {report['completed']} (succeeded {report['succeeded']}, "
+          f"failed {report['failed']}), timed out {report['timed_out']}, makespan {report['makespan_seconds']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays recorded webhook traffic against a running app")
+    parser.add_argument("recording", help="Directory written by the app with TRAFFIC_RECORD_DIR")
+    parser.add_argument("--target", default="http://localhost:5048/webhook")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speed-up factor of the recorded spacing")
+    parser.add_argument("--concurrency", type=int, default=16, help="Notifications posted at the same time")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Share of notifications delivered twice")
+    parser.add_argument("--duplicate-delay", type=float, default=1.0, help="Seconds before a duplicate delivery")
+    parser.add_argument("--completion-timeout", type=float, default=600.0,
+                        help="Seconds to wait for the emails to finish after the last delivery")
+    parser.add_argument("--fake-host", default="127.0.0.1")
+    parser.add_argument("--fake-port", type=int, default=8400)
+    parser.add_argument("--no-fake", action="store_true", help="Do not serve the recorded messages")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="JSON file to write the report to")
+    args = parser.parse_args()
+
+    notifications, messages = load_recording(args.recording)
+    if not notifications:
+        print(f"No notifications recorded in {args.recording}")
+        return 1
+
+    server = None
+    if not args.no_fake:
+        server = start_fake_services(messages, args.fake_host, args.fake_port)
+        base = f"http://{args.fake_host}:{args.fake_port}"
+        print(f"Serving {len(messages)} recorded messages. The app must run with:")
+        print(f"  AZURE_AD_AUTHORITY={base}/aad")
+        print(f"  GRAPH_API_BASE_URL={base}/graph/v1.0")
+        print(f"  OPENAI_API_URL={base}/openai/v1/chat/completions")
+        print(f"  NAVISION_API_URL={base}/navision/ODataV4/")
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    schedule = build_schedule(notifications, args.speed, args.duplicates, args.duplicate_delay, args.seed)
+    replay = Replay(args.target, args.concurrency)
+    try:
+        send_seconds = replay.send(schedule)
+        statuses = replay.wait_for_completion(args.completion_timeout)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = build_report(replay, statuses, send_seconds)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    return 1 if report["http_errors"] or report["timed_out"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
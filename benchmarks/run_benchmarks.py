@@ -0,0 +1,266 @@
+"""End-to-end benchmark of orchestrate_all_processes
+
+Drives the whole pipeline (decoding, classification, transformation and
+payloads) with local fakes for Graph, SQL Server, ChatGPT and Navision and
+synthetic invoices, and compares the results against baselines.json.
+
+    python benchmarks/run_benchmarks.py                     # run and compare
+    python benchmarks/run_benchmarks.py --update-baselines  # run and store the new baselines
+    python benchmarks/run_benchmarks.py --scenarios 10x1p 10x30p --tolerance 0.3
+
+Exits with 1 when a scenario regressed by more than the tolerance.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import statistics
+import platform
+import argparse
+import tempfile
+import logging
+import random
+import shutil
+import json
+import time
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+BASELINES_FILE = os.path.join(BENCHMARKS_DIR, "baselines.json")
+
+# (concurrent emails, pages of each invoice)
+SCENARIOS = {
+    f"{emails}x{pages}p": (emails, pages)
+    for emails in (1, 10, 100)
+    for pages in (1, 30)
+}
+# For each metric, whether a higher value is better
+METRICS = {
+    "emails_per_second": True,
+    "p50_seconds": False,
+    "p95_seconds": False,
+    "p99_seconds": False,
+    "peak_rss_mb": False
+}
+
+
+def percentile(values, share):
+    """This function returns the value below which the given share of the values fall
+    Args:
+        values (list): The values
+        share (float): Between 0 and 1, e.g. 0.95
+    Returns:
+        float: The percentile, interpolated between the closest values
+    """
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    position = (len(values) - 1) * share
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def peak_rss_mb():
+    """This function returns the peak resident memory of the process, or None if it is not available"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+    except (ImportError, AttributeError):
+        return None
+
+
+def run_scenario(name, emails, pages, seed=0):
+    """This function runs a scenario in the current process
+    Steps:
+        1. Create the synthetic invoices and the fake services
+        2. Import the pipeline against the fakes, with checkpoints in a temporary directory
+        3. Process every email at the same time, one thread each, as the webhook does
+        4. Measure the throughput, the latency percentiles and the peak memory
+    Args:
+        name (str): The name of the scenario
+        emails (int): Emails processed at the same time
+        pages (int): Pages of each invoice
+        seed (int): Seed of the vendor choice
+    Returns:
+        dict: The results of the scenario
+    """
+    sys.path.insert(0, SRC_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+    checkpoint_dir = tempfile.mkdtemp(prefix="benchmark-checkpoints-")
+    os.environ.update({
+        "CHECKPOINT_DIR": checkpoint_dir,
+        "DECISION_CACHE_FILE": "",
+        "REFERENCE_SNAPSHOT_DIR": "",
+        "PROFILING_ENABLED": "False"
+    })
+
+    from synthetic import make_vendors, make_reference_tables, make_account_history, make_email
+    from fakes import FakeServices
+
+    rng = random.Random(seed)
+    vendors = make_vendors()
+    email_list = [make_email(index, rng.choice(vendors), pages) for index in range(emails)]
+    fakes = FakeServices(
+        {email["id"]: email for email in email_list},
+        make_reference_tables(vendors),
+        {vendor["no"]: make_account_history(vendor) for vendor in vendors}
+    )
+    fakes.install_database()
+
+    from orchestration import orchestrate_all_processes
+    from ProcessingData.deadline import Deadline, use_deadline
+    from info.config import EMAIL_DEADLINE_SECONDS
+    fakes.install()
+
+    def process(email_id):
+        started_at = time.perf_counter()
+        with use_deadline(Deadline(EMAIL_DEADLINE_SECONDS, email_id)):
+            result = orchestrate_all_processes(email_id)
+        return time.perf_counter() - started_at, result is True
+
+    try:
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(emails) as pool:
+            outcomes = list(pool.map(process, [email["id"] for email in email_list]))
+        elapsed = time.perf_counter() - started_at
+    finally:
+        fakes.uninstall()
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    latencies = [latency for latency, _ in outcomes]
+    return {
+        "scenario": name,
+        "emails": emails,
+        "pages": pages,
+        "succeeded": sum(1 for _, succeeded in outcomes if succeeded),
+        "seconds": round(elapsed, 3),
+        "emails_per_second": round(emails / elapsed, 3),
+        "p50_seconds": round(percentile(latencies, 0.5), 3),
+        "p95_seconds": round(percentile(latencies, 0.95), 3),
+        "p99_seconds": round(percentile(latencies, 0.99), 3),
+        "mean_seconds": round(statistics.mean(latencies), 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "service_calls": fakes.calls
+    }
+
+
+def _run_in_child(name, emails, pages, results):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    results.put(run_scenario(name, emails, pages))
+
+
+def run_isolated(name):
+    """This function runs a scenario in a new process, so its peak memory is its own
+    Args:
+        name (str): The name of the scenario in SCENARIOS
+    Returns:
+        dict: The results of the scenario
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    emails, pages = SCENARIOS[name]
+    process = context.Process(target=_run_in_child, args=(name, emails, pages, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def machine_info():
+    """This function describes the machine, baselines are only comparable on the same one"""
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count()
+    }
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    """This function lists the metrics of a scenario that are worse than the baseline by more than the tolerance
+    Args:
+        result (dict): The results of the scenario
+        baseline (dict): The stored results of the same scenario
+        tolerance (float): Allowed relative change, e.g. 0.2 for 20%
+    Returns:
+        list: One message per regressed metric
+    """
+    regressions = []
+    for metric, higher_is_better in METRICS.items():
+        current, expected = result.get(metric), baseline.get(metric)
+        if current is None or not expected:
+            continue
+        change = (current - expected) / expected
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{metric}: {expected} -> {current} ({change:+.0%})")
+    return regressions
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_baselines(results):
+    with open(BASELINES_FILE, "w", encoding="utf-8") as file:
+        json.dump({"machine": machine_info(), "scenarios": results}, file, indent=2, ensure_ascii=False)
+        file.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the invoice pipeline")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression, 0.2 for 20%%")
+    parser.add_argument("--update-baselines", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    baselines = load_baselines()
+    if baselines and baselines.get("machine") != machine_info():
+        print(f"Warning: the baselines were measured on {baselines.get('machine')}")
+
+    results = {}
+    failed = False
+    print(f"{'scenario':<10}{'emails/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'rss MB':>9}  result")
+    for name in args.scenarios:
+        result = run_isolated(name)
+        results[name] = result
+
+        baseline = baselines.get("scenarios", {}).get(name)
+        regressions = compare_to_baseline(result, baseline, args.tolerance) if baseline else []
+        if result["succeeded"] != result["emails"]:
+            regressions.append(f"only {result['succeeded']} of {result['emails']} emails succeeded")
+        failed = failed or bool(regressions)
+
+        status = "no baseline" if baseline is None else ("ok" if not regressions else "REGRESSION")
+        print(
+            f"{name:<10}{result['emails_per_second']:>10.2f}{result['p50_seconds']:>9.3f}"
+            f"{result['p95_seconds']:>9.3f}{result['p99_seconds']:>9.3f}{result['peak_rss_mb'] or 0:>9.1f}  {status}"
+        )
+        for regression in regressions:
+            print(f"{'':<10}  {regression}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.update_baselines:
+        stored = baselines.get("scenarios", {}) if baselines.get("machine") == machine_info() else {}
+        save_baselines(dict(stored, **results))
+        print(f"Baselines saved to {BASELINES_FILE}")
+        return 0
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
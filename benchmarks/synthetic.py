@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+import pandas as pd
+import qrcode
+import fitz
+import io
+
+
+COMPANY_NIF = "513631984"
+VENDOR_COUNT = 20
+LINE_TEXT = "Serviço de manutenção e assistência técnica - referência {ref} - quantidade {qty} - valor {value:.2f} EUR"
+
+
+def make_vendors():
+    """This function creates the vendors of the benchmark
+    The vendors cycle through the ways an account is chosen: a single account,
+    a dominant account and several accounts, which go to ChatGPT
+    Returns:
+        list: One dict per vendor with no, name, vat and accounts
+    """
+    vendors = []
+    for index in range(VENDOR_COUNT):
+        kind = ("single", "dominant", "several")[index % 3]
+        accounts = {"single": ["62210"], "dominant": ["62210", "62220"], "several": ["62210", "62220", "62230", "62240"]}[kind]
+        vendors.append({
+            "no": f"FOR{index:05d}",
+            "name": f"Fornecedor Benchmark {index}, Lda",
+            "vat": str(500000000 + index),
+            "kind": kind,
+            "accounts": accounts
+        })
+    return vendors
+
+
+def make_reference_tables(vendors, registered_invoices=5000):
+    """This function creates the reference tables served by the fake database
+    Args:
+        vendors (list): The vendors returned by make_vendors
+        registered_invoices (int): Rows of the posted purchase headers, so the duplicate checks scan a realistic table
+    Returns:
+        dict: The vendors, purchase_header and purchase_header_reg DataFrames, by table name
+    """
+    vendors_df = pd.DataFrame({
+        "No_": [vendor["no"] for vendor in vendors],
+        "Name": [vendor["name"] for vendor in vendors],
+        "VAT Registration No_": [vendor["vat"] for vendor in vendors],
+        "Row Version": range(1, len(vendors) + 1)
+    })
+    purchase_header_df = pd.DataFrame({
+        "Document Type": ["Invoice"] * 50,
+        "No_": [f"FCA{datetime.now():%y}{index:06d}" for index in range(1, 51)],
+        "Vendor Invoice No_": [f"OPEN/{index}" for index in range(50)],
+        "Row Version": range(1, 51)
+    })
+    purchase_header_reg_df = pd.DataFrame({
+        "No_": [f"FCR{index:06d}" for index in range(registered_invoices)],
+        "Vendor Invoice No_": [f"POSTED/{index}" for index in range(registered_invoices)],
+        "Row Version": range(1, registered_invoices + 1)
+    })
+    return {
+        "[ADC$Vendor]": vendors_df,
+        "[ADC$Purchase Header]": purchase_header_df,
+        "[ADC$Purch_ Inv_ Header]": purchase_header_reg_df
+    }
+
+
+def make_account_history(vendor):
+    """This function creates the posted invoice lines of a vendor, aggregated by account and description
+    Args:
+        vendor (dict): A vendor returned by make_vendors
+    Returns:
+        pd.DataFrame: No_, Description, Usage, Last Used and Row Version
+    """
+    usage = {"single": [40], "dominant": [95, 3], "several": [12, 10, 9, 7]}[vendor["kind"]]
+    descriptions = ["Manutenção de equipamentos", "Assistência técnica", "Consumíveis de escritório", "Transportes"]
+    return pd.DataFrame({
+        "No_": vendor["accounts"],
+        "Description": descriptions[:len(vendor["accounts"])],
+        "Usage": usage,
+        "Last Used": [datetime(2025, 1, 1) - timedelta(days=index) for index in range(len(usage))],
+        "Row Version": range(1, len(usage) + 1)
+    })
+
+
+def make_qr_text(vendor, invoice_no, base=100.0):
+    """This function creates the content of the QR code of a Portuguese invoice
+    Args:
+        vendor (dict): The vendor issuing the invoice
+        invoice_no (str): The ATCUD of the invoice
+        base (float): The taxable amount at 23% VAT
+    Returns:
+        str: The QR code content
+    """
+    vat = round(base * 0.23, 2)
+    return "*".join([
+        f"A:{vendor['vat']}", f"B:{COMPANY_NIF}", "C:PT", "D:FT", "E:N",
+        f"F:{datetime.now():%Y%m%d}", f"G:FT {invoice_no}", f"H:{invoice_no}",
+        "I1:PT", f"I7:{base:.2f}", f"I8:{vat:.2f}", f"N:{vat:.2f}", f"O:{base + vat:.2f}",
+        "Q:abcd", "R:1234"
+    ])
+
+
+def make_invoice_pdf(qr_text, pages=1, lines_per_page=40):
+    """This function creates an invoice PDF with the QR code on its first page
+    Args:
+        qr_text (str): The content of the QR code
+        pages (int): Number of pages
+        lines_per_page (int): Lines of text on each page
+    Returns:
+        bytes: The PDF
+    """
+    qr_image = io.BytesIO()
+    qrcode.make(qr_text, box_size=4, border=4).save(qr_image, format="PNG")
+
+    document = fitz.open()
+    for page_num in range(pages):
+        page = document.new_page(width=595, height=842)
+        text = "\n".join(
+            LINE_TEXT.format(ref=f"{page_num}-{line}", qty=line % 7 + 1, value=line * 3.5)
+            for line in range(lines_per_page)
+        )
+        page.insert_text((40, 50), f"FATURA - página {page_num + 1} de {pages}", fontsize=12)
+        page.insert_textbox(fitz.Rect(40, 70, 555, 640), text, fontsize=7)
+        if page_num == 0:
+            page.insert_image(fitz.Rect(40, 650, 190, 800), stream=qr_image.getvalue())
+
+    pdf = document.tobytes()
+    document.close()
+    return pdf
+
+
+def make_email(index, vendor, pages):
+    """This function creates the details of an email, as returned by fetch_email_details
+    Args:
+        index (int): The position of the email in the scenario
+        vendor (dict): The vendor issuing the invoice
+        pages (int): Number of pages of the attached invoice
+    Returns:
+        dict: The details of the email
+    """
+    invoice_no = f"BENCH{pages}P/{index}"
+    pdf = make_invoice_pdf(make_qr_text(vendor, invoice_no, 100.0 + index), pages)
+    return {
+        "id": f"bench-{pages}p-{index}",
+        "internetMessageId": f"<bench-{pages}p-{index}@example.com>",
+        "sender": {"name": vendor["name"], "address": f"faturas@{vendor['no'].lower()}.example.com"},
+        "subject": f"Fatura {invoice_no}",
+        "body": f"<p>Segue em anexo a fatura {invoice_no} relativa à manutenção de equipamentos.</p>",
+        "attachments": [{
+            "name": f"{invoice_no.replace('/', '_')}.pdf",
+            "contentType": "application/pdf",
+            "content": pdf,
+            "size": len(pdf)
+        }],
+        "receivedDateTime": datetime.now().isoformat(),
+        "hasAttachments": True
+    }
@@ -1,50 +1,262 @@
 from flask import Flask, request, jsonify
 import logging
-from logging.handlers import RotatingFileHandler
-import os
-from info.config import WEBHOOK_PORT
-from orchestration import orchestrate_all_processes
+from info.config import (
+    WEBHOOK_PORT,
+    EMAIL_DEADLINE_SECONDS,
+    ASYNC_PIPELINE,
+    STAGED_PIPELINE,
+    PROFILING_ENABLED,
+    EMAIL_WORKERS
+)
+from ProcessingData.deadline import Deadline, DeadlineExceeded, use_deadline, format_stage_times
+from ProcessingData.structured_logging import setup_logging, use_correlation_id
+from ProcessingData.profiling import get_profiling_summaries
+from ProcessingData.traffic_recorder import record_notification
+from ProcessingData.mailboxes import (
+    MailboxQueue, get_mailbox, get_mailboxes, resolve_mailbox, find_mailbox, use_mailbox
+)
+from ProcessingData.metrics import EMAILS_TOTAL, EMAILS_IN_FLIGHT, STARTUP_SECONDS, register_collector, render_metrics
+from ProcessingData.API.decision_cache import get_decision_cache_stats
+from ProcessingData.API.throttling import get_throttling_stats
+from werkzeug.serving import make_server
 from datetime import datetime
 import threading
+import time
+import sys
 
 
 app = Flask(__name__)
 processed_emails = {}
 processing_lock = threading.Lock()
+_async_pipeline = {"pipeline": None}
+_async_pipeline_lock = threading.Lock()
+_email_queue = {"queue": None}
+_email_queue_lock = threading.Lock()
+# Set once the server listens, so Graph's validation request can be answered
+webhook_ready = threading.Event()
 
 
-def is_already_processed(email_id):
+def is_already_processed(email_id, mailbox=None):
     """Check if the email has already been processed
+    Each mailbox has its own namespace of email IDs
     Args:
         email_id (str): The ID of the email to check
+        mailbox (Mailbox): The mailbox of the email, defaults to the current one
     Returns:
         bool: True if the email has already been processed, False otherwise
     """
-    return email_id in processed_emails
+    return ((mailbox or get_mailbox()).name, email_id) in processed_emails
 
 
-def process_email_background(email_id, event):
+def mark_finished(email_id, result, mailbox=None):
+    """This function stores when and how the processing of an email ended
+    Args:
+        email_id (str): The ID of the email
+        result: The result of the processing
+        mailbox (Mailbox): The mailbox of the email, defaults to the current one
+    """
+    key = ((mailbox or get_mailbox()).name, email_id)
+    with processing_lock:
+        if key in processed_emails:
+            processed_emails[key]['finished_at'] = datetime.now()
+            processed_emails[key]['result'] = result is True
+
+
+def finish_email(email_id, result, mailbox=None, outcome=None, deadline=None):
+    """This function records the end of the processing of an email, in any of the pipelines
+    An email that ran out of time is reported like a processing error and forgotten,
+    so the notification Graph delivers again for it is processed instead of ignored
+    Args:
+        email_id (str): The ID of the email
+        result: The result of the processing
+        mailbox (Mailbox): The mailbox of the email, defaults to the current one
+        outcome (str): How the processing ended when it did not return, e.g. "deadline_exceeded"
+        deadline (Deadline): The deadline of the email, whose stage times are reported
+    """
+    if outcome != "deadline_exceeded":
+        mark_finished(email_id, result, mailbox)
+        return
+
+    # Imported here, like the pipeline, so the webhook starts without the PDF and QR libraries
+    from ProcessingData.process_email import notify_deadline_exceeded
+
+    mailbox = mailbox or get_mailbox()
+    with processing_lock:
+        processed_emails.pop((mailbox.name, email_id), None)
+    try:
+        with use_mailbox(mailbox), use_correlation_id(email_id):
+            notify_deadline_exceeded(email_id, deadline)
+    except Exception as e:
+        logging.error(f"Error reporting the deadline of email {email_id}: {str(e)}")
+
+
+def process_email_background(email_id, event, deadline=None, mailbox=None):
     """This function orchestrates all processes for an email
     Args:
         email_id (str): The ID of the email to process
         event (dict): The event data
+        deadline (Deadline): The time budget of the email, started when this function runs
+        mailbox (Mailbox): The mailbox of the email, defaults to the current one
     """
+    # Imported here so the webhook starts without pandas, OpenCV and PyMuPDF; warm_up loads them in the background
+    from orchestration import orchestrate_all_processes
+
+    deadline = deadline or Deadline(EMAIL_DEADLINE_SECONDS, email_id)
+    # The time waiting for a worker is not part of the deadline
+    deadline.start()
+    mailbox = mailbox or get_mailbox()
+    EMAILS_IN_FLIGHT.inc()
+    result = None
+    outcome = None
     try:
-        result = orchestrate_all_processes(email_id)
+        with use_deadline(deadline), use_correlation_id(email_id), use_mailbox(mailbox):
+            result = orchestrate_all_processes(email_id)
         
         if isinstance(result, dict) and result.get('not_found'):
             logging.info(f"Email {email_id} not found - removing from control")
+            EMAILS_TOTAL.inc(outcome="not_found")
             return
             
         if result:
             logging.info(f"Email {email_id} processed successfully")
+            EMAILS_TOTAL.inc(outcome="processed")
         else:
             logging.warning(f"Email {email_id} could not be processed")
+            EMAILS_TOTAL.inc(outcome="failed")
+    except DeadlineExceeded as e:
+        logging.error(f"{str(e)} - stage times: {format_stage_times(deadline)}")
+        EMAILS_TOTAL.inc(outcome="deadline_exceeded")
+        outcome = "deadline_exceeded"
     except Exception as e:
         logging.error(f"Error processing email {email_id}: {str(e)}")
+        EMAILS_TOTAL.inc(outcome="error")
+    finally:
+        EMAILS_IN_FLIGHT.dec()
+        finish_email(email_id, result, mailbox, outcome, deadline)
+
+
+class QueuedEmail:
+    """A notification waiting for one of the email workers"""
+
+    def __init__(self, email_id, event, deadline, mailbox):
+        self.email_id = email_id
+        self.event = event
+        self.deadline = deadline
+        self.mailbox = mailbox
+
+
+def _email_worker(email_queue):
+    while True:
+        queued = email_queue.get()
+        try:
+            process_email_background(queued.email_id, queued.event, queued.deadline, queued.mailbox)
+        finally:
+            email_queue.release(queued)
+
+
+def get_email_queue():
+    """This function returns the queue of the email workers, starting EMAIL_WORKERS threads on first use
+    The queue has a partition per mailbox. The workers take from the mailboxes in turn,
+    each within its max_concurrent, so a busy mailbox does not hold every worker
+    Returns:
+        MailboxQueue: The queue
+    """
+    with _email_queue_lock:
+        if _email_queue["queue"] is None:
+            email_queue = MailboxQueue()
+            for index in range(EMAIL_WORKERS):
+                threading.Thread(target=_email_worker, args=(email_queue,), name=f"email-{index}", daemon=True).start()
+            _email_queue["queue"] = email_queue
+        return _email_queue["queue"]
+
+
+def get_started_pipeline():
+    """This function returns the pipeline, or the queue, of the enabled mode if it was already created
+    Used by the scrapes, which must not start workers nor import the pipeline modules
+    Returns:
+        AsyncPipeline, StagedPipeline or MailboxQueue: The pipeline, or None if it was not created yet
+    """
+    if ASYNC_PIPELINE:
+        return _async_pipeline["pipeline"]
+    if STAGED_PIPELINE:
+        orchestration = sys.modules.get("orchestration")
+        return orchestration.get_started_staged_pipeline() if orchestration else None
+    return _email_queue["queue"]
+
+
+def get_mailbox_stats():
+    """This function returns the waiting and active emails of each mailbox in the enabled pipeline
+    Returns:
+        dict: queued, active and max_concurrent, by mailbox name, all zero before the pipeline is created
+    """
+    pipeline = get_started_pipeline()
+    if pipeline is None:
+        return {
+            mailbox.name: {"queued": 0, "active": 0, "max_concurrent": mailbox.max_concurrent}
+            for mailbox in get_mailboxes()
+        }
+    if ASYNC_PIPELINE:
+        return pipeline.mailbox_stats()
+    if STAGED_PIPELINE:
+        return pipeline.admission.stats()
+    return pipeline.stats()
+
+
+def get_async_pipeline():
+    """This function returns the async pipeline, starting its event loop on first use
+    Returns:
+        AsyncPipeline: The pipeline
+    """
+    with _async_pipeline_lock:
+        if _async_pipeline["pipeline"] is None:
+            # Imported here, like the other pipelines, so the webhook starts without the pipeline modules
+            from async_orchestration import AsyncPipeline
+
+            pipeline = AsyncPipeline()
+            pipeline.start_in_background()
+            _async_pipeline["pipeline"] = pipeline
+        return _async_pipeline["pipeline"]
+
+
+def get_staged_pipeline():
+    """This function returns the staged pipeline, importing the pipeline modules on first use
+    Returns:
+        StagedPipeline: The pipeline
+    """
+    from orchestration import get_staged_pipeline as get_pipeline
+
+    return get_pipeline()
+
+
+def warm_up():
+    """This function loads what the first email would otherwise wait for
+    Steps:
+        1. Import the pipeline modules (pandas, OpenCV, PyMuPDF)
+        2. Reserve the invoice numbers of the checkpointed emails
+        3. Connect to SQL Server, load the reference data and seed the invoice number series
+        4. Start the staged pipeline, when it is enabled, and the sweep of old checkpoints
+    Runs in the background while the webhook already answers; a notification
+    accepted meanwhile waits for the imports instead of failing.
+    """
+    warm_up_started_at = time.perf_counter()
+    try:
+        from orchestration import reserve_checkpointed_invoice_numbers
+        from ProcessingData.DB.reference_data import warm_reference_data, get_reference_table
+        from ProcessingData.transformations.number_series import seed_number_series
+        from ProcessingData.checkpoints import start_checkpoint_sweeper
+
+        # Before any invoice of a new email is numbered
+        reserve_checkpointed_invoice_numbers()
+        warm_reference_data()
+        seed_number_series(get_reference_table('purchase_header'))
+        if STAGED_PIPELINE:
+            get_staged_pipeline()
+        start_checkpoint_sweeper()
+        logging.info(f"Warm-up finished in {time.perf_counter() - warm_up_started_at:.2f}s")
+    except Exception as e:
+        logging.error(f"Error warming up: {str(e)}")
     finally:
-        with processing_lock:
-            pass
+        STARTUP_SECONDS.set(time.perf_counter() - warm_up_started_at, phase="warm_up")
 
 
 @app.route("/webhook", methods=["GET", "POST"])
@@ -63,25 +275,49 @@ def webhook():
             response = jsonify({"status": "success"}), 200
             
             data = request.get_json()
+            # Each mailbox's subscription names it in the notification URL
+            mailbox_name = request.args.get("mailbox")
+            record_notification(data, mailbox=mailbox_name)
             if "value" in data:
+                # Looked up before taking processing_lock: the first call imports the pipeline modules
+                # and starts its workers, which must not hold up the other notifications
+                if ASYNC_PIPELINE:
+                    pipeline = get_async_pipeline()
+                elif STAGED_PIPELINE:
+                    pipeline = get_staged_pipeline()
+                else:
+                    pipeline = get_email_queue()
+
                 for event in data["value"]:
                     email_id = event.get("resource", "").split('/')[-1]
+                    mailbox = resolve_mailbox(mailbox_name, event.get("resource"))
 
                     with processing_lock:
-                        if not is_already_processed(email_id):
-                            processed_emails[email_id] = {
+                        accepted = not is_already_processed(email_id, mailbox)
+                        if accepted:
+                            processed_emails[(mailbox.name, email_id)] = {
                                 'timestamp': datetime.now(),
                                 'event': event
                             }
-                            thread = threading.Thread(
-                                target=process_email_background,
-                                args=(email_id, event),
-                                daemon=True
-                            )
-                            thread.start()
-                            logging.info(f"Thread started for email {email_id}")
-                        else:
-                            logging.info(f"Email {email_id} is already being processed")
+                    if not accepted:
+                        logging.info(f"Email {email_id} of {mailbox.name} is already being processed")
+                        continue
+
+                    deadline = Deadline(EMAIL_DEADLINE_SECONDS, email_id)
+                    on_done = (
+                        lambda email_id, result, outcome, mailbox=mailbox, deadline=deadline: finish_email(
+                            email_id, result, mailbox, outcome, deadline
+                        )
+                    )
+                    if ASYNC_PIPELINE:
+                        pipeline.submit(email_id, deadline, mailbox, on_done)
+                        logging.info(f"Email {email_id} of {mailbox.name} submitted to the async pipeline")
+                    elif STAGED_PIPELINE:
+                        pipeline.submit(email_id, deadline, on_done=on_done, mailbox=mailbox)
+                        logging.info(f"Email {email_id} of {mailbox.name} submitted to the staged pipeline")
+                    else:
+                        pipeline.put(QueuedEmail(email_id, event, deadline, mailbox))
+                        logging.info(f"Email {email_id} queued for mailbox {mailbox.name}")
 
             return response
 
@@ -92,35 +328,131 @@ def webhook():
     return jsonify({"status": "error", "message": "Method not allowed"}), 405
 
 
-def setup_logging():
-    """Configura o sistema de logging"""
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+@app.route("/emails/<email_id>", methods=["GET"])
+def email_status(email_id):
+    """This function returns when an email was accepted and, once it ended, when and with which result
+    The mailbox is given with ?mailbox=<name>, the default one otherwise
+    """
+    mailbox = find_mailbox(request.args.get("mailbox")) or get_mailbox()
+    with processing_lock:
+        entry = processed_emails.get((mailbox.name, email_id))
+        if entry is None:
+            return jsonify({"status": "unknown"}), 404
+        received_at, finished_at = entry['timestamp'], entry.get('finished_at')
+        status = {
+            "status": "finished" if finished_at else "processing",
+            "received_at": received_at.isoformat(),
+            "finished_at": finished_at.isoformat() if finished_at else None,
+            "succeeded": entry.get('result'),
+            "seconds": round((finished_at - received_at).total_seconds(), 3) if finished_at else None
+        }
+    return jsonify(status), 200
+
+
+@app.route("/pipeline", methods=["GET"])
+def pipeline_status():
+    """This function returns the queue depth and busy workers of each stage of the staged pipeline"""
+    if not STAGED_PIPELINE:
+        return jsonify({"status": "disabled"}), 200
+    return jsonify({"status": "enabled", "stages": get_staged_pipeline().stats()}), 200
+
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    
-    file_handler = RotatingFileHandler("logs/app.log", maxBytes=10*1024*1024, backupCount=5)
-    file_handler.setFormatter(formatter)
+@app.route("/mailboxes", methods=["GET"])
+def mailboxes_status():
+    """This function returns the waiting and active emails and the quota of each mailbox"""
+    return jsonify(get_mailbox_stats()), 200
 
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
 
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+@app.route("/debug/profiles", methods=["GET"])
+def profiles():
+    """This function returns the top functions and allocation sites of the last profiled emails
+    With the staged or async pipeline, each step of an email has its own summary, named by its "step"
+    """
+    if not PROFILING_ENABLED:
+        return jsonify({"status": "disabled"}), 200
+    summaries = get_profiling_summaries(request.args.get("email_id"))
+    return jsonify({"status": "enabled", "profiles": summaries}), 200
+
+
+def collect_runtime_metrics():
+    """This function reports the caches, sessions, limiters and queues at scrape time
+    Returns:
+        list: (name, type, help, [(labels, value)]) for each metric
+    """
+    decision_stats = get_decision_cache_stats()
+    # Not imported here, the payload builders import pandas. Nothing was sent to Navision before it is loaded
+    navision_post_data = sys.modules.get("ProcessingData.API.navision_post_data")
+    if navision_post_data is not None:
+        navision_stats = navision_post_data.get_navision_session_stats()
+    else:
+        navision_stats = {"requests": 0, "handshakes": 0}
+    throttling_stats = get_throttling_stats()
+    with processing_lock:
+        tracked_emails = len(processed_emails)
+
+    metrics = [
+        ("invoice_decision_cache_requests_total", "counter", "Decision cache lookups, by result",
+         [({"result": "hit"}, decision_stats["hits"]), ({"result": "miss"}, decision_stats["misses"])]),
+        ("invoice_decision_cache_size", "gauge", "Decisions in the cache",
+         [({}, decision_stats["size"])]),
+        ("invoice_navision_requests_total", "counter", "Requests sent to Navision",
+         [({}, navision_stats["requests"])]),
+        ("invoice_navision_handshakes_total", "counter", "NTLM handshakes with Navision",
+         [({}, navision_stats["handshakes"])]),
+        ("invoice_throttle_limit", "gauge", "Concurrent calls allowed to each backend",
+         [({"backend": backend}, stats["limit"]) for backend, stats in throttling_stats.items()]),
+        ("invoice_throttle_in_flight", "gauge", "Calls in flight to each backend",
+         [({"backend": backend}, stats["in_flight"]) for backend, stats in throttling_stats.items()]),
+        ("invoice_throttled_responses_total", "counter", "Throttled responses from each backend",
+         [({"backend": backend}, stats["throttled"]) for backend, stats in throttling_stats.items()]),
+        ("invoice_tracked_emails", "gauge", "Emails remembered to ignore duplicate notifications",
+         [({}, tracked_emails)])
+    ]
 
+    mailbox_stats = get_mailbox_stats()
+    metrics.append(("invoice_mailbox_queued", "gauge", "Emails of each mailbox waiting for a slot of its quota",
+                    [({"mailbox": name}, stats["queued"]) for name, stats in mailbox_stats.items()]))
+    metrics.append(("invoice_mailbox_active", "gauge", "Emails of each mailbox being processed",
+                    [({"mailbox": name}, stats["active"]) for name, stats in mailbox_stats.items()]))
 
-def start_webhook():
-    """Inicia o servidor webhook"""
+    staged_pipeline = get_started_pipeline() if STAGED_PIPELINE else None
+    if staged_pipeline is not None:
+        stage_stats = staged_pipeline.stats()
+        metrics.append(("invoice_stage_queued", "gauge", "Emails waiting in the queue of each stage",
+                        [({"stage": name}, stats["queued"]) for name, stats in stage_stats.items()]))
+        metrics.append(("invoice_stage_busy", "gauge", "Busy workers of each stage",
+                        [({"stage": name}, stats["busy"]) for name, stats in stage_stats.items()]))
+    return metrics
+
+
+register_collector(collect_runtime_metrics)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """This function returns the metrics in the Prometheus text format"""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def start_webhook(port=WEBHOOK_PORT, started_at=None):
+    """Inicia o servidor webhook
+    Sets webhook_ready once the port is bound, before serving
+    Args:
+        port (int): The port to listen on
+        started_at (float): time.perf_counter() at the start of the process, for the startup metric
+    """
     try:
         logging.info("Starting webhook server...")
-        app.run(host='0.0.0.0', port=WEBHOOK_PORT, debug=False, use_reloader=False)
+        server = make_server('0.0.0.0', port, app, threaded=True)
+        if started_at is not None:
+            STARTUP_SECONDS.set(time.perf_counter() - started_at, phase="webhook_ready")
+        webhook_ready.set()
+        server.serve_forever()
     except Exception as e:
         logging.error(f"Error starting webhook: {str(e)}")
 
 
 if __name__ == "__main__":
     setup_logging()
+    threading.Thread(target=warm_up, daemon=True).start()
     start_webhook()
@@ -1,19 +1,40 @@
-import requests
 import logging
-from info.config import OPENAI_API_KEY
+import json
+import time
+import re
+from info.config import (
+    OPENAI_API_KEY,
+    OPENAI_API_URL,
+    CHATGPT_MODEL,
+    CHATGPT_PROMPT_TOKEN_BUDGET,
+    CHATGPT_BATCH_WINDOW_SECONDS,
+    CHATGPT_BATCH_MAX_SIZE
+)
+from ProcessingData.API.prompt_builder import (
+    build_prompt,
+    build_batch_prompt,
+    estimate_tokens,
+    PROMPT_INTRO,
+    BATCH_PROMPT_FOOTER
+)
+from ProcessingData.batching import MicroBatcher
+from ProcessingData.deadline import get_timeout, DeadlineExceeded
+from ProcessingData.API.throttling import send_with_throttling
+from ProcessingData.metrics import OPERATION_SECONDS
+from ProcessingData.structured_logging import debug_sampled
 
 
-def send_message(email_details, account_vendor):
-    """This function sends a message to the ChatGPT API
-    Steps:
-        1. Send the message to the ChatGPT API
-        2. Validate the response is a valid account number
-        3. Return the validated account number
+CHATGPT_API_URL = OPENAI_API_URL
+
+
+def build_chat_request(email_details, account_vendor, pdf_texts=None):
+    """This function builds the ChatGPT request that classifies one invoice
     Args:
         email_details (dict): The details of the email
         account_vendor (pd.DataFrame): The account vendor data
+        pdf_texts (list): The text of each PDF, defaults to the 'pdf_texts' of email_details
     Returns:
-        str: The validated account number from the ChatGPT API
+        tuple: (headers, data, prompt, valid_accounts)
     """
     headers = {
         "Authorization": f"Bearer {OPENAI_API_KEY}",
@@ -21,40 +42,22 @@ def send_message(email_details, account_vendor):
     }
 
     # Log dos PDFs recebidos
-    pdf_texts = email_details.get('pdf_texts', [])
-    logging.info(f"Number of PDFs received: {len(pdf_texts)}")
+    if pdf_texts is None:
+        pdf_texts = email_details.get('pdf_texts', [])
+    logging.info("Number of PDFs received: %d", len(pdf_texts))
     for i, pdf in enumerate(pdf_texts):
-        logging.info(f"PDF {i+1}:")
-        logging.info(f"  Filename: {pdf.get('filename', 'No filename')}")
-        logging.info(f"  Content length: {len(pdf.get('text', ''))}")
-        logging.info(f"  First 200 chars: {pdf.get('text', '')[:200]}")
-
-    anexos = [f"Arquivo: {pdf['filename']}, Conteúdo: {pdf['text']}" 
-              for pdf in pdf_texts]
-    anexos_str = "\n".join(anexos)
-
-    # Log do conteúdo que será enviado
-    logging.info(f"Sending to ChatGPT - Attachments content length: {len(anexos_str)}")
+        debug_sampled("PDF %d (%s), %d characters: %.200s", i + 1, pdf.get('filename', 'No filename'),
+                      len(pdf.get('text', '')), pdf.get('text', ''))
 
     # Extrai apenas os números das contas disponíveis para validação posterior
-    valid_accounts = account_vendor['No_'].tolist()
-    logging.info(f"Available accounts: {valid_accounts}")
-    
-    prompt = (
-        "Você é um assistente especializado em análise de documentos e correspondência contábil.\n\n"
-        "### 📊 Contas Disponíveis:\n"
-        f"{account_vendor.to_string()}\n\n"
-        "### 📧 Email:\n"
-        f"- Remetente: {email_details.get('sender', '')}\n"
-        f"- Assunto: {email_details.get('subject', '')}\n"
-        f"- Conteúdo: {email_details.get('body', '')}\n"
-        f"- Anexos: {anexos_str}\n\n"
-        "📌 IMPORTANTE: Retorne APENAS o número exato da conta (No_) que melhor corresponde. "
-        "A resposta deve ser EXATAMENTE igual a um dos números de conta listados acima, sem texto adicional."
-    )
+    valid_accounts = account_vendor['No_'].astype(str).unique().tolist()
+    logging.info("Available accounts: %d", len(valid_accounts))
+    debug_sampled("Available accounts: %s", valid_accounts)
+
+    prompt = build_prompt(email_details, account_vendor, pdf_texts, CHATGPT_PROMPT_TOKEN_BUDGET)
 
     data = {
-        "model": "gpt-4",
+        "model": CHATGPT_MODEL,
         "messages": [
             {"role": "system", "content": "Você é um assistente especializado em classificação contábil. Responda APENAS com o número da conta, sem texto adicional."},
             {"role": "user", "content": prompt}
@@ -62,30 +65,196 @@ def send_message(email_details, account_vendor):
         "temperature": 0.1,
         "max_tokens": 10  # Reduzido para garantir apenas o número da conta
     }
+    return headers, data, prompt, valid_accounts
+
+
+def read_chat_answer(status_code, body, text, valid_accounts):
+    """This function validates the answer of ChatGPT for one invoice
+    Args:
+        status_code (int): The HTTP status of the response
+        body (dict): The JSON body of the response, None if it is not a 200
+        text (str): The raw body of the response, used in the logs
+        valid_accounts (list): The candidate account numbers
+    Returns:
+        str: The validated account number, or False if it is not valid
+    """
+    if status_code != 200:
+        logging.error(f"Error in ChatGPT API: {status_code}")
+        logging.error(f"Response content: {text}")
+        return False
+
+    account_number = body["choices"][0]["message"]["content"].strip()
+    logging.info(f"ChatGPT response: '{account_number}'")
+
+    # Valida se a resposta é uma conta válida
+    if account_number not in valid_accounts:
+        logging.error(f"ChatGPT returned invalid account number: '{account_number}' ({len(valid_accounts)} valid accounts)")
+        logging.debug("Valid accounts are: %s", valid_accounts)
+        return False
+
+    logging.info(f"Valid account number found: {account_number}")
+    return account_number
+
+
+def send_message(email_details, account_vendor, pdf_texts=None):
+    """This function sends a message to the ChatGPT API
+    Steps:
+        1. Build a prompt that fits in CHATGPT_PROMPT_TOKEN_BUDGET
+        2. Send the message to the ChatGPT API
+        3. Validate the response is a valid account number
+        4. Return the validated account number
+    Args:
+        email_details (dict): The details of the email
+        account_vendor (pd.DataFrame): The account vendor data
+        pdf_texts (list): The text of each PDF, defaults to the 'pdf_texts' of email_details
+    Returns:
+        str: The validated account number from the ChatGPT API
+    """
+    headers, data, prompt, valid_accounts = build_chat_request(email_details, account_vendor, pdf_texts)
+
+    try:
+        started_at = time.monotonic()
+        response = send_with_throttling(
+            "openai",
+            "post",
+            CHATGPT_API_URL,
+            headers=headers,
+            json=data,
+            timeout=get_timeout()
+        )
+        OPERATION_SECONDS.observe(time.monotonic() - started_at, operation="chatgpt")
+        logging.info(
+            f"ChatGPT call: prompt {len(prompt)} characters (~{estimate_tokens(prompt)} tokens), "
+            f"latency {time.monotonic() - started_at:.2f}s, status {response.status_code}"
+        )
+
+        body = response.json() if response.status_code == 200 else None
+        return read_chat_answer(response.status_code, body, response.text, valid_accounts)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.error(f"Exception in ChatGPT API: {str(e)}")
+        return False
+
+
+def parse_batch_answer(content, invoices):
+    """This function reads the JSON array answered for a batch and validates each account
+    Args:
+        content (str): The answer of ChatGPT
+        invoices (list): (email_details, account_vendor, pdf_texts) tuples, in the order of the prompt
+    Returns:
+        list: The account of each invoice, or None where the answer is missing or not a candidate
+    """
+    accounts = [None] * len(invoices)
+
+    match = re.search(r"\[.*\]", content or "", re.DOTALL)
+    try:
+        answer = json.loads(match.group(0)) if match else []
+    except ValueError:
+        answer = []
+    if not isinstance(answer, list):
+        answer = []
+
+    for position, ((_, account_vendor, _), account) in enumerate(zip(invoices, answer)):
+        account = str(account).strip()
+        if account in account_vendor['No_'].astype(str).unique():
+            accounts[position] = account
+        else:
+            logging.error(f"ChatGPT returned invalid account number '{account}' for invoice {position + 1} of the batch")
+
+    return accounts
+
+
+def send_messages_batch(invoices):
+    """This function classifies several invoices with a single ChatGPT request
+    Steps:
+        1. Build one prompt with a section per invoice, asking for a JSON array of accounts
+        2. Validate each account against the candidates of its invoice
+        3. Classify the invoices without a valid answer one by one with send_message
+    Args:
+        invoices (list): (email_details, account_vendor, pdf_texts) tuples
+    Returns:
+        list: The validated account number of each invoice, or False where it failed
+    """
+    if len(invoices) == 1:
+        return [send_message(*invoices[0])]
+
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    section_budget = (
+        CHATGPT_PROMPT_TOKEN_BUDGET
+        - estimate_tokens(PROMPT_INTRO)
+        - estimate_tokens(BATCH_PROMPT_FOOTER.format(count=len(invoices)))
+    )
+    prompt = build_batch_prompt(invoices, section_budget)
+
+    data = {
+        "model": CHATGPT_MODEL,
+        "messages": [
+            {"role": "system", "content": "Você é um assistente especializado em classificação contábil. Responda APENAS com um array JSON de números de conta, sem texto adicional."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.1,
+        "max_tokens": 10 * len(invoices) + 10
+    }
 
+    accounts = [None] * len(invoices)
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
+        started_at = time.monotonic()
+        response = send_with_throttling(
+            "openai",
+            "post",
+            CHATGPT_API_URL,
             headers=headers,
-            json=data
+            json=data,
+            timeout=get_timeout()
+        )
+        OPERATION_SECONDS.observe(time.monotonic() - started_at, operation="chatgpt_batch")
+        logging.info(
+            f"ChatGPT batch call: {len(invoices)} invoices, prompt {len(prompt)} characters "
+            f"(~{estimate_tokens(prompt)} tokens), latency {time.monotonic() - started_at:.2f}s, "
+            f"status {response.status_code}"
         )
 
         if response.status_code == 200:
-            account_number = response.json()["choices"][0]["message"]["content"].strip()
-            logging.info(f"ChatGPT response: '{account_number}'")
-            
-            # Valida se a resposta é uma conta válida
-            if account_number not in valid_accounts:
-                logging.error(f"ChatGPT returned invalid account number: '{account_number}'")
-                logging.error(f"Valid accounts are: {valid_accounts}")
-                return False
-            
-            logging.info(f"Valid account number found: {account_number}")
-            return account_number
+            content = response.json()["choices"][0]["message"]["content"]
+            logging.info(f"ChatGPT batch response: '{content.strip()}'")
+            accounts = parse_batch_answer(content, invoices)
         else:
             logging.error(f"Error in ChatGPT API: {response.status_code}")
             logging.error(f"Response content: {response.text}")
-            return False
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"Exception in ChatGPT API: {str(e)}")
-        return False
+
+    # Invoices the batch could not classify are asked again on their own
+    return [
+        account if account else send_message(*invoice)
+        for invoice, account in zip(invoices, accounts)
+    ]
+
+
+classification_batcher = MicroBatcher(
+    send_messages_batch,
+    CHATGPT_BATCH_WINDOW_SECONDS,
+    CHATGPT_BATCH_MAX_SIZE,
+    name="ChatGPT classification batch"
+)
+
+
+def classify_account(email_details, account_vendor, pdf_texts=None):
+    """This function asks ChatGPT for the account of an invoice, together with other invoices when batching is enabled
+    Args:
+        email_details (dict): The details of the email
+        account_vendor (pd.DataFrame): The account vendor data
+        pdf_texts (list): The text of each PDF
+    Returns:
+        str: The validated account number, or False if it failed
+    """
+    if CHATGPT_BATCH_WINDOW_SECONDS > 0:
+        return classification_batcher.submit((email_details, account_vendor, pdf_texts))
+    return send_message(email_details, account_vendor, pdf_texts)
@@ -0,0 +1,198 @@
+from info.config import (
+    DECISION_CACHE_TTL_SECONDS,
+    DECISION_CACHE_MAX_SIZE,
+    DECISION_CACHE_FILE
+)
+from collections import Counter, OrderedDict
+import unicodedata
+import threading
+import hashlib
+import logging
+import json
+import time
+import re
+import os
+
+
+# QR code columns with the taxable base of each VAT rate
+VAT_BASE_COLUMNS = ['I2', 'I3', 'I5', 'I7']
+FINGERPRINT_TOKENS = 8
+FINGERPRINT_TEXT_CHARS = 2000
+
+# Words that change from one monthly invoice to the next or carry no meaning
+IGNORED_TOKENS = {
+    "janeiro", "fevereiro", "marco", "abril", "maio", "junho", "julho", "agosto",
+    "setembro", "outubro", "novembro", "dezembro", "fatura", "factura", "faturas",
+    "recibo", "documento", "anexo", "original", "duplicado", "para", "pelo", "pela",
+    "como", "mais", "este", "esta", "total", "valor", "data", "email", "www"
+}
+
+_decision_cache = OrderedDict()
+_decision_cache_lock = threading.Lock()
+_decision_cache_state = {"loaded": False}
+_decision_stats = {"hits": 0, "misses": 0}
+
+
+def _normalize_tokens(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [
+        token for token in re.findall(r"[a-z]{4,}", text)
+        if token not in IGNORED_TOKENS
+    ]
+
+
+def build_invoice_fingerprint(df, email_details, pdf_texts=None):
+    """This function builds a fingerprint of the features that decide the account of an invoice
+    Steps:
+        1. Take the document type from the QR code
+        2. Take which VAT rates have a taxable base
+        3. Take the most frequent words of the subject and of the beginning of the PDFs,
+           ignoring numbers, dates and month names so recurring invoices get the same fingerprint
+    Args:
+        df (pd.DataFrame): The QR code data of the invoice
+        email_details (dict): The details of the email
+        pdf_texts (list): The text of each PDF
+    Returns:
+        str: The fingerprint
+    """
+    document_type = str(df['D'].iloc[0]) if 'D' in df.columns else ''
+
+    vat_mix = []
+    for column in VAT_BASE_COLUMNS:
+        if column in df.columns:
+            try:
+                if float(str(df[column].iloc[0]).strip()) != 0:
+                    vat_mix.append(column)
+            except ValueError:
+                continue
+
+    text = (email_details or {}).get('subject', '') or ''
+    for pdf in pdf_texts or []:
+        text += " " + pdf.get('text', '')[:FINGERPRINT_TEXT_CHARS]
+    tokens = sorted(token for token, _ in Counter(_normalize_tokens(text)).most_common(FINGERPRINT_TOKENS))
+
+    features = {"document_type": document_type, "vat_mix": vat_mix, "tokens": tokens}
+    return hashlib.sha1(json.dumps(features, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_history_signature(candidate_accounts):
+    """This function returns a signature of the accounts a vendor has used,
+    so cached decisions are dropped when a new account appears in its history
+    Args:
+        candidate_accounts (list): The account numbers of the vendor
+    Returns:
+        str: The signature
+    """
+    accounts = sorted({str(account) for account in candidate_accounts})
+    return hashlib.sha1("|".join(accounts).encode("utf-8")).hexdigest()
+
+
+def _load_from_disk():
+    if _decision_cache_state["loaded"]:
+        return
+    _decision_cache_state["loaded"] = True
+
+    if not DECISION_CACHE_FILE or not os.path.exists(DECISION_CACHE_FILE):
+        return
+
+    try:
+        with open(DECISION_CACHE_FILE, encoding="utf-8") as file:
+            for entry in json.load(file):
+                _decision_cache[(entry["vendor"], entry["fingerprint"])] = entry
+        logging.info(f"Loaded {len(_decision_cache)} cached account decisions")
+    except Exception as e:
+        logging.error(f"Error loading account decision cache: {str(e)}")
+
+
+def _save_to_disk():
+    if not DECISION_CACHE_FILE:
+        return
+
+    try:
+        directory = os.path.dirname(DECISION_CACHE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{DECISION_CACHE_FILE}.tmp", "w", encoding="utf-8") as file:
+            json.dump(list(_decision_cache.values()), file)
+        os.replace(f"{DECISION_CACHE_FILE}.tmp", DECISION_CACHE_FILE)
+    except Exception as e:
+        logging.error(f"Error saving account decision cache: {str(e)}")
+
+
+def get_cached_decision(vendor_no, fingerprint, candidate_accounts):
+    """This function returns the account chosen before for the same vendor and fingerprint
+    Args:
+        vendor_no (str): The No_ of the vendor
+        fingerprint (str): The fingerprint built by build_invoice_fingerprint
+        candidate_accounts (list): The accounts the vendor has used
+    Returns:
+        str: The cached account, or None if there is no valid decision
+    """
+    key = (str(vendor_no), fingerprint)
+    signature = get_history_signature(candidate_accounts)
+
+    with _decision_cache_lock:
+        _load_from_disk()
+        entry = _decision_cache.get(key)
+
+        valid = (
+            entry is not None
+            and time.time() - entry["created_at"] < DECISION_CACHE_TTL_SECONDS
+            and entry["history_signature"] == signature
+        )
+        if not valid:
+            if entry is not None:
+                del _decision_cache[key]
+            _decision_stats["misses"] += 1
+            return None
+
+        _decision_cache.move_to_end(key)
+        _decision_stats["hits"] += 1
+
+    logging.info(f"Account {entry['account']} reused from a previous decision for vendor {vendor_no}")
+    return entry["account"]
+
+
+def store_decision(vendor_no, fingerprint, candidate_accounts, account):
+    """This function saves the account chosen for a vendor and fingerprint
+    Args:
+        vendor_no (str): The No_ of the vendor
+        fingerprint (str): The fingerprint built by build_invoice_fingerprint
+        candidate_accounts (list): The accounts the vendor has used
+        account (str): The chosen account
+    """
+    key = (str(vendor_no), fingerprint)
+
+    with _decision_cache_lock:
+        _load_from_disk()
+        _decision_cache[key] = {
+            "vendor": key[0],
+            "fingerprint": fingerprint,
+            "account": str(account),
+            "history_signature": get_history_signature(candidate_accounts),
+            "created_at": time.time()
+        }
+        _decision_cache.move_to_end(key)
+
+        while len(_decision_cache) > DECISION_CACHE_MAX_SIZE:
+            _decision_cache.popitem(last=False)
+
+        _save_to_disk()
+
+
+def get_decision_cache_stats():
+    """This function returns the hits, misses and size of the decision cache
+    Returns:
+        dict: hits, misses and size
+    """
+    with _decision_cache_lock:
+        return dict(_decision_stats, size=len(_decision_cache))
+
+
+def clear_decision_cache():
+    """This function forgets every cached decision, including the ones on disk"""
+    with _decision_cache_lock:
+        _decision_cache.clear()
+        _decision_cache_state["loaded"] = True
+        _save_to_disk()
@@ -1,14 +1,19 @@
-import requests
 from info.config import (
     TENANT_ID, 
+    AZURE_AD_AUTHORITY,
     CLIENT_ID, 
     CLIENT_SECRET, 
     GRAPH_API_BASE_URL,
     WEBHOOK_URL,
-    MAILBOX_USER_ID,
-    DESTINATION_EMAIL
+    DESTINATION_EMAIL,
+    REQUEST_TIMEOUT_SECONDS
 )
+from ProcessingData.API.throttling import send_with_throttling
+from ProcessingData.deadline import DeadlineExceeded
+from ProcessingData.metrics import ALERTS_TOTAL
+from ProcessingData.mailboxes import get_mailbox
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import logging
 
 
@@ -16,6 +21,7 @@ _token_cache = {
     "access_token": None,
     "expires_at": None
 }
+_alerts = {"enabled": True}
 
 
 def get_access_token():
@@ -28,7 +34,7 @@ def get_access_token():
         logging.info("Using cached token")
         return _token_cache["access_token"]
 
-    url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+    url = f"{AZURE_AD_AUTHORITY}/{TENANT_ID}/oauth2/v2.0/token"
 
     payload = {
         "client_id": CLIENT_ID,
@@ -40,7 +46,7 @@ def get_access_token():
     logging.info("Requesting new access token...")
 
     try:
-        response = requests.post(url, data=payload)
+        response = send_with_throttling("azure_ad", "post", url, data=payload, timeout=REQUEST_TIMEOUT_SECONDS)
 
         if response.status_code == 200:
             token_data = response.json()
@@ -56,13 +62,33 @@ def get_access_token():
         logging.error(f"Error getting token. Status: {response.status_code}")
         return None
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"Exception getting token: {str(e)}")
         return None
 
 
-def subscribe_to_emails():
-    """This function subscribes to new emails with specific filters"""
+def notification_url(mailbox):
+    """This function returns the webhook URL of a mailbox's subscription, which names the mailbox
+    Args:
+        mailbox (Mailbox): The mailbox
+    Returns:
+        str: WEBHOOK_URL with a mailbox query parameter
+    """
+    if not WEBHOOK_URL:
+        return WEBHOOK_URL
+    scheme, netloc, path, query, fragment = urlsplit(WEBHOOK_URL)
+    query = urlencode(parse_qsl(query) + [("mailbox", mailbox.name)])
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def subscribe_to_emails(mailbox=None):
+    """This function subscribes to new emails with specific filters
+    Args:
+        mailbox (Mailbox): The mailbox to subscribe to, defaults to the current one
+    """
+    mailbox = mailbox or get_mailbox()
     access_token = get_access_token()
     if not access_token:
         logging.error("Unable to obtain access token")
@@ -83,27 +109,30 @@ def subscribe_to_emails():
     ]
 
     resource = (
-        f"users/{MAILBOX_USER_ID}/messages"
+        f"users/{mailbox.user_id}/messages"
         f"?$filter={' and '.join(filters)}"
     )
 
     payload = {
         "changeType": "created",
-        "notificationUrl": WEBHOOK_URL,
+        "notificationUrl": notification_url(mailbox),
         "resource": resource,
         "expirationDateTime": expiration_date,
         "clientState": "EmailMonitoringApp"
     }
 
-    logging.info("Iniciando subscrição com filtros:")
+    logging.info(f"Iniciando subscrição da caixa {mailbox.name} com filtros:")
     logging.info(f"- Data inicial: {start_time}")
     logging.info(f"- Resource URL: {resource}")
 
     try:
-        response = requests.post(
+        response = send_with_throttling(
+            "graph",
+            "post",
             f"{GRAPH_API_BASE_URL}/subscriptions",
             headers=headers,
-            json=payload
+            json=payload,
+            timeout=REQUEST_TIMEOUT_SECONDS
         )
 
         logging.info(f"Response status: {response.status_code}")
@@ -123,6 +152,14 @@ def subscribe_to_emails():
         return False
 
 
+def set_alerts_enabled(enabled):
+    """This function turns the alert emails on or off, e.g. for dry runs
+    Args:
+        enabled (bool): False to only log the alerts
+    """
+    _alerts["enabled"] = enabled
+
+
 def send_email(subject, message):
     """This function sends an email using the Microsoft Graph API
     Steps:
@@ -132,6 +169,11 @@ def send_email(subject, message):
         subject (str): The subject of the email
         message (str): The message of the email
     """
+    ALERTS_TOTAL.inc(reason=subject)
+    if not _alerts["enabled"]:
+        logging.info(f"Alert not sent (alerts disabled): {subject}")
+        return True
+
     access_token = get_access_token()
     if not access_token:
         logging.error("Unable to obtain access token")
@@ -186,10 +228,11 @@ def send_email(subject, message):
             } for email in cc_recipients
         ]
 
-    url = f"{GRAPH_API_BASE_URL}/users/{MAILBOX_USER_ID}/sendMail"
+    # Alerts are sent from the mailbox of the email they are about
+    url = f"{GRAPH_API_BASE_URL}/users/{get_mailbox().user_id}/sendMail"
     
     try:
-        response = requests.post(url, headers=headers, json=email_data)
+        response = send_with_throttling("graph", "post", url, headers=headers, json=email_data, timeout=REQUEST_TIMEOUT_SECONDS)
         if response.status_code == 202:
             logging.info("Email sent successfully")
             return True
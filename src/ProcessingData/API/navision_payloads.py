@@ -0,0 +1,118 @@
+import pandas as pd
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+# (payload field, DataFrame column, type) of each entity sent to Navision
+HEADER_FIELDS = [
+    ("Document_Type", "Document Type", "str"),
+    ("No", "No_", "str"),
+    ("Buy_from_Vendor_No", "Buy-from Vendor No_", "str"),
+    ("Document_Date", "Document Date", "date"),
+    ("Vendor_Invoice_No", "Vendor Invoice No_", "str")
+]
+
+LINE_FIELDS = [
+    ("Document_Type", "Document Type", "str"),
+    ("Document_No", "Document_No", "str"),
+    ("Line_No", "Line_No", "int"),
+    ("Quantity", "Quantity", "float"),
+    ("Direct_Unit_Cost", "Direct_Unit_Cost", "float"),
+    ("Total_VAT_Amount", "Total_VAT_Amount", "float"),
+    ("Type", "Type", "str"),
+    ("FilteredTypeField", "FilteredTypeField", "str"),
+    ("No", "No", "str"),
+    ("VAT_Prod_Posting_Group", "VAT_Prod_Posting_Group", "str"),
+    ("Withholding_Tax_Code", "Withholding_Tax_Code", "str")
+]
+
+# Fields only sent for the rows where the condition is True
+LINE_CONDITIONS = {
+    "Withholding_Tax_Code": lambda df: ~df["Document_No"].astype(str).str.startswith('F')
+}
+
+
+def _convert_column(column, field_type):
+    """Converts a whole column to Python values, using None for missing values"""
+    missing = column.isna()
+
+    if field_type == "date":
+        values = pd.to_datetime(column).dt.strftime("%Y-%m-%d")
+    elif field_type == "float":
+        values = column.astype(float)
+    elif field_type == "int":
+        values = column.fillna(0).astype(int)
+    else:
+        values = column.astype(str)
+
+    return [None if is_missing else value for value, is_missing in zip(values.tolist(), missing.tolist())]
+
+
+def build_payloads(df, fields, conditions=None):
+    """This function converts a DataFrame into Navision payloads, one column at a time
+    Steps:
+        1. Convert each mapped column present in the DataFrame to its payload type in a single vectorized call
+        2. Blank the conditional fields in the rows where their condition is False
+        3. Zip the columns into one dict per row, leaving out missing values and empty strings
+    Args:
+        df (pd.DataFrame): DataFrame with the data of the entity
+        fields (list): The (payload field, column, type) mapping of the entity
+        conditions (dict): Optional payload field -> function returning a boolean mask of the rows to send it
+    Returns:
+        list: One payload dict per row. Legitimate zeros are kept
+    """
+    if df.empty:
+        return []
+
+    names = []
+    columns = []
+    for name, column, field_type in fields:
+        if column not in df.columns:
+            continue
+        values = _convert_column(df[column], field_type)
+        if conditions and name in conditions:
+            mask = conditions[name](df).tolist()
+            values = [value if send else None for value, send in zip(values, mask)]
+        names.append(name)
+        columns.append(values)
+
+    return [
+        {name: value for name, value in zip(names, row) if value is not None and value != ""}
+        for row in zip(*columns)
+    ]
+
+
+def build_header_payloads(header_df):
+    """This function builds the header payloads
+    Args:
+        header_df (pd.DataFrame): DataFrame containing the header data
+    Returns:
+        list: One payload per header
+    """
+    return build_payloads(header_df, HEADER_FIELDS)
+
+
+def build_line_payloads(line_df):
+    """This function builds the line payloads
+    Args:
+        line_df (pd.DataFrame): DataFrame containing the line data
+    Returns:
+        list: One payload per line
+    """
+    return build_payloads(line_df, LINE_FIELDS, LINE_CONDITIONS)
+
+
+def serialize_payload(payload):
+    """This function serializes a payload to JSON, with orjson when it is installed
+    Args:
+        payload (dict): The payload to serialize
+    Returns:
+        bytes: The JSON document
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
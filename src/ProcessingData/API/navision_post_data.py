@@ -1,13 +1,108 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests_ntlm import HttpNtlmAuth
-import pandas as pd
+from ProcessingData.API.navision_payloads import (
+    build_header_payloads,
+    build_line_payloads,
+    serialize_payload
+)
+from ProcessingData.deadline import get_timeout
+from ProcessingData.metrics import OPERATION_SECONDS
+from email.parser import BytesParser
+from info.config import (
+    NAVISION_API_URL,
+    NAVISION_COMPANY,
+    NAVISION_USERNAME,
+    NAVISION_PASSWORD,
+    NAVISION_POOL_SIZE
+)
+import threading
 import logging
+import json
+import uuid
 
 
-API_URL_HEADER = "http://SRV004.ADC.local:7048/BC140/ODataV4/Company('ADC')/Fatura_Compra"
-API_URL_LINE = "http://SRV004.ADC.local:7048/BC140/ODataV4/Company('ADC')/Linhas_Fatura_Compra"
-USERNAME = "joaquima"
-PASSWORD = "ItDep@AdCE2025"
+API_URL_BASE = NAVISION_API_URL.rstrip("/") + "/"
+HEADER_ENTITY = f"Company('{NAVISION_COMPANY}')/Fatura_Compra"
+LINE_ENTITY = f"Company('{NAVISION_COMPANY}')/Linhas_Fatura_Compra"
+API_URL_HEADER = API_URL_BASE + HEADER_ENTITY
+API_URL_LINE = API_URL_BASE + LINE_ENTITY
+API_URL_BATCH = API_URL_BASE + "$batch"
+
+_navision_session = {"session": None}
+_navision_session_lock = threading.Lock()
+_navision_stats = {"requests": 0, "handshakes": 0}
+
+
+def _count_handshake(response, *args, **kwargs):
+    """Response hook counting requests and the NTLM challenges they needed"""
+    with _navision_session_lock:
+        _navision_stats["requests"] += 1
+        if any(previous.status_code == 401 for previous in response.history):
+            _navision_stats["handshakes"] += 1
+    return response
+
+
+def get_navision_session():
+    """This function returns the long-lived session used to talk to Navision
+    Steps:
+        1. Create the session the first time, with NTLM authentication from the config
+        2. Keep a pool of connections, so an authenticated connection is reused by the next request
+    Returns:
+        requests.Session: The shared session
+    """
+    with _navision_session_lock:
+        if _navision_session["session"] is None:
+            session = requests.Session()
+            session.auth = HttpNtlmAuth(NAVISION_USERNAME, NAVISION_PASSWORD)
+            session.verify = False
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=NAVISION_POOL_SIZE))
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=NAVISION_POOL_SIZE))
+            session.hooks["response"].append(_count_handshake)
+            _navision_session["session"] = session
+            logging.info("Navision session created")
+        return _navision_session["session"]
+
+
+def reset_navision_session():
+    """This function closes the shared session, so the next request authenticates again"""
+    with _navision_session_lock:
+        session = _navision_session["session"]
+        _navision_session["session"] = None
+    if session is not None:
+        session.close()
+
+
+def get_navision_session_stats():
+    """This function returns how many requests were sent and how many NTLM handshakes they needed
+    Returns:
+        dict: requests, handshakes and saved (requests that reused an authenticated connection)
+    """
+    with _navision_session_lock:
+        stats = dict(_navision_stats)
+    stats["saved"] = stats["requests"] - stats["handshakes"]
+    return stats
+
+
+def post_to_navision(url, data, headers):
+    """This function posts to Navision through the shared session
+    Steps:
+        1. Send the request, reusing an authenticated connection when one is free
+        2. If Navision still answers 401, recreate the session and try once more
+    Args:
+        url (str): The URL to post to
+        data (bytes): The body of the request
+        headers (dict): The headers of the request
+    Returns:
+        requests.Response: The response of Navision
+    """
+    with OPERATION_SECONDS.time(operation="navision_post"):
+        response = get_navision_session().post(url, data=data, headers=headers, timeout=get_timeout())
+    if response.status_code == 401:
+        logging.warning("Navision rejected the session credentials - authenticating again")
+        reset_navision_session()
+        response = get_navision_session().post(url, data=data, headers=headers, timeout=get_timeout())
+    return response
 
 
 def send_header_df_to_navision(header_df):
@@ -15,22 +110,12 @@ def send_header_df_to_navision(header_df):
     Args:
         header_df (pd.DataFrame): DataFrame containing the header data
     """
-    for _, header_row in header_df.iterrows():
-        header_payload = {
-            "Document_Type": str(header_row["Document Type"]),
-            "No": str(header_row["No_"]),
-            "Buy_from_Vendor_No": str(header_row["Buy-from Vendor No_"]),
-            "Document_Date": header_row["Document Date"].strftime("%Y-%m-%d"),
-            "Vendor_Invoice_No": str(header_row["Vendor Invoice No_"])
-        }
-
-        header_payload = {k: v for k, v in header_payload.items() if v}
-
+    for header_payload in build_header_payloads(header_df):
         try:
-            header_response = send_header_to_navision(header_payload)
-            logging.info(f"Header sent successfully: {header_row['No_']}")
+            send_header_to_navision(header_payload)
+            logging.info(f"Header sent successfully: {header_payload.get('No')}")
         except requests.exceptions.RequestException as e:
-            logging.error(f"Error sending header {header_row['No_']}: {str(e)}")
+            logging.error(f"Error sending header {header_payload.get('No')}: {str(e)}")
             raise
 
 
@@ -39,23 +124,12 @@ def send_line_df_to_navision(line_df):
     Args:
         line_df (pd.DataFrame): DataFrame containing the line data
     """
-    for _, line_row in line_df.iterrows():
-        line_payload = {
-            "Document_Type": str(line_row["Document Type"]),
-            "Document_No": str(line_row["Document_No"]),
-            "Line_No": int(line_row["Line_No"]),
-            "Quantity": float(line_row["Quantity"]),
-            "Direct_Unit_Cost": float(line_row["Direct_Unit_Cost"]),
-            "Total_VAT_Amount": float(line_row["Total_VAT_Amount"]),
-        }
-
-        line_payload = {k: v for k, v in line_payload.items() if v}
-
+    for line_payload in build_line_payloads(line_df):
         try:
-            line_response = send_line_to_navision(line_payload)
-            logging.info(f"Line sent successfully: {line_row['Document_No']} - {line_row['Line_No']}")
+            send_line_to_navision(line_payload)
+            logging.info(f"Line sent successfully: {line_payload.get('Document_No')} - {line_payload.get('Line_No')}")
         except requests.exceptions.RequestException as e:
-            logging.error(f"Error sending line {line_row['Document_No']} - {line_row['Line_No']}: {str(e)}")
+            logging.error(f"Error sending line {line_payload.get('Document_No')} - {line_payload.get('Line_No')}: {str(e)}")
             raise
 
 
@@ -69,13 +143,7 @@ def send_header_to_navision(payload):
         "Content-Type": "application/json",
         "Accept": "application/json"
     }
-    response = requests.post(
-        API_URL_HEADER,
-        json=payload,
-        headers=headers,
-        auth=HttpNtlmAuth(USERNAME, PASSWORD),
-        verify=False
-    )
+    response = post_to_navision(API_URL_HEADER, serialize_payload(payload), headers)
     response.raise_for_status()
     return response
 
@@ -90,12 +158,134 @@ def send_line_to_navision(payload):
         "Content-Type": "application/json",
         "Accept": "application/json"
     }
-    response = requests.post(
-        API_URL_LINE,
-        json=payload,
-        headers=headers,
-        auth=HttpNtlmAuth(USERNAME, PASSWORD),
-        verify=False
-    )
+    response = post_to_navision(API_URL_LINE, serialize_payload(payload), headers)
     response.raise_for_status()
     return response
+
+
+def build_batch_request(invoices):
+    """This function builds an OData $batch request with one atomic changeset per invoice
+    Steps:
+        1. Open a changeset for each invoice
+        2. Add the POST of the header followed by the POSTs of its lines
+        3. Close the changeset and the batch
+    Args:
+        invoices (list): (header_payload, line_payloads) tuples
+    Returns:
+        tuple: (body bytes, batch boundary)
+    """
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    parts = []
+
+    for header_payload, line_payloads in invoices:
+        changeset_boundary = f"changeset_{uuid.uuid4()}"
+        parts.append(
+            f"--{batch_boundary}\r\n"
+            f"Content-Type: multipart/mixed; boundary={changeset_boundary}\r\n\r\n".encode()
+        )
+
+        requests_in_changeset = [(HEADER_ENTITY, header_payload)] + [(LINE_ENTITY, line) for line in line_payloads]
+        for content_id, (entity, payload) in enumerate(requests_in_changeset, start=1):
+            parts.append(
+                f"--{changeset_boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                "Content-Transfer-Encoding: binary\r\n"
+                f"Content-ID: {content_id}\r\n\r\n"
+                f"POST {entity} HTTP/1.1\r\n"
+                "Content-Type: application/json\r\n"
+                "Accept: application/json\r\n\r\n".encode()
+            )
+            parts.append(serialize_payload(payload) + b"\r\n")
+
+        parts.append(f"--{changeset_boundary}--\r\n".encode())
+
+    parts.append(f"--{batch_boundary}--\r\n".encode())
+    return b"".join(parts), batch_boundary
+
+
+def _parse_http_part(part):
+    """Parses an application/http part into its status, Content-ID and JSON body"""
+    raw = part.get_payload(decode=True) or b""
+    head, _, body = raw.partition(b"\r\n\r\n")
+    if not body and b"\n\n" in raw:
+        head, _, body = raw.partition(b"\n\n")
+
+    status_line = head.splitlines()[0].decode(errors="replace") if head else ""
+    status_parts = status_line.split(" ", 2)
+    status = int(status_parts[1]) if len(status_parts) > 1 and status_parts[1].isdigit() else 0
+
+    body = body.strip()
+    try:
+        body = json.loads(body) if body else None
+    except ValueError:
+        body = body.decode(errors="replace")
+
+    return {
+        "content_id": part.get("Content-ID"),
+        "status": status,
+        "body": body
+    }
+
+
+def parse_batch_response(content_type, content):
+    """This function parses an OData $batch response back into the responses of each changeset
+    Args:
+        content_type (str): The Content-Type header of the response, with its boundary
+        content (bytes): The body of the response
+    Returns:
+        list: One list of {content_id, status, body} per changeset, in the order they were sent.
+              A failed changeset has a single response with the error
+    """
+    message = BytesParser().parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + content
+    )
+    if not message.is_multipart():
+        return []
+
+    changesets = []
+    for part in message.get_payload():
+        if part.is_multipart():
+            changesets.append([_parse_http_part(response) for response in part.get_payload()])
+        else:
+            changesets.append([_parse_http_part(part)])
+    return changesets
+
+
+def send_invoices_batch(invoices):
+    """This function sends several invoices to Navision in a single $batch request
+    Steps:
+        1. Build the batch with one changeset per invoice, so a failing line rolls back its header
+        2. Send the batch
+        3. Parse the responses back per invoice and entity
+    Args:
+        invoices (list): (header_payload, line_payloads) tuples
+    Returns:
+        list: One {no, success, responses, error} dict per invoice, in the same order
+    """
+    body, batch_boundary = build_batch_request(invoices)
+    headers = {
+        "Content-Type": f"multipart/mixed; boundary={batch_boundary}",
+        "Accept": "multipart/mixed"
+    }
+    response = post_to_navision(API_URL_BATCH, body, headers)
+    response.raise_for_status()
+
+    changesets = parse_batch_response(response.headers.get("Content-Type", ""), response.content)
+
+    results = []
+    for index, (header_payload, line_payloads) in enumerate(invoices):
+        responses = changesets[index] if index < len(changesets) else []
+        failed = [entity for entity in responses if not 200 <= entity["status"] < 300]
+        success = len(responses) == len(line_payloads) + 1 and not failed
+
+        error = None
+        if not success:
+            error = failed[0]["body"] if failed else "Missing responses in batch"
+
+        results.append({
+            "no": header_payload.get("No"),
+            "success": success,
+            "responses": responses,
+            "error": error
+        })
+    return results
@@ -0,0 +1,257 @@
+from html.parser import HTMLParser
+import html
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is optional
+    tiktoken = None
+
+
+# Lines of the PDF text around these words hold the items and totals of the invoice
+PDF_KEYWORDS = re.compile(
+    r"total|iva|descri|designa|artigo|produto|servi|quant|qtd|pre[cç]o|base|incid|subtotal|per[ií]odo|refer",
+    re.IGNORECASE
+)
+PDF_WINDOW_LINES = 2
+# Share of the budget left after the accounts and the subject that the email body may use
+BODY_BUDGET_SHARE = 0.25
+
+_encoding = {"encoding": None}
+
+
+def estimate_tokens(text):
+    """This function estimates the number of tokens of a text, with tiktoken when it is installed
+    Args:
+        text (str): The text
+    Returns:
+        int: The number of tokens
+    """
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding["encoding"] is None:
+            _encoding["encoding"] = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding["encoding"].encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """This function cuts a text so it fits in a number of tokens
+    Args:
+        text (str): The text
+        max_tokens (int): The maximum number of tokens
+    Returns:
+        str: The text, cut if needed
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Proportional cut, then trim until it fits
+    cut = text[:max(0, int(len(text) * max_tokens / estimate_tokens(text)))]
+    while cut and estimate_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    return cut
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self._skip += 1
+        elif tag in ("br", "p", "div", "tr", "li"):
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def strip_html(content):
+    """This function converts an HTML email body to plain text
+    Args:
+        content (str): The body of the email
+    Returns:
+        str: The visible text, with blank lines and repeated spaces removed
+    """
+    if not content:
+        return ""
+    extractor = _TextExtractor()
+    try:
+        extractor.feed(content)
+        extractor.close()
+        text = "".join(extractor.parts)
+    except Exception:
+        text = re.sub(r"<[^>]+>", " ", content)
+    text = html.unescape(text)
+    lines = [re.sub(r"[ \t ]+", " ", line).strip() for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+def rank_accounts(account_vendor):
+    """This function returns the distinct candidate accounts, most used first, one per line
+    Args:
+        account_vendor (pd.DataFrame): The accounts of the vendor, with No_ and Description
+            and, when it comes from the account history, Usage and Last Used
+    Returns:
+        list: One "No_ - Description" line per account
+    """
+    accounts = account_vendor.copy()
+    accounts['Description'] = accounts['Description'].fillna('') if 'Description' in accounts.columns else ''
+
+    if 'Usage' in accounts.columns:
+        sort_columns = [column for column in ['Usage', 'Last Used'] if column in accounts.columns]
+        accounts = accounts.sort_values(sort_columns, ascending=False)
+    else:
+        accounts = (
+            accounts.groupby(['No_', 'Description'], sort=False).size().rename('Usage')
+            .reset_index().sort_values('Usage', ascending=False)
+        )
+
+    lines = []
+    seen = set()
+    for no, description, usage in zip(accounts['No_'], accounts['Description'], accounts['Usage']):
+        if no in seen:
+            continue
+        seen.add(no)
+        lines.append(f"{no} - {description} (usada {usage}x)" if description else f"{no} (usada {usage}x)")
+    return lines
+
+
+def select_pdf_windows(text, max_tokens):
+    """This function keeps the parts of a PDF text around its items and totals
+    Steps:
+        1. Find the lines with words like total, IVA, descrição or quantidade
+        2. Keep PDF_WINDOW_LINES lines around each of them
+        3. Fall back to the beginning of the text if nothing matches
+    Args:
+        text (str): The text of the PDF
+        max_tokens (int): The maximum number of tokens
+    Returns:
+        str: The selected text
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    selected = set()
+    for index, line in enumerate(lines):
+        if PDF_KEYWORDS.search(line):
+            selected.update(range(max(0, index - PDF_WINDOW_LINES), min(len(lines), index + PDF_WINDOW_LINES + 1)))
+
+    if not selected:
+        return truncate_to_tokens("\n".join(lines), max_tokens)
+
+    windows = []
+    previous = None
+    for index in sorted(selected):
+        if previous is not None and index != previous + 1:
+            windows.append("[...]")
+        windows.append(lines[index])
+        previous = index
+    return truncate_to_tokens("\n".join(windows), max_tokens)
+
+
+PROMPT_INTRO = "Você é um assistente especializado em análise de documentos e correspondência contábil.\n\n"
+PROMPT_FOOTER = (
+    "\n📌 IMPORTANTE: Retorne APENAS o número exato da conta (No_) que melhor corresponde. "
+    "A resposta deve ser EXATAMENTE igual a um dos números de conta listados acima, sem texto adicional."
+)
+BATCH_PROMPT_FOOTER = (
+    "\n📌 IMPORTANTE: Retorne APENAS um array JSON com {count} números de conta (No_), "
+    "um por fatura e na mesma ordem, por exemplo [\"62211\", \"62212\"]. "
+    "Cada número deve ser EXATAMENTE igual a um dos números de conta listados para essa fatura, sem texto adicional."
+)
+
+
+def build_invoice_section(email_details, account_vendor, pdf_texts, token_budget):
+    """This function builds the accounts, email and attachments part of a prompt within a token budget
+    Steps:
+        1. List the distinct candidate accounts, most used first
+        2. Add the sender and the subject
+        3. Add the plain text of the body, using at most BODY_BUDGET_SHARE of what is left
+        4. Share the rest of the budget between the PDFs, keeping the lines around items and totals
+    Args:
+        email_details (dict): The details of the email
+        account_vendor (pd.DataFrame): The candidate accounts
+        pdf_texts (list): The text of each PDF
+        token_budget (int): The maximum number of tokens of the section
+    Returns:
+        str: The section
+    """
+    email_details = email_details or {}
+    accounts_str = "\n".join(rank_accounts(account_vendor))
+
+    header = (
+        "### 📊 Contas Disponíveis:\n"
+        f"{accounts_str}\n\n"
+        "### 📧 Email:\n"
+        f"- Remetente: {email_details.get('sender', '')}\n"
+        f"- Assunto: {email_details.get('subject', '')}\n"
+    )
+
+    remaining = token_budget - estimate_tokens(header)
+
+    body = strip_html(email_details.get('body', ''))
+    body = truncate_to_tokens(body, int(max(remaining, 0) * BODY_BUDGET_SHARE))
+    remaining -= estimate_tokens(body)
+
+    pdf_texts = [pdf for pdf in pdf_texts or [] if pdf.get('text')]
+    anexos = []
+    for position, pdf in enumerate(pdf_texts):
+        share = max(remaining, 0) // (len(pdf_texts) - position)
+        text = select_pdf_windows(pdf['text'], share)
+        remaining -= estimate_tokens(text)
+        anexos.append(f"Arquivo: {pdf.get('filename', '')}, Conteúdo: {text}")
+
+    return (
+        f"{header}"
+        f"- Conteúdo: {body}\n"
+        f"- Anexos: {chr(10).join(anexos)}\n"
+    )
+
+
+def build_prompt(email_details, account_vendor, pdf_texts, token_budget):
+    """This function builds the classification prompt of one invoice within a token budget
+    Args:
+        email_details (dict): The details of the email
+        account_vendor (pd.DataFrame): The candidate accounts
+        pdf_texts (list): The text of each PDF
+        token_budget (int): The maximum number of tokens of the prompt
+    Returns:
+        str: The prompt
+    """
+    section_budget = token_budget - estimate_tokens(PROMPT_INTRO) - estimate_tokens(PROMPT_FOOTER)
+    section = build_invoice_section(email_details, account_vendor, pdf_texts, section_budget)
+    return f"{PROMPT_INTRO}{section}{PROMPT_FOOTER}"
+
+
+def build_batch_prompt(invoices, token_budget):
+    """This function builds one prompt that classifies several invoices, sharing the budget between them
+    Args:
+        invoices (list): (email_details, account_vendor, pdf_texts) tuples
+        token_budget (int): The maximum number of tokens of all the invoice sections together
+    Returns:
+        str: The prompt, asking for a JSON array with one account per invoice
+    """
+    footer = BATCH_PROMPT_FOOTER.format(count=len(invoices))
+    share = token_budget // max(len(invoices), 1)
+    sections = []
+    for position, (email_details, account_vendor, pdf_texts) in enumerate(invoices, start=1):
+        title = f"## Fatura {position}\n"
+        # The title and the line break joining the sections come out of the share of each invoice
+        section_budget = share - estimate_tokens(title) - 1
+        sections.append(f"{title}{build_invoice_section(email_details, account_vendor, pdf_texts, section_budget)}")
+    return PROMPT_INTRO + "\n".join(sections) + footer
@@ -0,0 +1,220 @@
+from ProcessingData.deadline import get_deadline, get_timeout
+from info.config import (
+    THROTTLE_INITIAL_CONCURRENCY,
+    THROTTLE_MAX_CONCURRENCY,
+    THROTTLE_MAX_RETRIES,
+    THROTTLE_DEFAULT_DELAY_SECONDS
+)
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import requests
+import logging
+import time
+import re
+
+
+THROTTLED_STATUS_CODES = (429, 503)
+# Longest wait accepted from a Retry-After header
+MAX_RETRY_DELAY_SECONDS = 120
+
+
+class AdaptiveLimiter:
+    """Limits the calls in flight to a backend and adapts the limit to its throttling
+
+    The limit grows by one for every `limit` successful calls (additive increase)
+    and is halved when the backend throttles (multiplicative decrease). A
+    throttled response also pauses every caller until its Retry-After delay has
+    passed, so the backend is not hit again before it asked.
+    """
+
+    def __init__(self, name, initial_limit, max_limit, min_limit=1):
+        """
+        Args:
+            name (str): Name of the backend, used in the logs
+            initial_limit (int): Calls allowed in flight at the start
+            max_limit (int): Highest limit the increases can reach
+            min_limit (int): Lowest limit the decreases can reach
+        """
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """This function waits for a free slot and for any Retry-After pause to pass"""
+        with self._condition:
+            while True:
+                pause = self.blocked_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, throttled=False, retry_after=None, failed=False):
+        """This function frees a slot and adapts the limit to how the call went
+        Args:
+            throttled (bool): True if the backend answered 429 or 503
+            retry_after (float): Seconds the backend asked to wait
+            failed (bool): True if the call raised, which leaves the limit as it is
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(self.min_limit, self.limit / 2)
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                logging.warning(
+                    f"{self.name} throttled the request - limit lowered to {int(self.limit)}, "
+                    f"waiting {retry_after or 0:.1f}s"
+                )
+            elif not failed:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def pause_remaining(self):
+        """This function returns the seconds left of the Retry-After pause, 0 if there is none"""
+        with self._condition:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def stats(self):
+        """This function returns the limit, calls in flight and throttled responses of the backend"""
+        with self._condition:
+            return {"limit": int(self.limit), "in_flight": self.in_flight, "throttled": self.throttled}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(backend):
+    """This function returns the limiter of a backend, creating it on first use
+    Args:
+        backend (str): The name of the backend, e.g. "graph" or "openai"
+    Returns:
+        AdaptiveLimiter: The limiter
+    """
+    with _limiters_lock:
+        if backend not in _limiters:
+            _limiters[backend] = AdaptiveLimiter(backend, THROTTLE_INITIAL_CONCURRENCY, THROTTLE_MAX_CONCURRENCY)
+        return _limiters[backend]
+
+
+def get_throttling_stats():
+    """This function returns the stats of every backend limiter
+    Returns:
+        dict: The stats of each backend
+    """
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {backend: limiter.stats() for backend, limiter in limiters.items()}
+
+
+def _parse_duration(value):
+    # OpenAI sends durations such as "1s", "6m0s" or "20ms"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_retry_after(response):
+    """This function reads how long a throttled response asks to wait
+    Steps:
+        1. Use retry-after-ms or Retry-After, in seconds or as an HTTP date
+        2. Otherwise use the OpenAI rate limit reset headers
+    Args:
+        response (requests.Response): The throttled response
+    Returns:
+        float: The seconds to wait, or None if the response does not say
+    """
+    headers = response.headers or {}
+
+    try:
+        if headers.get("retry-after-ms"):
+            return min(float(headers["retry-after-ms"]) / 1000, MAX_RETRY_DELAY_SECONDS)
+
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            return min(max(delay, 0), MAX_RETRY_DELAY_SECONDS)
+    except (TypeError, ValueError):
+        pass
+
+    resets = [
+        _parse_duration(str(headers.get(header, "")))
+        for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return min(max(resets), MAX_RETRY_DELAY_SECONDS) if resets else None
+
+
+def _attempt_timeout(timeout):
+    """Shortens the caller's timeout to what is left of the deadline after waiting for a slot or a retry"""
+    deadline = get_deadline()
+    # Past the deadline the caller's timeout is kept, so the alerts sent after it still go out
+    if timeout is None or deadline is None or deadline.expired():
+        return timeout
+    return get_timeout(timeout)
+
+
+def send_with_throttling(backend, method, url, **kwargs):
+    """This function sends a request within the concurrency limit of its backend,
+    retrying throttled responses after the delay the backend asked for
+    The timeout is recomputed before every attempt from what is left of the email's
+    deadline, and the retries stop once the deadline is shorter than the wait
+    Args:
+        backend (str): The name of the backend, e.g. "graph" or "openai"
+        method (str): The requests function to call, e.g. "get" or "post"
+        url (str): The URL of the request
+        **kwargs: The arguments of the requests function
+    Returns:
+        requests.Response: The last response
+    """
+    limiter = get_limiter(backend)
+    timeout = kwargs.get("timeout")
+
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        limiter.acquire()
+        deadline = get_deadline()
+        if attempt and deadline is not None and deadline.expired():
+            limiter.release(failed=True)
+            logging.warning(f"Deadline passed while waiting to retry the {backend} request")
+            break
+        try:
+            kwargs["timeout"] = _attempt_timeout(timeout)
+            # Looked up on every call so patched requests functions are used
+            response = getattr(requests, method)(url, **kwargs)
+        except Exception:
+            limiter.release(failed=True)
+            raise
+
+        throttled = response.status_code in THROTTLED_STATUS_CODES
+        if not throttled:
+            limiter.release()
+            return response
+
+        delay = parse_retry_after(response)
+        if delay is None:
+            delay = THROTTLE_DEFAULT_DELAY_SECONDS * 2 ** attempt
+        limiter.release(throttled=True, retry_after=delay)
+
+        # Another caller may have been asked to wait longer than this response says
+        wait = max(delay, limiter.pause_remaining())
+        if attempt == THROTTLE_MAX_RETRIES or (deadline is not None and deadline.remaining() <= wait):
+            break
+        logging.info(f"Retrying {backend} request in {delay:.1f}s (attempt {attempt + 2})")
+
+    return response
@@ -0,0 +1,127 @@
+from ProcessingData.DB.conection import fetch_account_history
+from ProcessingData.transformations.account_history import (
+    HISTORY_COLUMNS,
+    merge_account_history,
+    summarize_account_history
+)
+from ProcessingData.metrics import OPERATION_SECONDS, CACHE_REQUESTS_TOTAL
+from info.config import ACCOUNT_HISTORY_REFRESH_SECONDS
+from datetime import datetime, timedelta
+import pandas as pd
+import threading
+import logging
+
+
+_account_history_cache = {}
+_account_history_lock = threading.Lock()
+
+
+def get_account_history(vendor_id):
+    """This function returns the cached (No_, Description) history of a vendor, refreshing it when stale
+    Steps:
+        1. Return the cached history if it was refreshed recently
+        2. Otherwise fetch, outside the lock, the pairs changed after the cached row version
+        3. Merge them into the cached history, unless another thread stored a newer one meanwhile
+    Args:
+        vendor_id (str): The ID of the vendor
+    Returns:
+        pd.DataFrame: The aggregated history of the vendor
+    """
+    now = datetime.utcnow()
+
+    with _account_history_lock:
+        entry = _account_history_cache.get(vendor_id)
+        if entry and now < entry["refreshed_at"] + timedelta(seconds=ACCOUNT_HISTORY_REFRESH_SECONDS):
+            CACHE_REQUESTS_TOTAL.inc(cache="account_history", result="hit")
+            return entry["history"]
+        CACHE_REQUESTS_TOTAL.inc(cache="account_history", result="miss")
+
+    # Not under the lock, so the other vendors are served while SQL Server answers
+    since_row_version = entry["row_version"] if entry else 0
+    with OPERATION_SECONDS.time(operation="db_lookup"):
+        delta_df, row_version = fetch_account_history(vendor_id, since_row_version)
+
+    if delta_df is None:
+        # Keep serving the cached history while the database is unavailable
+        return entry["history"] if entry else merge_account_history(None, None)
+
+    with _account_history_lock:
+        current = _account_history_cache.get(vendor_id)
+        if current is not entry and current and current["row_version"] >= row_version:
+            # Refreshed by another thread while this one was querying
+            return current["history"]
+
+        history_df = merge_account_history(current["history"] if current else None, delta_df)
+        _account_history_cache[vendor_id] = {
+            "history": history_df,
+            "summary": None,
+            "row_version": row_version,
+            "refreshed_at": now
+        }
+    logging.info(f"Account history of vendor {vendor_id} refreshed: {len(delta_df)} changed pairs")
+    return history_df
+
+
+def get_account_summary(vendor_id):
+    """This function returns the distinct accounts used by a vendor with usage counts
+    Args:
+        vendor_id (str): The ID of the vendor
+    Returns:
+        pd.DataFrame: One row per account (No_, Description, Usage, Share, Last Used)
+    """
+    history_df = get_account_history(vendor_id)
+
+    with _account_history_lock:
+        entry = _account_history_cache.get(vendor_id)
+        if entry and entry["history"] is history_df and entry["summary"] is not None:
+            return entry["summary"]
+
+        summary_df = summarize_account_history(history_df)
+        if entry and entry["history"] is history_df:
+            entry["summary"] = summary_df
+        return summary_df
+
+
+def clear_account_cache(vendor_id=None):
+    """This function clears the cached history of one vendor or of all vendors
+    Args:
+        vendor_id (str): The ID of the vendor, or None to clear everything
+    """
+    with _account_history_lock:
+        if vendor_id is None:
+            _account_history_cache.clear()
+        else:
+            _account_history_cache.pop(vendor_id, None)
+
+
+def export_account_history():
+    """This function returns the cached history of every vendor as a single DataFrame
+    Returns:
+        pd.DataFrame: The HISTORY_COLUMNS plus 'Vendor No_'
+    """
+    with _account_history_lock:
+        frames = [
+            entry["history"].assign(**{'Vendor No_': vendor_id})
+            for vendor_id, entry in _account_history_cache.items()
+            if not entry["history"].empty
+        ]
+
+    if not frames:
+        return pd.DataFrame(columns=HISTORY_COLUMNS + ['Vendor No_'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def import_account_history(history_df):
+    """This function fills the cache from a saved history, marking it stale so the next use syncs the delta
+    Args:
+        history_df (pd.DataFrame): History exported by export_account_history
+    """
+    with _account_history_lock:
+        for vendor_id, vendor_history in history_df.groupby('Vendor No_', sort=False):
+            vendor_history = vendor_history[HISTORY_COLUMNS].reset_index(drop=True)
+            _account_history_cache[vendor_id] = {
+                "history": vendor_history,
+                "summary": None,
+                "row_version": int(vendor_history['Row Version'].max()),
+                "refreshed_at": datetime.min
+            }
@@ -1,14 +1,34 @@
-import pyodbc
+from ProcessingData.metrics import STARTUP_SECONDS
 import pandas as pd
+import threading
+import time
 
 
 SERVER = 'SRV004'
 DATABASE = 'ADC'
 
-connection = pyodbc.connect(
-    f"DRIVER={{SQL Server}}; SERVER={SERVER}; DATABASE={DATABASE}; Trusted_Connection=yes"
-)
-cursor = connection.cursor()
+# pyodbc connections must not be used by two threads at once, so each thread opens its own
+_connection = threading.local()
+
+
+def get_cursor():
+    """This function returns the cursor of the calling thread's SQL Server connection, connecting on first use
+    The connection is not opened at import, so importing the pipeline does not wait for SQL Server
+    Returns:
+        pyodbc.Cursor: The cursor
+    """
+    cursor = getattr(_connection, "cursor", None)
+    if cursor is None:
+        import pyodbc
+
+        started_at = time.perf_counter()
+        connection = pyodbc.connect(
+            f"DRIVER={{SQL Server}}; SERVER={SERVER}; DATABASE={DATABASE}; Trusted_Connection=yes"
+        )
+        _connection.connection = connection
+        _connection.cursor = cursor = connection.cursor()
+        STARTUP_SECONDS.set(time.perf_counter() - started_at, phase="database_connection")
+    return cursor
 
 
 def fetch_from_table(table, schema):
@@ -24,6 +44,7 @@ def fetch_from_table(table, schema):
         pd.DataFrame: The data from the table
     """
     try:
+        cursor = get_cursor()
         query = f"SELECT * FROM {schema}.{table}"
         cursor.execute(query)
         rows = cursor.fetchall()
@@ -46,6 +67,7 @@ def fetch_account_vendor(vendor_id):
         pd.DataFrame: The data from the table
     """
     try:
+        cursor = get_cursor()
         query = "SELECT No_, Description FROM ADC.dbo.[ADC$Purch_ Inv_ Line] WHERE [Buy-From Vendor No_] = ?"
         cursor.execute(query, (vendor_id,))
         rows = cursor.fetchall()
@@ -55,3 +77,95 @@ def fetch_account_vendor(vendor_id):
     except Exception as e:
         print(f"Error fetching account vendor: {e}")
         return pd.DataFrame()
+
+
+def fetch_account_history(vendor_id, since_row_version=0):
+    """This function fetches the aggregated account history of a vendor
+    Steps:
+        1. Read the row version below which every change is committed, the watermark of the next call
+        2. Group the posted invoice lines of the vendor by account and description
+        3. Only include the pairs with a line changed after the given row version, with their full usage
+        4. Convert the data to a DataFrame
+    Args:
+        vendor_id (str): The ID of the vendor
+        since_row_version (int): Only pairs with a line of a higher SQL Server rowversion are returned
+    Returns:
+        tuple: (pd.DataFrame, int) One row per (No_, Description) with Usage, Last Used and Row Version,
+        and the row version to pass next time. (None, since_row_version) if the query failed
+    """
+    try:
+        cursor = get_cursor()
+        # A transaction still open may commit a lower rowversion than one already visible,
+        # so the watermark stops below the oldest active one instead of at the highest read
+        cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) - 1")
+        watermark = int(cursor.fetchone()[0])
+        query = (
+            "SELECT No_, Description, COUNT(*) AS Usage, "
+            "MAX([Posting Date]) AS [Last Used], "
+            "MAX(CAST([timestamp] AS BIGINT)) AS [Row Version] "
+            "FROM ADC.dbo.[ADC$Purch_ Inv_ Line] "
+            "WHERE [Buy-From Vendor No_] = ? AND No_ <> '' "
+            "GROUP BY No_, Description "
+            "HAVING MAX(CAST([timestamp] AS BIGINT)) > ?"
+        )
+        cursor.execute(query, (vendor_id, since_row_version))
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        return df, max(watermark, since_row_version)
+    except Exception as e:
+        print(f"Error fetching account history: {e}")
+        return None, since_row_version
+
+
+def fetch_table_changes(table, schema, since_row_version=0):
+    """This function fetches the rows of a table changed after a row version
+    Steps:
+        1. Read the row version below which every change is committed, the watermark of the next call
+        2. Execute the query filtered by the SQL Server rowversion
+        3. Convert the data to a DataFrame, replacing the binary timestamp by its number
+    Args:
+        table (str): The name of the table
+        schema (str): The schema of the table
+        since_row_version (int): Only rows with a higher rowversion are returned
+    Returns:
+        tuple: (pd.DataFrame, int) The changed rows with a 'Row Version' column and the row version
+        to pass next time. (None, since_row_version) if the query failed
+    """
+    try:
+        cursor = get_cursor()
+        # Same watermark as fetch_account_history: a row committed late with a lower rowversion is read next time
+        cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) - 1")
+        watermark = int(cursor.fetchone()[0])
+        query = (
+            f"SELECT *, CAST([timestamp] AS BIGINT) AS [Row Version] FROM {schema}.{table} "
+            "WHERE CAST([timestamp] AS BIGINT) > ?"
+        )
+        cursor.execute(query, (since_row_version,))
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        return df.drop(columns=['timestamp'], errors='ignore'), max(watermark, since_row_version)
+    except Exception as e:
+        print(f"Error fetching table changes: {e}")
+        return None, since_row_version
+
+
+def fetch_table_keys(table, schema, key_columns):
+    """This function fetches only the key columns of a table, used to detect deleted rows
+    Args:
+        table (str): The name of the table
+        schema (str): The schema of the table
+        key_columns (list): The columns of the primary key
+    Returns:
+        pd.DataFrame: The keys of every row in the table
+    """
+    try:
+        cursor = get_cursor()
+        columns_sql = ", ".join(f"[{column}]" for column in key_columns)
+        cursor.execute(f"SELECT {columns_sql} FROM {schema}.{table}")
+        rows = cursor.fetchall()
+        return pd.DataFrame.from_records(rows, columns=key_columns)
+    except Exception as e:
+        print(f"Error fetching table keys: {e}")
+        return None
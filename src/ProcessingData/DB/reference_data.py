@@ -0,0 +1,198 @@
+from ProcessingData.DB.conection import fetch_table_changes, fetch_table_keys
+from ProcessingData.DB.snapshot import (
+    apply_table_changes,
+    get_row_version,
+    read_snapshot,
+    write_snapshot
+)
+from ProcessingData.DB.account_cache import export_account_history, import_account_history
+from ProcessingData.metrics import OPERATION_SECONDS, CACHE_REQUESTS_TOTAL
+from info.config import (
+    TABLES,
+    REFERENCE_REFRESH_SECONDS,
+    REFERENCE_SNAPSHOT_DIR,
+    REFERENCE_SNAPSHOT_SAVE_SECONDS
+)
+from datetime import datetime, timedelta
+import threading
+import logging
+import atexit
+
+
+# Primary key of each reference table and whether deleted rows must be detected.
+# Purchase headers are deleted by Navision when the invoice is posted.
+REFERENCE_TABLES = {
+    'vendors': {'keys': ['No_'], 'prune': False},
+    'purchase_header': {'keys': ['Document Type', 'No_'], 'prune': True},
+    'purchase_header_reg': {'keys': ['No_'], 'prune': False}
+}
+ACCOUNT_HISTORY_SNAPSHOT = 'account_history'
+
+_reference_cache = {}
+_reference_lock = threading.Lock()
+# One sync at a time per table, run outside _reference_lock so the other tables stay available
+_sync_locks = {name: threading.Lock() for name in REFERENCE_TABLES}
+_last_snapshot_save = {"at": None}
+_snapshot_saver = {"thread": None}
+
+
+def _load_from_snapshot(name):
+    if not REFERENCE_SNAPSHOT_DIR:
+        return None
+    df, watermark = read_snapshot(REFERENCE_SNAPSHOT_DIR, name)
+    if df is None:
+        return None
+    return {"df": df, "row_version": watermark, "refreshed_at": None}
+
+
+def _sync_table(name, entry):
+    """Fetches the rows changed since the entry's watermark and applies them"""
+    table = REFERENCE_TABLES[name]
+    since_row_version = entry["row_version"] if entry else 0
+    # Taken before the query: a change committed while it runs is newer than the synced table
+    started_at = datetime.utcnow()
+
+    changes_df, row_version = fetch_table_changes(TABLES[name], 'dbo', since_row_version)
+    if changes_df is None:
+        if entry:
+            logging.warning(f"Database unavailable - serving cached {name}")
+            return entry
+        return None
+
+    keys_df = None
+    if table['prune'] and entry:
+        keys_df = fetch_table_keys(TABLES[name], 'dbo', table['keys'])
+
+    df = apply_table_changes(entry["df"] if entry else None, changes_df, table['keys'], keys_df)
+    logging.info(f"Reference table {name} synced: {len(changes_df)} changed rows, {len(df)} rows")
+
+    return {
+        "df": df,
+        "row_version": row_version,
+        "refreshed_at": started_at
+    }
+
+
+def _is_fresh(entry, max_age, requested_at):
+    return (
+        entry is not None and entry["refreshed_at"] is not None
+        and entry["refreshed_at"] >= requested_at - timedelta(seconds=max_age)
+    )
+
+
+def get_reference_table(name, max_age=None):
+    """This function returns a reference table, syncing only the rows changed since the last sync
+    Steps:
+        1. Load the table from the local snapshot the first time, if snapshots are enabled
+        2. If the table is older than max_age, fetch the changed rows from the database
+        3. While another thread syncs the table, serve the cached one instead of waiting for it,
+           unless max_age was given: then wait, and use its sync if it started after this call
+    The database is queried outside _reference_lock and the result swapped in under it.
+    Args:
+        name (str): The name of the table in REFERENCE_TABLES
+        max_age (float): Seconds the table may be old, REFERENCE_REFRESH_SECONDS by default.
+            0 syncs the changes committed up to this call
+    Returns:
+        pd.DataFrame: The table, or None if it could not be loaded
+    """
+    requested_at = datetime.utcnow()
+    wait_for_sync = max_age is not None
+    if max_age is None:
+        max_age = REFERENCE_REFRESH_SECONDS
+
+    with _reference_lock:
+        entry = _reference_cache.get(name)
+
+    fresh = _is_fresh(entry, max_age, requested_at)
+    CACHE_REQUESTS_TOTAL.inc(cache="reference_" + name, result="hit" if fresh else "miss")
+    if fresh:
+        return entry["df"]
+
+    sync_lock = _sync_locks[name]
+    if not sync_lock.acquire(blocking=entry is None or wait_for_sync):
+        return entry["df"]
+
+    try:
+        # Another thread may have synced the table while this one waited
+        with _reference_lock:
+            entry = _reference_cache.get(name)
+        if entry is None:
+            entry = _load_from_snapshot(name)
+
+        if not _is_fresh(entry, max_age, requested_at):
+            with OPERATION_SECONDS.time(operation="db_lookup"):
+                entry = _sync_table(name, entry)
+
+        if entry is None:
+            return None
+
+        with _reference_lock:
+            _reference_cache[name] = entry
+        return entry["df"]
+    finally:
+        sync_lock.release()
+
+
+def warm_reference_data():
+    """This function loads every reference table and the account history at startup"""
+    if REFERENCE_SNAPSHOT_DIR:
+        history_df, _ = read_snapshot(REFERENCE_SNAPSHOT_DIR, ACCOUNT_HISTORY_SNAPSHOT)
+        if history_df is not None:
+            import_account_history(history_df)
+
+    for name in REFERENCE_TABLES:
+        get_reference_table(name)
+
+    start_snapshot_saver()
+
+
+def save_reference_snapshot():
+    """This function saves the reference tables and the account history to REFERENCE_SNAPSHOT_DIR
+    Returns:
+        bool: True if every snapshot was saved, False otherwise
+    """
+    if not REFERENCE_SNAPSHOT_DIR:
+        return False
+
+    with _reference_lock:
+        entries = dict(_reference_cache)
+        _last_snapshot_save["at"] = datetime.utcnow()
+
+    saved = True
+    for name, entry in entries.items():
+        saved = write_snapshot(REFERENCE_SNAPSHOT_DIR, name, entry["df"], entry["row_version"]) and saved
+
+    history_df = export_account_history()
+    saved = write_snapshot(
+        REFERENCE_SNAPSHOT_DIR, ACCOUNT_HISTORY_SNAPSHOT, history_df, get_row_version(history_df)
+    ) and saved
+
+    return saved
+
+
+def start_snapshot_saver():
+    """This function saves the snapshots every REFERENCE_SNAPSHOT_SAVE_SECONDS on a background thread, and at exit
+    The snapshots are never written by the threads processing emails
+    """
+    if not REFERENCE_SNAPSHOT_DIR:
+        return
+
+    with _reference_lock:
+        if _snapshot_saver["thread"] is not None:
+            return
+
+        stopped = threading.Event()
+
+        def save_periodically():
+            while not stopped.wait(REFERENCE_SNAPSHOT_SAVE_SECONDS):
+                try:
+                    save_reference_snapshot()
+                except Exception as e:
+                    logging.error(f"Error saving the reference snapshot: {str(e)}")
+
+        thread = threading.Thread(target=save_periodically, name="reference-snapshot", daemon=True)
+        _snapshot_saver["thread"] = thread
+
+    thread.start()
+    atexit.register(stopped.set)
+    atexit.register(save_reference_snapshot)
@@ -0,0 +1,139 @@
+from datetime import datetime
+import pandas as pd
+import logging
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - snapshots are optional
+    pa = None
+    feather = None
+
+
+WATERMARKS_FILE = "watermarks.json"
+
+
+def snapshots_available():
+    """This function checks if pyarrow is installed, which is needed to read and write snapshots"""
+    return pa is not None
+
+
+def apply_table_changes(df, changes_df, key_columns, keys_df=None):
+    """This function applies the rows changed since the last sync to a cached table
+    Steps:
+        1. Append the changed rows, keeping only the newest version of each key
+        2. If the current keys of the table are given, drop the rows that were deleted
+    Args:
+        df (pd.DataFrame): The cached table
+        changes_df (pd.DataFrame): The rows changed since the last sync
+        key_columns (list): The columns of the primary key
+        keys_df (pd.DataFrame): The keys currently in the table, or None to skip deletions
+    Returns:
+        pd.DataFrame: The synced table
+    """
+    if df is None or df.empty:
+        synced = changes_df
+    elif changes_df is None or changes_df.empty:
+        synced = df
+    else:
+        synced = (
+            pd.concat([df, changes_df], ignore_index=True)
+            .drop_duplicates(subset=key_columns, keep='last')
+        )
+
+    if synced is None:
+        return pd.DataFrame()
+
+    if keys_df is not None:
+        synced = synced.merge(keys_df.drop_duplicates(), on=key_columns, how='inner')
+
+    return synced.reset_index(drop=True)
+
+
+def get_row_version(df):
+    """This function returns the highest row version of a table, used as the sync watermark
+    Args:
+        df (pd.DataFrame): A table with a 'Row Version' column
+    Returns:
+        int: The watermark, 0 if the table is empty
+    """
+    if df is None or df.empty or 'Row Version' not in df.columns:
+        return 0
+    return int(df['Row Version'].max())
+
+
+def _read_watermarks(snapshot_dir):
+    path = os.path.join(snapshot_dir, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_snapshot(snapshot_dir, name, df, watermark):
+    """This function saves a table as an uncompressed Arrow file so it can be memory-mapped later
+    Steps:
+        1. Write the table to a temporary file and move it over the old snapshot
+        2. Record the watermark and the sync time of the table
+    Args:
+        snapshot_dir (str): The directory of the snapshots
+        name (str): The name of the table
+        df (pd.DataFrame): The table to save
+        watermark (int): The row version the table is synced up to
+    Returns:
+        bool: True if the snapshot was saved, False otherwise
+    """
+    if not snapshots_available():
+        logging.warning("pyarrow is not installed - reference snapshots are disabled")
+        return False
+
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        path = os.path.join(snapshot_dir, f"{name}.arrow")
+        tmp_path = f"{path}.tmp"
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+
+        watermarks = _read_watermarks(snapshot_dir)
+        watermarks[name] = {
+            "watermark": watermark,
+            "synced_at": datetime.utcnow().isoformat()
+        }
+        tmp_watermarks = os.path.join(snapshot_dir, f"{WATERMARKS_FILE}.tmp")
+        with open(tmp_watermarks, "w", encoding="utf-8") as file:
+            json.dump(watermarks, file, indent=2)
+        os.replace(tmp_watermarks, os.path.join(snapshot_dir, WATERMARKS_FILE))
+
+        logging.info(f"Snapshot of {name} saved: {len(df)} rows, watermark {watermark}")
+        return True
+
+    except Exception as e:
+        logging.error(f"Error saving snapshot of {name}: {str(e)}")
+        return False
+
+
+def read_snapshot(snapshot_dir, name):
+    """This function memory-maps a saved table
+    Args:
+        snapshot_dir (str): The directory of the snapshots
+        name (str): The name of the table
+    Returns:
+        tuple: (pd.DataFrame, int) with the table and its watermark, or (None, 0) if there is no snapshot
+    """
+    path = os.path.join(snapshot_dir, f"{name}.arrow")
+    if not snapshots_available() or not os.path.exists(path):
+        return None, 0
+
+    try:
+        table = feather.read_table(path, memory_map=True)
+        watermark = _read_watermarks(snapshot_dir).get(name, {}).get("watermark", 0)
+        logging.info(f"Snapshot of {name} loaded: {table.num_rows} rows, watermark {watermark}")
+        return table.to_pandas(), watermark
+
+    except Exception as e:
+        logging.error(f"Error reading snapshot of {name}: {str(e)}")
+        return None, 0
@@ -1,8 +1,14 @@
 import pandas as pd
-from ProcessingData.DB.conection import fetch_from_table, fetch_account_vendor
-from ProcessingData.API.chatgpt import send_message
-from info.config import TABLES
+from ProcessingData.DB.reference_data import get_reference_table
+from ProcessingData.DB.account_cache import get_account_summary, get_account_history
+from ProcessingData.transformations.account_history import get_dominant_account
+from ProcessingData.API.chatgpt import classify_account
+from ProcessingData.API.decision_cache import build_invoice_fingerprint, get_cached_decision, store_decision
+from ProcessingData.local_classifier import classify_locally
+from ProcessingData.metrics import ACCOUNT_SOURCE_TOTAL
+from info.config import ACCOUNT_DOMINANCE_SHARE, ACCOUNT_DOMINANCE_MIN_USAGE, LOCAL_CLASSIFIER_THRESHOLD
 from ProcessingData.API.graph_api import send_email
+from ProcessingData.deadline import DeadlineExceeded
 import logging
 
 
@@ -17,7 +23,7 @@ def initial_validation(df, response):
         or 
         bool: False if the invoice is not valid
     """
-    vendors_df = fetch_from_table(TABLES['vendors'], 'dbo')
+    vendors_df = get_reference_table('vendors')
     
     if df.iloc[0]['B'] != '513631984':
         send_email(
@@ -141,17 +147,17 @@ def validate_total_invoice(df, response):
     return result_df
 
 
-def process_df(response):
-    """Processes invoice data from QR code response
-    
+def parse_qr_response(response):
+    """Parses the QR code of the email processing response and validates its vendor
+
     Args:
         response (dict): Email processing response containing:
             - email_details: Email metadata
             - qr_info: QR code content
-            
+
     Returns:
-        pd.DataFrame: Processed invoice data
-        bool: False if processing fails
+        pd.DataFrame: The QR code data with Emitente and Vendor No_
+        bool: False if the response or the vendor is not valid
     """
     if not isinstance(response, dict):
         logging.error("Invalid response format")
@@ -176,42 +182,144 @@ def process_df(response):
     df = initial_validation(df, response)
     if not isinstance(df, pd.DataFrame):
         return False
+    return df
 
-    try:
-        # Usa o Vendor No_ para buscar a conta
-        account_vendor = fetch_account_vendor(df["Vendor No_"].iloc[0])
-        
-        # Processa a conta
-        if len(account_vendor) > 1:
-            account_number = send_message(response.get("email_details"), account_vendor)
-        else:
-            account_number = account_vendor["No_"].iloc[0]
-
-        if not account_number:
-            send_email(
-                "Invalid account number",
-                f"Invoice sent by {response['email_details']['sender']} is not valid - no valid account number found"
-            )
-            return False
 
-        df = df.reset_index(drop=True).copy()
-        account_values = [account_number] * len(df.index)
-        
-        df.loc[:, 'Account'] = account_values
-        df = df.drop('Vendor No_', axis=1)
+def choose_account(df, response):
+    """Chooses the account of an invoice without asking ChatGPT, when possible
 
-        result_df = validate_total_invoice(df, response)
-        if not isinstance(result_df, pd.DataFrame):
-            return False
+    Args:
+        df (pd.DataFrame): The QR code data returned by parse_qr_response
+        response (dict): Email processing response
 
-        logging.info(f"Invoice processed successfully for {response['email_details']['sender']}")
-        return result_df
+    Returns:
+        tuple: (account_number, account_vendor, fingerprint). account_number is None
+        when ChatGPT has to decide between the accounts of account_vendor
+    """
+    # Usa o Vendor No_ para buscar a conta
+    vendor_no = df["Vendor No_"].iloc[0]
+    account_vendor = get_account_summary(vendor_no)
 
-    except Exception as e:
-        error_msg = str(e)
-        logging.error(f"Erro processing invoice: {error_msg}")
+    if len(account_vendor) <= 1:
+        ACCOUNT_SOURCE_TOTAL.inc(source="single_account")
+        return account_vendor["No_"].iloc[0], account_vendor, None
+
+    dominant_account = get_dominant_account(
+        account_vendor, ACCOUNT_DOMINANCE_SHARE, ACCOUNT_DOMINANCE_MIN_USAGE
+    )
+    if dominant_account:
+        logging.info(f"Account {dominant_account} dominates the vendor history - skipping ChatGPT")
+        ACCOUNT_SOURCE_TOTAL.inc(source="dominant_account")
+        return dominant_account, account_vendor, None
+
+    candidate_accounts = account_vendor["No_"].tolist()
+    fingerprint = build_invoice_fingerprint(df, response.get("email_details"), response.get("pdf_texts"))
+
+    account_number = get_cached_decision(vendor_no, fingerprint, candidate_accounts)
+    if account_number:
+        ACCOUNT_SOURCE_TOTAL.inc(source="decision_cache")
+        return account_number, account_vendor, fingerprint
+
+    if LOCAL_CLASSIFIER_THRESHOLD <= 1:
+        predicted_account, confidence = classify_locally(
+            vendor_no, get_account_history(vendor_no),
+            response.get("email_details"), response.get("pdf_texts")
+        )
+        if predicted_account and confidence >= LOCAL_CLASSIFIER_THRESHOLD:
+            logging.info(f"Account {predicted_account} chosen by the local classifier - skipping ChatGPT")
+            ACCOUNT_SOURCE_TOTAL.inc(source="local_classifier")
+            return predicted_account, account_vendor, fingerprint
+
+    ACCOUNT_SOURCE_TOTAL.inc(source="chatgpt")
+    return None, account_vendor, fingerprint
+
+
+def remember_account(df, account_vendor, fingerprint, account_number):
+    """Keeps the account chosen by ChatGPT for the next invoices with the same fingerprint
+
+    Args:
+        df (pd.DataFrame): The QR code data returned by parse_qr_response
+        account_vendor (pd.DataFrame): The candidate accounts
+        fingerprint (str): The fingerprint returned by choose_account
+        account_number (str): The account chosen by ChatGPT
+    """
+    if account_number:
+        store_decision(df["Vendor No_"].iloc[0], fingerprint, account_vendor["No_"].tolist(), account_number)
+
+
+def apply_account(df, response, account_number):
+    """Sets the account of an invoice and splits it by tax rate
+
+    Args:
+        df (pd.DataFrame): The QR code data returned by parse_qr_response
+        response (dict): Email processing response
+        account_number (str): The account of the invoice
+
+    Returns:
+        pd.DataFrame: Processed invoice data
+        bool: False if there is no account or the totals are not valid
+    """
+    if not account_number:
         send_email(
-            "Erro no processamento",
-            f"Ocorreu um erro ao processar a fatura.\nErro: {error_msg}"
+            "Invalid account number",
+            f"Invoice sent by {response['email_details']['sender']} is not valid - no valid account number found"
         )
         return False
+
+    df = df.reset_index(drop=True).copy()
+    account_values = [account_number] * len(df.index)
+    
+    df.loc[:, 'Account'] = account_values
+    df = df.drop('Vendor No_', axis=1)
+
+    result_df = validate_total_invoice(df, response)
+    if not isinstance(result_df, pd.DataFrame):
+        return False
+
+    logging.info(f"Invoice processed successfully for {response['email_details']['sender']}")
+    return result_df
+
+
+def notify_processing_error(error):
+    """Warns that an invoice could not be processed
+
+    Args:
+        error (Exception): The error raised while processing the invoice
+    """
+    error_msg = str(error)
+    logging.error(f"Erro processing invoice: {error_msg}")
+    send_email(
+        "Erro no processamento",
+        f"Ocorreu um erro ao processar a fatura.\nErro: {error_msg}"
+    )
+
+
+def process_df(response):
+    """Processes invoice data from QR code response
+    
+    Args:
+        response (dict): Email processing response containing:
+            - email_details: Email metadata
+            - qr_info: QR code content
+            
+    Returns:
+        pd.DataFrame: Processed invoice data
+        bool: False if processing fails
+    """
+    df = parse_qr_response(response)
+    if not isinstance(df, pd.DataFrame):
+        return False
+
+    try:
+        account_number, account_vendor, fingerprint = choose_account(df, response)
+        if account_number is None:
+            account_number = classify_account(response.get("email_details"), account_vendor, response.get("pdf_texts"))
+            remember_account(df, account_vendor, fingerprint, account_number)
+
+        return apply_account(df, response, account_number)
+
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        notify_processing_error(e)
+        return False
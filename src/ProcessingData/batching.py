@@ -0,0 +1,91 @@
+from ProcessingData.deadline import get_deadline, use_deadline
+from concurrent.futures import Future
+import threading
+import logging
+
+
+class MicroBatcher:
+    """Collects items submitted by many threads and processes them together
+
+    A batch is flushed when it reaches max_size items or when window_seconds
+    have passed since its first item arrived, whichever comes first. Every
+    submitting thread blocks until the batch it joined has been processed and
+    then receives its own result. The batch runs under the latest deadline of
+    its submitters, so one email close to its deadline does not cut the
+    outbound calls of the others short.
+    """
+
+    def __init__(self, process_batch, window_seconds, max_size, name="batch"):
+        """
+        Args:
+            process_batch (callable): Receives a list of items and returns a list of results in the same order
+            window_seconds (float): How long to wait for more items after the first one
+            max_size (int): Maximum number of items in a batch
+            name (str): Name used in the logs
+        """
+        self.process_batch = process_batch
+        self.window_seconds = window_seconds
+        self.max_size = max(1, max_size)
+        self.name = name
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, item):
+        """This function adds an item to the current batch and waits for its result
+        Args:
+            item: The item to process
+        Returns:
+            The result returned by process_batch for this item
+        """
+        future = Future()
+        batch = None
+
+        with self._lock:
+            self._pending.append((item, future, get_deadline()))
+            if len(self._pending) >= self.max_size:
+                batch = self._take_batch()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window_seconds, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if batch:
+            self._run(batch)
+
+        return future.result()
+
+    def _take_batch(self):
+        batch = self._pending
+        self._pending = []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+            batch = self._pending
+            self._pending = []
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        items = [item for item, _, _ in batch]
+        deadlines = [deadline for _, _, deadline in batch if deadline is not None]
+        latest_deadline = max(deadlines, key=lambda deadline: deadline.expires_at) if deadlines else None
+        logging.info(f"Processing {self.name} of {len(items)} items")
+
+        try:
+            with use_deadline(latest_deadline):
+                results = self.process_batch(items)
+            if len(results) != len(items):
+                raise ValueError(f"{self.name} returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,204 @@
+from info.config import CHECKPOINT_DIR, CHECKPOINT_RETENTION_HOURS, CHECKPOINT_SWEEP_SECONDS
+import pandas as pd
+import threading
+import hashlib
+import logging
+import base64
+import shutil
+import json
+import time
+import io
+import os
+
+
+# Stages of the pipeline, in the order they are completed
+STAGES = ["fetched", "decoded", "classified", "payloads", "posted"]
+# Large stages that are no longer needed once the invoice is posted
+DISPOSABLE_STAGES = ["fetched", "decoded", "classified"]
+
+_sweeper = {"thread": None}
+_sweeper_lock = threading.Lock()
+
+
+def _checkpoint_dir(email_id):
+    key = hashlib.sha256(email_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(CHECKPOINT_DIR, key)
+
+
+def _checkpoint_path(email_id, stage):
+    return os.path.join(_checkpoint_dir(email_id), f"{stage}.json")
+
+
+def _encode(value):
+    """Stores the values JSON has no type for: the attachments' bytes and the classified DataFrame"""
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, pd.DataFrame):
+        return {"__dataframe__": value.to_json(orient="table", date_format="iso")}
+    raise TypeError(f"Cannot checkpoint a value of type {type(value).__name__}")
+
+
+def _decode(value):
+    if len(value) == 1 and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    if len(value) == 1 and "__dataframe__" in value:
+        return pd.read_json(io.StringIO(value["__dataframe__"]), orient="table")
+    return value
+
+
+def save_checkpoint(email_id, stage, data):
+    """This function persists the result of a stage of an email
+    Args:
+        email_id (str): The ID of the email
+        stage (str): One of STAGES
+        data: The result of the stage: JSON values, bytes or DataFrames
+    """
+    if not CHECKPOINT_DIR:
+        return
+
+    try:
+        directory = _checkpoint_dir(email_id)
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, "email_id.txt"), "w", encoding="utf-8") as file:
+            file.write(email_id)
+
+        path = _checkpoint_path(email_id, stage)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(data, file, default=_encode, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+        logging.info(f"Checkpoint '{stage}' saved for email {email_id}")
+    except Exception as e:
+        logging.error(f"Error saving checkpoint '{stage}' for email {email_id}: {str(e)}")
+
+
+def load_checkpoint(email_id, stage):
+    """This function loads the persisted result of a stage of an email
+    Args:
+        email_id (str): The ID of the email
+        stage (str): One of STAGES
+    Returns:
+        The result of the stage, or None if the stage was not completed
+    """
+    if not CHECKPOINT_DIR:
+        return None
+
+    path = _checkpoint_path(email_id, stage)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file, object_hook=_decode)
+        logging.info(f"Resuming email {email_id} from checkpoint '{stage}'")
+        return data
+    except Exception as e:
+        logging.error(f"Error loading checkpoint '{stage}' for email {email_id}: {str(e)}")
+        return None
+
+
+def load_stage_checkpoints(stage):
+    """This function loads the persisted result of a stage for every email that has one
+    Args:
+        stage (str): One of STAGES
+    Returns:
+        list: The result of the stage of each email, in no particular order
+    """
+    if not CHECKPOINT_DIR or not os.path.isdir(CHECKPOINT_DIR):
+        return []
+
+    results = []
+    for entry in os.scandir(CHECKPOINT_DIR):
+        path = os.path.join(entry.path, f"{stage}.json")
+        if not entry.is_dir() or not os.path.exists(path):
+            continue
+        try:
+            with open(path, encoding="utf-8") as file:
+                results.append(json.load(file, object_hook=_decode))
+        except Exception as e:
+            logging.error(f"Error loading checkpoint '{stage}' from {entry.path}: {str(e)}")
+    return results
+
+
+def get_last_stage(email_id):
+    """This function returns the last stage completed by an email
+    Args:
+        email_id (str): The ID of the email
+    Returns:
+        str: The last completed stage, or None if there are no checkpoints
+    """
+    if not CHECKPOINT_DIR:
+        return None
+
+    completed = [stage for stage in STAGES if os.path.exists(_checkpoint_path(email_id, stage))]
+    return completed[-1] if completed else None
+
+
+def discard_checkpoints(email_id, stages=None):
+    """This function deletes the checkpoints of an email
+    Args:
+        email_id (str): The ID of the email
+        stages (list): The stages to delete, or None to delete every checkpoint of the email
+    """
+    if not CHECKPOINT_DIR:
+        return
+
+    directory = _checkpoint_dir(email_id)
+    if stages is None:
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+
+    for stage in stages:
+        path = _checkpoint_path(email_id, stage)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def sweep_checkpoints(max_age_hours=CHECKPOINT_RETENTION_HOURS):
+    """This function deletes the checkpoints of the emails not touched for longer than the retention period
+    Args:
+        max_age_hours (float): The retention period, 0 keeps every checkpoint
+    Returns:
+        int: The number of emails whose checkpoints were deleted
+    """
+    if not CHECKPOINT_DIR or max_age_hours <= 0 or not os.path.isdir(CHECKPOINT_DIR):
+        return 0
+
+    oldest = time.time() - max_age_hours * 3600
+    removed = 0
+    for entry in os.scandir(CHECKPOINT_DIR):
+        if not entry.is_dir():
+            continue
+        try:
+            modified = max([item.stat().st_mtime for item in os.scandir(entry.path)] or [entry.stat().st_mtime])
+        except OSError:
+            continue
+        if modified < oldest:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+
+    if removed:
+        logging.info(f"Deleted the checkpoints of {removed} emails older than {max_age_hours} hours")
+    return removed
+
+
+def start_checkpoint_sweeper():
+    """This function runs sweep_checkpoints every CHECKPOINT_SWEEP_SECONDS on a background thread"""
+    if not CHECKPOINT_DIR or CHECKPOINT_RETENTION_HOURS <= 0:
+        return
+
+    with _sweeper_lock:
+        if _sweeper["thread"] is not None:
+            return
+
+        def sweep_periodically():
+            while True:
+                try:
+                    sweep_checkpoints()
+                except Exception as e:
+                    logging.error(f"Error deleting old checkpoints: {str(e)}")
+                time.sleep(CHECKPOINT_SWEEP_SECONDS)
+
+        _sweeper["thread"] = threading.Thread(target=sweep_periodically, name="checkpoint-sweeper", daemon=True)
+        _sweeper["thread"].start()
@@ -0,0 +1,130 @@
+from ProcessingData.metrics import STAGE_SECONDS
+from info.config import REQUEST_TIMEOUT_SECONDS
+from contextlib import contextmanager
+import contextvars
+import logging
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an email runs out of its time budget"""
+
+
+class Deadline:
+    """The time budget of an email, started again by start() when a worker takes it"""
+
+    def __init__(self, seconds, email_id=None):
+        """
+        Args:
+            seconds (float): The time budget
+            email_id (str): The ID of the email, used in the logs
+        """
+        self.email_id = email_id
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.stages = {}
+        self.current_stage = None
+        self.exhausted_by = None
+
+    def start(self):
+        """This function starts the time budget from now, so the time waiting in a queue is not counted"""
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        """This function returns the seconds left, negative once the deadline has passed"""
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_current_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+@contextmanager
+def use_deadline(deadline):
+    """This function makes a deadline the current one while the block runs
+    Args:
+        deadline (Deadline): The deadline of the email being processed
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def get_deadline():
+    """This function returns the deadline of the email being processed, or None"""
+    return _current_deadline.get()
+
+
+def deadline_exceeded():
+    """This function tells whether the email being processed has run out of time
+    Returns:
+        bool: True if there is a deadline and it has passed
+    """
+    deadline = _current_deadline.get()
+    return deadline is not None and deadline.expired()
+
+
+def check_deadline():
+    """This function raises DeadlineExceeded if the email being processed has run out of time"""
+    deadline = _current_deadline.get()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded(
+            f"Deadline of email {deadline.email_id} exceeded during stage '{deadline.exhausted_by or deadline.current_stage}'"
+        )
+
+
+def get_timeout(default=REQUEST_TIMEOUT_SECONDS):
+    """This function returns the timeout of an outbound call, never longer than what is left of the deadline
+    Args:
+        default (float): The timeout used when there is no deadline or more time is left
+    Returns:
+        float: The timeout in seconds
+    """
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return default
+
+    check_deadline()
+    return min(default, deadline.remaining())
+
+
+@contextmanager
+def stage(name):
+    """This function measures a stage of the email being processed
+    and records it as the one that used up the time if the deadline passes during it
+    Args:
+        name (str): The name of the stage
+    """
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.current_stage = name
+
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started_at
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if deadline is not None:
+            deadline.current_stage = None
+            deadline.stages[name] = deadline.stages.get(name, 0) + elapsed
+            if deadline.exhausted_by is None and deadline.expired():
+                deadline.exhausted_by = name
+                logging.warning(
+                    f"Deadline of email {deadline.email_id} exceeded during stage '{name}'. "
+                    f"Stage times: {format_stage_times(deadline)}"
+                )
+
+
+def format_stage_times(deadline):
+    """This function formats the time spent in each stage of a deadline
+    Args:
+        deadline (Deadline): The deadline
+    Returns:
+        str: The stages and their seconds, e.g. "fetched=1.20s, decoded=8.03s"
+    """
+    return ", ".join(f"{name}={seconds:.2f}s" for name, seconds in deadline.stages.items())
@@ -0,0 +1,140 @@
+from collections import defaultdict
+import unicodedata
+import threading
+import logging
+import zlib
+import re
+
+
+N_FEATURES = 2 ** 18
+# Lines spread over the accounts by their prior and added to the evidence of every word,
+# so a word seen on a couple of lines is not trusted as if it were certain
+ALPHA = 0.25
+# Below this many known features the text says too little to decide
+MIN_MATCHED_FEATURES = 2
+MAX_TEXT_CHARS = 20000
+
+_vendor_models = {}
+_models_lock = threading.Lock()
+
+
+def extract_features(text):
+    """This function converts a text into hashed word unigrams and bigrams
+    Args:
+        text (str): The text
+    Returns:
+        set: The hashed features present in the text
+    """
+    text = unicodedata.normalize("NFKD", (text or "")[:MAX_TEXT_CHARS].lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    words = re.findall(r"[a-z]{3,}", text)
+
+    grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    return {zlib.crc32(gram.encode("utf-8")) % N_FEATURES for gram in grams}
+
+
+def _new_model():
+    return {
+        "class_counts": defaultdict(float),
+        "feature_counts": defaultdict(lambda: defaultdict(float)),
+        "vocabulary": set(),
+        "trained_usage": {}
+    }
+
+
+def train_vendor_model(model, history_df):
+    """This function adds the lines not yet seen in a vendor's history to its model
+    Steps:
+        1. For each (account, description) pair, take the usage not trained yet
+        2. Add the features of the description, weighted by that usage, to the account
+    Args:
+        model (dict): The model of the vendor, changed in place
+        history_df (pd.DataFrame): The vendor history with No_, Description and Usage
+    Returns:
+        int: How many new lines were trained
+    """
+    trained = 0
+    for account, description, usage in zip(history_df['No_'], history_df['Description'], history_df['Usage']):
+        pair = (str(account), description or "")
+        new_usage = float(usage) - model["trained_usage"].get(pair, 0)
+        if new_usage <= 0:
+            continue
+
+        model["trained_usage"][pair] = float(usage)
+        model["class_counts"][pair[0]] += new_usage
+        for feature in extract_features(pair[1]):
+            model["feature_counts"][pair[0]][feature] += new_usage
+            model["vocabulary"].add(feature)
+        trained += int(new_usage)
+
+    return trained
+
+
+def predict_with_model(model, text):
+    """This function predicts the account of a text from the accounts its words were posted to
+    Steps:
+        1. Keep only the features of the text the model has seen
+        2. For each feature, share it between the accounts by how often it was posted to each,
+           smoothed towards the prior
+        3. Average those shares over the features, so the confidence is the part of the
+           evidence that agrees on the account and does not grow with the length of the text
+    Args:
+        model (dict): The model of a vendor
+        text (str): The text of the invoice
+    Returns:
+        tuple: (account, confidence between 0 and 1), or (None, 0.0) if the model cannot decide
+    """
+    if not model["class_counts"]:
+        return None, 0.0
+
+    features = extract_features(text) & model["vocabulary"]
+    if len(features) < MIN_MATCHED_FEATURES:
+        return None, 0.0
+
+    total_lines = sum(model["class_counts"].values())
+    priors = {account: class_count / total_lines for account, class_count in model["class_counts"].items()}
+
+    shares = defaultdict(float)
+    for feature in features:
+        counts = {account: model["feature_counts"][account].get(feature, 0) for account in priors}
+        feature_total = sum(counts.values()) + ALPHA
+        for account, prior in priors.items():
+            shares[account] += (counts[account] + ALPHA * prior) / feature_total
+
+    account = max(shares, key=shares.get)
+    return account, shares[account] / len(features)
+
+
+def classify_locally(vendor_no, history_df, email_details, pdf_texts=None):
+    """This function predicts the account of an invoice from the vendor's posted lines
+    Steps:
+        1. Train the vendor's model with the history lines it has not seen yet
+        2. Predict the account from the subject and the text of the PDFs
+    Args:
+        vendor_no (str): The No_ of the vendor
+        history_df (pd.DataFrame): The vendor history with No_, Description and Usage
+        email_details (dict): The details of the email
+        pdf_texts (list): The text of each PDF
+    Returns:
+        tuple: (account, confidence), or (None, 0.0) if the model cannot decide
+    """
+    with _models_lock:
+        model = _vendor_models.setdefault(str(vendor_no), _new_model())
+        trained = train_vendor_model(model, history_df)
+        if trained:
+            logging.info(f"Local classifier of vendor {vendor_no} trained with {trained} new lines")
+
+        text = (email_details or {}).get('subject', '') or ''
+        for pdf in pdf_texts or []:
+            text += "\n" + pdf.get('text', '')
+
+        account, confidence = predict_with_model(model, text)
+
+    logging.info(f"Local classifier for vendor {vendor_no}: account {account}, confidence {confidence:.2f}")
+    return account, confidence
+
+
+def reset_local_models():
+    """This function forgets every trained model"""
+    with _models_lock:
+        _vendor_models.clear()
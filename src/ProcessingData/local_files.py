@@ -0,0 +1,155 @@
+from email.utils import parseaddr, parsedate_to_datetime
+from email.parser import BytesParser
+from email import policy
+import mimetypes
+import logging
+import os
+
+try:
+    import extract_msg
+except ImportError:  # pragma: no cover - extract_msg is only needed for Outlook .msg files
+    extract_msg = None
+
+
+SUPPORTED_EXTENSIONS = (".eml", ".msg", ".pdf")
+
+
+def _attachment(name, content, content_type=None):
+    content_type = content_type or mimetypes.guess_type(name or "")[0] or "application/octet-stream"
+    # Some mailers send PDFs as application/octet-stream
+    if content_type == "application/octet-stream" and (name or "").lower().endswith(".pdf"):
+        content_type = "application/pdf"
+    return {
+        "name": name or "Unknown",
+        "contentType": content_type,
+        "content": content,
+        "size": len(content or b"")
+    }
+
+
+def load_eml(path):
+    """This function reads an .eml file into the same email details as fetch_email_details
+    Args:
+        path (str): The path of the file
+    Returns:
+        dict: The details of the email
+    """
+    with open(path, "rb") as file:
+        message = BytesParser(policy=policy.default).parse(file)
+
+    name, address = parseaddr(message.get("From", ""))
+    body = message.get_body(preferencelist=("html", "plain"))
+
+    try:
+        received = parsedate_to_datetime(message["Date"]).isoformat() if message.get("Date") else ""
+    except (TypeError, ValueError):
+        received = ""
+
+    attachments = [
+        _attachment(part.get_filename(), part.get_payload(decode=True), part.get_content_type())
+        for part in message.iter_attachments()
+    ]
+
+    return {
+        "id": os.path.basename(path),
+        "internetMessageId": message.get("Message-ID", ""),
+        "sender": {"name": name or address, "address": address},
+        "subject": message.get("Subject", ""),
+        "body": body.get_content() if body is not None else "",
+        "attachments": attachments,
+        "receivedDateTime": received,
+        "hasAttachments": bool(attachments)
+    }
+
+
+def load_msg(path):
+    """This function reads an Outlook .msg file into the same email details as fetch_email_details
+    Args:
+        path (str): The path of the file
+    Returns:
+        dict: The details of the email
+    """
+    if extract_msg is None:
+        raise ImportError("extract_msg is required to read .msg files")
+
+    message = extract_msg.Message(path)
+    try:
+        name, address = parseaddr(message.sender or "")
+        attachments = [
+            _attachment(attachment.longFilename or attachment.shortFilename, attachment.data)
+            for attachment in message.attachments
+            if isinstance(attachment.data, bytes)
+        ]
+        return {
+            "id": os.path.basename(path),
+            "internetMessageId": message.messageId or "",
+            "sender": {"name": name or address, "address": address},
+            "subject": message.subject or "",
+            "body": message.htmlBody.decode("utf-8", "ignore") if message.htmlBody else (message.body or ""),
+            "attachments": attachments,
+            "receivedDateTime": message.date.isoformat() if message.date else "",
+            "hasAttachments": bool(attachments)
+        }
+    finally:
+        message.close()
+
+
+def load_pdf(path):
+    """This function wraps a loose PDF in email details, with the file name as subject
+    Args:
+        path (str): The path of the file
+    Returns:
+        dict: The details of the email
+    """
+    name = os.path.basename(path)
+    with open(path, "rb") as file:
+        attachments = [_attachment(name, file.read(), "application/pdf")]
+
+    return {
+        "id": name,
+        "internetMessageId": "",
+        "sender": {"name": name, "address": ""},
+        "subject": os.path.splitext(name)[0],
+        "body": "",
+        "attachments": attachments,
+        "receivedDateTime": "",
+        "hasAttachments": True
+    }
+
+
+LOADERS = {".eml": load_eml, ".msg": load_msg, ".pdf": load_pdf}
+
+
+def find_files(directory):
+    """This function lists the .eml, .msg and .pdf files of a directory and its subdirectories
+    Args:
+        directory (str): The directory
+    Returns:
+        list: The paths, sorted
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(
+            os.path.join(root, name) for name in files
+            if name.lower().endswith(SUPPORTED_EXTENSIONS)
+        )
+    return sorted(paths)
+
+
+def load_email_file(path):
+    """This function reads an .eml, .msg or .pdf file into email details
+    Args:
+        path (str): The path of the file
+    Returns:
+        dict: The details of the email, or None if the file could not be read
+    """
+    loader = LOADERS.get(os.path.splitext(path)[1].lower())
+    if loader is None:
+        logging.warning(f"Unsupported file: {path}")
+        return None
+
+    try:
+        return loader(path)
+    except Exception as e:
+        logging.error(f"Error reading {path}: {str(e)}")
+        return None
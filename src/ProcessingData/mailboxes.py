@@ -0,0 +1,203 @@
+from info.config import MAILBOXES, MAILBOX_USER_ID, MAILBOX_MAX_CONCURRENT
+from contextlib import contextmanager
+import collections
+import contextvars
+import threading
+import logging
+
+
+DEFAULT_MAILBOX_NAME = "default"
+
+
+class Mailbox:
+    """A Graph mailbox whose invoices this process handles"""
+
+    def __init__(self, name, user_id, max_concurrent=MAILBOX_MAX_CONCURRENT):
+        """
+        Args:
+            name (str): The name of the mailbox, used in the webhook URL, the logs and the metrics
+            user_id (str): The Graph user ID or address of the mailbox
+            max_concurrent (int): Emails of the mailbox processed at the same time
+        """
+        self.name = name
+        self.user_id = user_id
+        self.max_concurrent = max(1, max_concurrent)
+
+    def __repr__(self):
+        return f"Mailbox({self.name!r}, {self.user_id!r}, {self.max_concurrent})"
+
+
+def parse_mailboxes(value, default_user_id=None, default_max_concurrent=MAILBOX_MAX_CONCURRENT):
+    """This function reads the mailboxes from the MAILBOXES setting
+    Args:
+        value (str): Comma separated "name=user_id" or "name=user_id:max_concurrent"
+        default_user_id (str): The mailbox used when value is empty
+        default_max_concurrent (int): The quota of the entries that do not set one
+    Returns:
+        list: The Mailbox objects, in the configured order
+    Raises:
+        ValueError: When an entry is malformed or a name is repeated
+    """
+    mailboxes = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, separator, rest = entry.partition("=")
+        user_id, _, max_concurrent = rest.partition(":")
+        if not separator or not name.strip() or not user_id.strip():
+            raise ValueError(f"Invalid mailbox '{entry}', expected name=user_id[:max_concurrent]")
+        mailboxes.append(Mailbox(
+            name.strip(), user_id.strip(), int(max_concurrent) if max_concurrent.strip() else default_max_concurrent
+        ))
+
+    names = [mailbox.name for mailbox in mailboxes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Repeated mailbox names in {names}")
+
+    if not mailboxes:
+        mailboxes.append(Mailbox(DEFAULT_MAILBOX_NAME, default_user_id, default_max_concurrent))
+    return mailboxes
+
+
+_mailboxes = parse_mailboxes(MAILBOXES, MAILBOX_USER_ID)
+# The mailbox of the email being processed by the current thread or task
+_current_mailbox = contextvars.ContextVar("mailbox", default=None)
+
+
+def get_mailboxes():
+    """This function returns the configured mailboxes, the first one being the default"""
+    return list(_mailboxes)
+
+
+def find_mailbox(name):
+    """This function returns the configured mailbox with the given name, or None"""
+    for mailbox in _mailboxes:
+        if mailbox.name == name:
+            return mailbox
+    return None
+
+
+def resolve_mailbox(name=None, resource=None):
+    """This function finds the mailbox a notification belongs to
+    Steps:
+        1. The mailbox named in the notification URL
+        2. The mailbox whose user is in the resource, e.g. Users/<user>/Messages/<id>
+        3. The default mailbox
+    Args:
+        name (str): The mailbox query parameter of the notification URL
+        resource (str): The resource of the notification
+    Returns:
+        Mailbox: The mailbox
+    """
+    if name:
+        mailbox = find_mailbox(name)
+        if mailbox is not None:
+            return mailbox
+        logging.warning(f"Notification for unknown mailbox '{name}'")
+
+    parts = (resource or "").split("/")
+    if len(parts) >= 2 and parts[0].lower() == "users":
+        user_id = parts[1].lower()
+        for mailbox in _mailboxes:
+            if (mailbox.user_id or "").lower() == user_id:
+                return mailbox
+
+    return _mailboxes[0]
+
+
+@contextmanager
+def use_mailbox(mailbox):
+    """This function makes a mailbox the current one while the block runs
+    Args:
+        mailbox (Mailbox): The mailbox of the email being processed, None for the default one
+    """
+    token = _current_mailbox.set(mailbox)
+    try:
+        yield mailbox
+    finally:
+        _current_mailbox.reset(token)
+
+
+def get_mailbox():
+    """This function returns the mailbox of the email being processed, or the default one"""
+    return _current_mailbox.get() or _mailboxes[0]
+
+
+class MailboxQueue:
+    """A queue with a partition per mailbox, served in turn within each mailbox's quota
+
+    get() takes the oldest item of the next mailbox, in round-robin order,
+    that has items waiting and fewer than max_concurrent items taken and not
+    yet released. A busy mailbox therefore waits in its own partition and
+    never holds more than its quota, while the other mailboxes keep their turn.
+    """
+
+    def __init__(self, mailboxes=None):
+        """
+        Args:
+            mailboxes (list): The Mailbox objects, defaults to the configured ones
+        """
+        mailboxes = mailboxes or get_mailboxes()
+        self.maxsize = 0
+        self._order = [mailbox.name for mailbox in mailboxes]
+        self._quotas = {mailbox.name: mailbox.max_concurrent for mailbox in mailboxes}
+        self._queues = {name: collections.deque() for name in self._order}
+        self._active = {name: 0 for name in self._order}
+        self._next = 0
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        """This function adds an item to the partition of its mailbox
+        Args:
+            item: Anything with a mailbox attribute
+        """
+        with self._condition:
+            self._queues[item.mailbox.name].append(item)
+            self._condition.notify()
+
+    def _take(self):
+        for offset in range(len(self._order)):
+            name = self._order[(self._next + offset) % len(self._order)]
+            if self._queues[name] and self._active[name] < self._quotas[name]:
+                self._next = (self._next + offset + 1) % len(self._order)
+                self._active[name] += 1
+                return self._queues[name].popleft()
+        return None
+
+    def get(self):
+        """This function takes the next item, waiting until a mailbox has one within its quota
+        Returns:
+            The item, which holds a slot of its mailbox until release() is called
+        """
+        with self._condition:
+            item = self._take()
+            while item is None:
+                self._condition.wait()
+                item = self._take()
+            return item
+
+    def release(self, item):
+        """This function frees the slot an item took from its mailbox's quota"""
+        with self._condition:
+            self._active[item.mailbox.name] -= 1
+            self._condition.notify()
+
+    def qsize(self):
+        with self._condition:
+            return sum(len(items) for items in self._queues.values())
+
+    def stats(self):
+        """This function returns the waiting and active items of each mailbox
+        Returns:
+            dict: queued, active and max_concurrent, by mailbox name
+        """
+        with self._condition:
+            return {
+                name: {
+                    "queued": len(self._queues[name]),
+                    "active": self._active[name],
+                    "max_concurrent": self._quotas[name]
+                }
+                for name in self._order
+            }
@@ -0,0 +1,215 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import logging
+import time
+
+
+# Seconds, from a cache lookup to a slow ChatGPT or Navision call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_metrics = []
+_collectors = []
+_registry_lock = threading.Lock()
+# The histogram observations made while record_observations() runs, to report them in another process
+_recorded_observations = contextvars.ContextVar("recorded_observations", default=None)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", " ").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. processed emails"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. emails in flight"""
+    type_name = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Counts observations in cumulative buckets, e.g. the latency of a stage"""
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        recorded = _recorded_observations.get()
+        if recorded is not None:
+            recorded.append((self.name, value, labels))
+
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][index] += 1
+                    break
+            counts["sum"] += value
+            counts["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """This function observes how long the block takes"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts["buckets"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {counts['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(counts['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts['count']}")
+        return lines
+
+
+@contextmanager
+def record_observations():
+    """This function collects the histogram observations made while the block runs, e.g. in a worker process
+    Yields:
+        list: (metric name, value, labels) of each observation, for replay_observations
+    """
+    recorded = []
+    token = _recorded_observations.set(recorded)
+    try:
+        yield recorded
+    finally:
+        _recorded_observations.reset(token)
+
+
+def replay_observations(observations):
+    """This function adds observations recorded in another process to the histograms of this one
+    Args:
+        observations (list): The list filled by record_observations
+    """
+    with _registry_lock:
+        histograms = {metric.name: metric for metric in _metrics if isinstance(metric, Histogram)}
+    for name, value, labels in observations:
+        histogram = histograms.get(name)
+        if histogram is not None:
+            histogram.observe(value, **labels)
+
+
+def register_collector(collector):
+    """This function adds a callable that reports values computed at scrape time, e.g. cache stats
+    Args:
+        collector (callable): Returns a list of (name, type, help, [(labels dict, value)])
+    """
+    with _registry_lock:
+        _collectors.append(collector)
+
+
+def render_metrics():
+    """This function renders every metric in the Prometheus text format
+    Returns:
+        str: The metrics
+    """
+    with _registry_lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    for collector in collectors:
+        try:
+            for name, type_name, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {type_name}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}")
+        except Exception as e:
+            logging.error(f"Error collecting metrics: {str(e)}")
+
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "invoice_stage_seconds", "Time spent in each stage of the email pipeline", ["stage"]
+)
+OPERATION_SECONDS = Histogram(
+    "invoice_operation_seconds",
+    "Latency of the operations inside the stages: Graph fetch, PDF open, text extraction, "
+    "DB lookups, ChatGPT and Navision calls",
+    ["operation"]
+)
+QR_DETECTION_SECONDS = Histogram(
+    "invoice_qr_detection_seconds", "Time spent on each QR code detection path", ["path", "found"]
+)
+EMAILS_TOTAL = Counter("invoice_emails_total", "Emails that left the pipeline, by outcome", ["outcome"])
+ALERTS_TOTAL = Counter("invoice_alerts_total", "Alert emails, by reason", ["reason"])
+ACCOUNT_SOURCE_TOTAL = Counter(
+    "invoice_account_source_total", "How the account of each invoice was chosen", ["source"]
+)
+CACHE_REQUESTS_TOTAL = Counter("invoice_cache_requests_total", "Cache lookups, by cache and result", ["cache", "result"])
+EMAILS_IN_FLIGHT = Gauge("invoice_emails_in_flight", "Emails being processed")
+STARTUP_SECONDS = Gauge(
+    "invoice_startup_seconds",
+    "Seconds taken by each startup phase; webhook_ready and subscribed count from the start of the process",
+    ["phase"]
+)
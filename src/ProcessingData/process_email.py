@@ -1,15 +1,81 @@
 from ProcessingData.API.graph_api import get_access_token, send_email
-from info.config import GRAPH_API_BASE_URL, MAILBOX_USER_ID
+from ProcessingData.API.throttling import send_with_throttling
+from ProcessingData.deadline import get_timeout, deadline_exceeded, format_stage_times, DeadlineExceeded
+from ProcessingData.metrics import OPERATION_SECONDS, QR_DETECTION_SECONDS
+from ProcessingData.structured_logging import debug_sampled
+from ProcessingData.traffic_recorder import record_message
+from ProcessingData.mailboxes import get_mailbox
+from info.config import GRAPH_API_BASE_URL
 from qrcode import QRCode
 
 import base64
-import requests
 import logging
+import time
 import fitz
 import cv2
 import numpy as np
 
 
+def build_email_request(email_id, access_token):
+    """This function builds the Graph request that fetches an email with its attachments
+    Args:
+        email_id (str): The unique identifier of the email, or the resource of its notification
+        access_token (str): The Graph access token
+    Returns:
+        tuple: (email_id, url, headers)
+    """
+    if "Messages/" in email_id:
+        email_id = email_id.split("Messages/")[-1]
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+    url = f"{GRAPH_API_BASE_URL}/users/{get_mailbox().user_id}/messages/{email_id}?$expand=attachments&$select=id,subject,sender,body,hasAttachments,receivedDateTime,internetMessageId"
+    return email_id, url, headers
+
+
+def parse_email_data(email_id, email_data):
+    """This function converts the Graph message of an email into its details
+    Args:
+        email_id (str): The unique identifier of the email
+        email_data (dict): The message returned by Graph, with its attachments expanded
+    Returns:
+        dict: A dictionary containing email details
+    """
+    # Process attachments
+    attachments = []
+    for attachment in email_data.get("attachments", []):
+        try:
+            attachment_processed = {
+                "name": attachment.get("name", "Unknown"),
+                "contentType": attachment.get("contentType", "Unknown"),
+                "content": base64.b64decode(attachment.get("contentBytes", "")) if attachment.get("contentBytes") else None,
+                "size": attachment.get("size", 0)
+            }
+            attachments.append(attachment_processed)
+            logging.info(f"Processed attachment: {attachment_processed['name']}, Type: {attachment_processed['contentType']}, Size: {str(attachment_processed['size'])}")
+        except Exception as e:
+            logging.error(f"Error processing attachment {attachment.get('name', 'Unknown')}: {str(e)}")
+            continue
+
+    email_details = {
+        "id": email_id,
+        "internetMessageId": email_data.get("internetMessageId", ""),
+        "sender": email_data["sender"]["emailAddress"],
+        "subject": email_data["subject"],
+        "body": email_data["body"]["content"],
+        "attachments": attachments,
+        "receivedDateTime": email_data.get("receivedDateTime", ""),
+        "hasAttachments": bool(attachments)
+    }
+
+    logging.info(f"Email details: Subject: {email_details['subject']}, MessageID: {email_details['internetMessageId']}")
+    logging.info(f"Number of attachments processed: {str(len(attachments))}")
+    return email_details
+
+
 def fetch_email_details(email_id):
     """This function fetches the details of a specific email
     Args:
@@ -23,18 +89,11 @@ def fetch_email_details(email_id):
         logging.error("Unable to obtain access token")
         return None
 
-    if "Messages/" in email_id:
-        email_id = email_id.split("Messages/")[-1]
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-
-    url = f"{GRAPH_API_BASE_URL}/users/{MAILBOX_USER_ID}/messages/{email_id}?$expand=attachments&$select=id,subject,sender,body,hasAttachments,receivedDateTime,internetMessageId"
+    email_id, url, headers = build_email_request(email_id, access_token)
     
     try:
-        response = requests.get(url, headers=headers)
+        with OPERATION_SECONDS.time(operation="graph_fetch"):
+            response = send_with_throttling("graph", "get", url, headers=headers, timeout=get_timeout())
         logging.info(f"Getting email {email_id}: Status {str(response.status_code)}")
         
         # Check if the email was deleted or does not exist
@@ -46,42 +105,15 @@ def fetch_email_details(email_id):
             
         if response.status_code == 200:
             email_data = response.json()
-            
-            # Process attachments
-            attachments = []
-            for attachment in email_data.get("attachments", []):
-                try:
-                    attachment_processed = {
-                        "name": attachment.get("name", "Unknown"),
-                        "contentType": attachment.get("contentType", "Unknown"),
-                        "content": base64.b64decode(attachment.get("contentBytes", "")) if attachment.get("contentBytes") else None,
-                        "size": attachment.get("size", 0)
-                    }
-                    attachments.append(attachment_processed)
-                    logging.info(f"Processed attachment: {attachment_processed['name']}, Type: {attachment_processed['contentType']}, Size: {str(attachment_processed['size'])}")
-                except Exception as e:
-                    logging.error(f"Error processing attachment {attachment.get('name', 'Unknown')}: {str(e)}")
-                    continue
-            
-            email_details = {
-                "id": email_id,
-                "internetMessageId": email_data.get("internetMessageId", ""),
-                "sender": email_data["sender"]["emailAddress"],
-                "subject": email_data["subject"],
-                "body": email_data["body"]["content"],
-                "attachments": attachments,
-                "receivedDateTime": email_data.get("receivedDateTime", ""),
-                "hasAttachments": bool(attachments)
-            }
-            
-            logging.info(f"Email details: Subject: {email_details['subject']}, MessageID: {email_details['internetMessageId']}")
-            logging.info(f"Number of attachments processed: {str(len(attachments))}")
-            return email_details
+            record_message(email_id, email_data)
+            return parse_email_data(email_id, email_data)
         
         logging.error(f"Error fetching email. Status: {str(response.status_code)}")
         logging.error(f"Response: {response.text}")
         return None
             
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"Error fetching email: {str(e)}")
         return None
@@ -107,8 +139,8 @@ def extract_attachments(email_id, email_data):
         for attachment in email_data["attachments"]:
             if "id" in attachment:
                 attachment_id = attachment["id"]
-                attachment_url = f"{GRAPH_API_BASE_URL}/users/{MAILBOX_USER_ID}/messages/{email_id}/attachments/{attachment_id}"
-                response = requests.get(attachment_url, headers=headers)
+                attachment_url = f"{GRAPH_API_BASE_URL}/users/{get_mailbox().user_id}/messages/{email_id}/attachments/{attachment_id}"
+                response = send_with_throttling("graph", "get", attachment_url, headers=headers, timeout=get_timeout())
                 
                 if response.status_code == 200:
                     attachment_data = response.json()
@@ -137,6 +169,10 @@ def extract_qr_code_from_email(attachments):
     logging.info(f"Searching for QR code in {str(len(attachments))} attachments")
     
     for attachment in attachments:
+        if deadline_exceeded():
+            logging.warning("Deadline exceeded - stopping the QR code search")
+            break
+
         try:
             if not isinstance(attachment, dict):
                 logging.error(f"Invalid attachment format: {str(type(attachment))}")
@@ -154,9 +190,14 @@ def extract_qr_code_from_email(attachments):
                 continue
 
             # Abre o PDF e processa cada página
-            pdf_document = fitz.open(stream=content, filetype="pdf")
+            with OPERATION_SECONDS.time(operation="pdf_open"):
+                pdf_document = fitz.open(stream=content, filetype="pdf")
             
             for page_num in range(len(pdf_document)):
+                if deadline_exceeded():
+                    logging.warning(f"Deadline exceeded - QR code search stopped at page {page_num + 1}")
+                    break
+
                 page = pdf_document[page_num]
                 
                 # Renderiza a página como uma imagem
@@ -181,16 +222,19 @@ def extract_qr_code_from_email(attachments):
                 
                 # Tenta diferentes métodos de detecção
                 methods = [
-                    lambda img: cv2.QRCodeDetector().detectAndDecode(img),
-                    lambda img: cv2.QRCodeDetector().detectAndDecode(cv2.bitwise_not(img)),
-                    lambda img: cv2.QRCodeDetector().detectAndDecode(binary)
+                    ("page", lambda img: cv2.QRCodeDetector().detectAndDecode(img)),
+                    ("page_inverted", lambda img: cv2.QRCodeDetector().detectAndDecode(cv2.bitwise_not(img))),
+                    ("page_binary", lambda img: cv2.QRCodeDetector().detectAndDecode(binary))
                 ]
                 
-                for method in methods:
+                for path, method in methods:
                     try:
+                        started_at = time.perf_counter()
                         decoded_text, points, _ = method(gray)
+                        found = bool(decoded_text and decoded_text.count('*') >= 6)
+                        QR_DETECTION_SECONDS.observe(time.perf_counter() - started_at, path=path, found=found)
                         
-                        if decoded_text and decoded_text.count('*') >= 6:
+                        if found:
                             logging.info(f"QR code found on page {page_num + 1}")
                             pdf_document.close()
                             return decoded_text
@@ -219,11 +263,14 @@ def extract_qr_code_from_email(attachments):
                             gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
                         )
                         
-                        for img_process in [gray, binary, cv2.bitwise_not(gray)]:
+                        for path, img_process in [("image", gray), ("image_binary", binary), ("image_inverted", cv2.bitwise_not(gray))]:
                             try:
+                                started_at = time.perf_counter()
                                 decoded_text, points, _ = cv2.QRCodeDetector().detectAndDecode(img_process)
+                                found = bool(decoded_text and decoded_text.count('*') >= 6)
+                                QR_DETECTION_SECONDS.observe(time.perf_counter() - started_at, path=path, found=found)
                                 
-                                if decoded_text and decoded_text.count('*') >= 6:
+                                if found:
                                     logging.info(f"QR code found in image {img_index} on page {page_num + 1}")
                                     pdf_document.close()
                                     return decoded_text
@@ -239,8 +286,14 @@ def extract_qr_code_from_email(attachments):
             pdf_document.close()
 
         except Exception as e:
-            logging.error(f"Error processing attachment: {str(e)}")
-            logging.error(f"Attachment details: {str(attachment)}")
+            # Only the metadata: the attachment itself holds the raw bytes of the PDF
+            logging.error(
+                "Error processing attachment %s (%s, %s bytes): %s",
+                attachment.get('name', 'Unknown') if isinstance(attachment, dict) else type(attachment).__name__,
+                attachment.get('contentType') if isinstance(attachment, dict) else None,
+                attachment.get('size') if isinstance(attachment, dict) else None,
+                e
+            )
             continue
 
     logging.warning("No QR code found in any attachment")
@@ -298,7 +351,8 @@ def extract_text_from_pdf(attachments):
             logging.info(f"Starting to process PDF: {name}")
             
             try:
-                pdf_document = fitz.open(stream=content, filetype="pdf")
+                with OPERATION_SECONDS.time(operation="pdf_open"):
+                    pdf_document = fitz.open(stream=content, filetype="pdf")
                 
                 if pdf_document.page_count == 0:
                     logging.warning(f"PDF {name} has no pages")
@@ -307,17 +361,22 @@ def extract_text_from_pdf(attachments):
 
                 text = ""
                 processed_pages = 0
+                extraction_started_at = time.perf_counter()
                 
                 for page_num in range(pdf_document.page_count):
+                    if deadline_exceeded():
+                        logging.warning(f"Deadline exceeded - text extraction of {name} stopped at page {page_num + 1}")
+                        break
+
                     try:
                         page = pdf_document[page_num]
                         page_text = page.get_text()
                         text += page_text
                         processed_pages += 1
                         text_length = len(page_text)
-                        logging.info(f"Page {page_num + 1} of {name} processed: {text_length} characters")
+                        logging.debug("Page %d of %s processed: %d characters", page_num + 1, name, text_length)
                         if text_length > 0:
-                            logging.info(f"Sample text from page {page_num + 1}: {page_text[:200]}...")
+                            debug_sampled("Sample text from page %d of %s: %.200s", page_num + 1, name, page_text)
                         else:
                             logging.warning(f"No text found on page {page_num + 1}")
                             
@@ -325,6 +384,8 @@ def extract_text_from_pdf(attachments):
                         logging.warning(f"Error processing page {page_num + 1} of {name}: {str(page_error)}")
                         continue
                 
+                OPERATION_SECONDS.observe(time.perf_counter() - extraction_started_at, operation="text_extraction")
+
                 if processed_pages > 0:
                     total_text_length = len(text)
                     if total_text_length > 0:
@@ -353,23 +414,47 @@ def extract_text_from_pdf(attachments):
     return pdf_texts
 
 
-def orchestrate_email_processing(email_id):
+def notify_deadline_exceeded(email_id, deadline=None):
+    """This function warns that an email ran out of time, the same way a processing error is reported
+    Args:
+        email_id (str): The unique identifier of the email
+        deadline (Deadline): The deadline of the email, whose stage times are included
+    """
+    stage_times = format_stage_times(deadline) if deadline is not None else ""
+    send_email(
+        "Erro no processamento",
+        f"Ocorreu um erro ao processar o email.\nID do Email: {email_id}\n"
+        f"Erro: prazo de processamento excedido ({stage_times}). O email será processado novamente se for reenviado."
+    )
+
+
+def notify_email_not_found(email_id):
+    """This function warns that an email could not be fetched
+    Args:
+        email_id (str): The unique identifier of the email
+    """
+    logging.error(f"Unable to fetch details of email {email_id}")
+    send_email(
+        "Email não encontrado",
+        f"Email não encontrado ou não pode ser processado.\nID do Email: {email_id}"
+    )
+
+
+def orchestrate_email_processing(email_id, email_details=None):
     """This function orchestrates the email processing
     Args:
         email_id (str): The unique identifier of the email to process
+        email_details (dict): The details of the email if they were already fetched, e.g. from a checkpoint
         
     Returns:
         dict: A dictionary containing the email details
     """
     try:
-        email_details = fetch_email_details(email_id)
+        if email_details is None:
+            email_details = fetch_email_details(email_id)
         
         if email_details is None:
-            logging.error(f"Unable to fetch details of email {email_id}")
-            send_email(
-                "Email não encontrado",
-                f"Email não encontrado ou não pode ser processado.\nID do Email: {email_id}"
-            )
+            notify_email_not_found(email_id)
             return None
 
         attachments = email_details.get("attachments", [])
@@ -391,6 +476,9 @@ def orchestrate_email_processing(email_id):
             return None
 
         qr_data = extract_qr_code_from_email(attachments)
+        if not qr_data and deadline_exceeded():
+            logging.warning(f"Deadline exceeded before the QR code of email {email_id} was found")
+            return None
         if not qr_data:
             received_date = email_details['receivedDateTime'].split('T')[0]
             error_message = (
@@ -423,6 +511,8 @@ def orchestrate_email_processing(email_id):
 
         return response
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         error_msg = str(e)
         logging.error(f"Error processing email {email_id}: {error_msg}")
@@ -0,0 +1,188 @@
+from contextlib import contextmanager
+from collections import deque
+from datetime import datetime
+from info.config import (
+    PROFILING_ENABLED,
+    PROFILING_SAMPLE_RATE,
+    PROFILING_EMAIL_IDS,
+    PROFILING_DIR,
+    PROFILING_TOP_ENTRIES,
+    PROFILING_MAX_SUMMARIES
+)
+import tracemalloc
+import threading
+import cProfile
+import logging
+import pstats
+import random
+import time
+import json
+import os
+import re
+
+
+_summaries = deque(maxlen=PROFILING_MAX_SUMMARIES)
+_summaries_lock = threading.Lock()
+# tracemalloc is global: it runs while at least one email is profiled
+_tracing = {"active": 0, "started_here": False}
+_tracing_lock = threading.Lock()
+
+
+def should_profile(email_id):
+    """This function decides whether an email is profiled
+    Args:
+        email_id (str): The ID of the email
+    Returns:
+        bool: True if the email is in the allow-list or was sampled
+    """
+    if not PROFILING_ENABLED:
+        return False
+    return email_id in PROFILING_EMAIL_IDS or random.random() < PROFILING_SAMPLE_RATE
+
+
+def _start_tracing():
+    with _tracing_lock:
+        if _tracing["active"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing["started_here"] = True
+        _tracing["active"] += 1
+
+
+def _stop_tracing():
+    with _tracing_lock:
+        _tracing["active"] -= 1
+        if _tracing["active"] == 0 and _tracing["started_here"]:
+            tracemalloc.stop()
+            _tracing["started_here"] = False
+
+
+def summarize_profile(profiler, top=PROFILING_TOP_ENTRIES):
+    """This function lists the functions with the most cumulative time
+    Args:
+        profiler (cProfile.Profile): The stopped profiler
+        top (int): Number of functions
+    Returns:
+        list: function, calls, total_seconds (own time) and cumulative_seconds of each function
+    """
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return [
+        {
+            "function": f"{os.path.basename(file_name)}:{line}({function})",
+            "calls": calls,
+            "total_seconds": round(total_time, 6),
+            "cumulative_seconds": round(cumulative_time, 6)
+        }
+        for (file_name, line, function), (_, calls, total_time, cumulative_time, _) in rows
+    ]
+
+
+def summarize_allocations(before, after, top=PROFILING_TOP_ENTRIES):
+    """This function lists the lines that allocated the most memory between two snapshots
+    Args:
+        before (tracemalloc.Snapshot): The snapshot taken when the email started
+        after (tracemalloc.Snapshot): The snapshot taken when it finished
+        top (int): Number of lines
+    Returns:
+        list: site, size_kib and count (blocks still allocated) of each line
+    """
+    differences = after.compare_to(before, "lineno")
+    return [
+        {
+            "site": f"{difference.traceback[0].filename}:{difference.traceback[0].lineno}",
+            "size_kib": round(difference.size_diff / 1024, 1),
+            "count": difference.count_diff
+        }
+        for difference in differences[:top]
+        if difference.size_diff > 0
+    ]
+
+
+def _save(email_id, profiler, summary):
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    # Graph IDs contain characters that are not valid in file names
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9_-]', '_', email_id)[-40:]}"
+    if summary.get("step"):
+        name += f"-{summary['step']}"
+    profile_file = os.path.join(PROFILING_DIR, f"{name}.prof")
+    profiler.dump_stats(profile_file)
+    summary["profile_file"] = profile_file
+    with open(os.path.join(PROFILING_DIR, f"{name}.json"), "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=2)
+
+
+@contextmanager
+def profile_email(email_id, step=None, selected=None):
+    """This function profiles the block when the email is selected by should_profile
+    Steps:
+        1. Start a CPU profiler on the current thread and take a tracemalloc snapshot
+        2. Run the block
+        3. Write the .prof file (readable with pstats or snakeviz) and a JSON summary to PROFILING_DIR
+        4. Keep the summary of the top functions and allocation sites for get_profiling_summaries
+    Only the current thread is profiled. The allocations are process wide, so
+    they include other emails processed at the same time. The staged and async
+    pipelines run each step of an email on a different thread, so they profile
+    each step on its own, with one summary per step.
+    Args:
+        email_id (str): The ID of the email
+        step (str): The step profiled, None when the block is the whole processing of the email
+        selected (bool): Whether the email was already selected by should_profile, decided here if None
+    """
+    if selected is None:
+        selected = should_profile(email_id)
+    if not selected:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler is already running on this thread
+        logging.warning(f"Email {email_id} not profiled: {str(e)}")
+        profiler = None
+
+    if profiler is None:
+        yield
+        return
+
+    _start_tracing()
+    before = tracemalloc.take_snapshot()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        seconds = time.perf_counter() - started_at
+        after = tracemalloc.take_snapshot()
+        _stop_tracing()
+
+        try:
+            summary = {
+                "email_id": email_id,
+                "step": step,
+                "finished_at": datetime.now().isoformat(),
+                "seconds": round(seconds, 3),
+                "top_functions": summarize_profile(profiler),
+                "top_allocations": summarize_allocations(before, after)
+            }
+            _save(email_id, profiler, summary)
+            with _summaries_lock:
+                _summaries.append(summary)
+            logging.info(
+                f"Email {email_id}{f' step {step}' if step else ''} profiled in {seconds:.2f}s: {summary['profile_file']}"
+            )
+        except Exception as e:
+            logging.error(f"Error saving the profile of email {email_id}: {str(e)}")
+
+
+def get_profiling_summaries(email_id=None):
+    """This function returns the summaries of the last profiled emails, newest first
+    Args:
+        email_id (str): Only the summaries of this email, all if None
+    Returns:
+        list: The summaries
+    """
+    with _summaries_lock:
+        summaries = list(_summaries)
+    return [summary for summary in reversed(summaries) if email_id is None or summary["email_id"] == email_id]
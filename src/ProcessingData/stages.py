@@ -0,0 +1,200 @@
+from ProcessingData.deadline import Deadline, DeadlineExceeded, use_deadline, format_stage_times
+from ProcessingData.structured_logging import use_correlation_id
+from ProcessingData.metrics import EMAILS_TOTAL, EMAILS_IN_FLIGHT
+from ProcessingData.mailboxes import get_mailbox, use_mailbox
+from ProcessingData.profiling import profile_email, should_profile
+from info.config import EMAIL_DEADLINE_SECONDS
+import threading
+import logging
+import queue
+
+
+class EmailJob:
+    """The state of an email as it moves through the stages of the pipeline"""
+
+    def __init__(self, email_id, deadline=None, on_done=None, mailbox=None):
+        """
+        Args:
+            email_id (str): The ID of the email
+            deadline (Deadline): The time budget, started again when the first stage takes the job
+            on_done (callable): Called with the email ID, the result and the outcome when the email leaves the pipeline
+            mailbox (Mailbox): The mailbox of the email, defaults to the current one
+        """
+        self.email_id = email_id
+        self.deadline = deadline or Deadline(EMAIL_DEADLINE_SECONDS, email_id)
+        self.mailbox = mailbox or get_mailbox()
+        self.email_details = None
+        self.response = None
+        self.df = None
+        self.invoices = None
+        self.result = False
+        self.outcome = None
+        self.on_done = on_done
+        self.release = None
+        # Decided once, so either every step of the email is profiled or none
+        self.profiled = should_profile(email_id)
+        self.done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        EMAILS_IN_FLIGHT.dec()
+        EMAILS_TOTAL.inc(outcome=self.outcome or ("processed" if result else "failed"))
+        if self.on_done is not None:
+            self.on_done(self.email_id, result, self.outcome)
+        if self.release is not None:
+            self.release(self)
+        self.done.set()
+
+
+def run_step(step, job, name):
+    """This function runs a step of a job, profiled when the job's email was selected for profiling
+    Args:
+        step (callable): Receives the EmailJob and returns True to continue with the next step
+        job (EmailJob): The job
+        name (str): The name of the step, used in the profile
+    Returns:
+        The result of the step
+    """
+    with profile_email(job.email_id, step=name, selected=job.profiled):
+        return step(job)
+
+
+class Stage:
+    """A step of the pipeline with its own bounded queue and worker threads
+
+    Each worker takes a job from the queue, runs the step under the job's
+    deadline and hands the job to the next stage if the step returns True.
+    Putting a job into a full queue blocks, so a slow stage holds back the
+    stages before it instead of piling up emails in memory.
+    """
+
+    def __init__(self, name, step, workers, queue_size=0, job_queue=None, starts_deadline=False):
+        """
+        Args:
+            name (str): The name of the stage
+            step (callable): Receives an EmailJob and returns True to continue with the next stage
+            workers (int): Number of worker threads
+            queue_size (int): Maximum number of jobs waiting, 0 for no limit
+            job_queue: The queue of the stage, e.g. a MailboxQueue, instead of a queue.Queue of queue_size
+            starts_deadline (bool): Start the job's deadline when a worker takes it, set on the first stage
+        """
+        self.name = name
+        self.step = step
+        self.starts_deadline = starts_deadline
+        self.workers = max(1, workers)
+        self.queue = job_queue if job_queue is not None else queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self._busy = 0
+        self._processed = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """This function starts the worker threads of the stage"""
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.name}-{index}", daemon=True).start()
+
+    def put(self, job):
+        """This function queues a job, waiting while the queue is full
+        Args:
+            job (EmailJob): The job
+        """
+        self.queue.put(job)
+
+    def stats(self):
+        """This function returns the queued and busy jobs of the stage
+        Returns:
+            dict: queued, busy, workers, capacity and processed
+        """
+        with self._lock:
+            return {
+                "queued": self.queue.qsize(),
+                "busy": self._busy,
+                "workers": self.workers,
+                "capacity": self.queue.maxsize,
+                "processed": self._processed
+            }
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if self.starts_deadline:
+                job.deadline.start()
+            with self._lock:
+                self._busy += 1
+
+            proceed = False
+            try:
+                with use_deadline(job.deadline), use_correlation_id(job.email_id), use_mailbox(job.mailbox):
+                    proceed = run_step(self.step, job, self.name)
+            except DeadlineExceeded as e:
+                logging.error(f"{str(e)} - stage times: {format_stage_times(job.deadline)}")
+                job.outcome = "deadline_exceeded"
+            except Exception as e:
+                logging.error(f"Error in stage {self.name} for email {job.email_id}: {str(e)}")
+                job.outcome = "error"
+
+            # The worker stays busy while the next stage's queue is full
+            if proceed and self.next_stage is not None:
+                self.next_stage.put(job)
+            elif not job.done.is_set():
+                job.finish(job.result)
+
+            with self._lock:
+                self._busy -= 1
+                self._processed += 1
+
+
+class StagedPipeline:
+    """Stages connected in order, each handing its jobs to the next one"""
+
+    def __init__(self, stages, admission=None):
+        """
+        Args:
+            stages (list): The Stage objects, in the order the jobs go through them
+            admission (MailboxQueue): The queue of the first stage, partitioned by mailbox. Each job
+                holds a slot of its mailbox's quota until it leaves the pipeline, so a busy mailbox
+                cannot fill the queues of the later stages
+        """
+        if admission is not None:
+            stages[0].queue = admission
+        # The time waiting for a mailbox's slot is not part of the email's deadline
+        stages[0].starts_deadline = True
+        self.admission = admission
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """This function starts the workers of every stage, once"""
+        with self._lock:
+            if not self._started:
+                for stage in self.stages:
+                    stage.start()
+                self._started = True
+
+    def submit(self, email_id, deadline=None, on_done=None, mailbox=None):
+        """This function adds an email to the first stage
+        Args:
+            email_id (str): The ID of the email
+            deadline (Deadline): The time budget, started when the first stage takes the email
+            on_done (callable): Called with the email ID, the result and the outcome when the email leaves the pipeline
+            mailbox (Mailbox): The mailbox of the email, defaults to the current one
+        Returns:
+            EmailJob: The job, whose done event is set when the email leaves the pipeline
+        """
+        self.start()
+        job = EmailJob(email_id, deadline, on_done, mailbox)
+        if self.admission is not None:
+            job.release = self.admission.release
+        EMAILS_IN_FLIGHT.inc()
+        self.stages[0].put(job)
+        return job
+
+    def stats(self):
+        """This function returns the queue depth and busy workers of each stage
+        Returns:
+            dict: The stats of each stage, by name
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -0,0 +1,177 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from contextlib import contextmanager
+from info.config import LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE
+import contextvars
+import atexit
+import logging
+import random
+import queue
+import json
+import os
+
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - [%(email_id)s] %(message)s'
+
+# The email being processed by the current thread or task, added to every record
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)
+_listener = {"listener": None}
+# Listeners draining the records of worker processes into this process's handlers
+_process_listeners = []
+
+
+@contextmanager
+def use_correlation_id(email_id):
+    """This function tags the records logged inside the block with the ID of an email
+    Args:
+        email_id (str): The ID of the email
+    """
+    token = _correlation_id.set(email_id)
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def get_correlation_id():
+    """This function returns the ID of the email being processed, or None"""
+    return _correlation_id.get()
+
+
+def debug_sampled(message, *args):
+    """This function logs a debug payload for a sample of the calls
+    The message is formatted by the listener thread, and only when debug is enabled
+    Args:
+        message (str): The message, with %-style placeholders
+        args: The values of the placeholders
+    """
+    logger = logging.getLogger()
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_DEBUG_SAMPLE_RATE:
+        logger.debug(message, *args)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "email_id": getattr(record, "email_id", None),
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _ContextQueueHandler(QueueHandler):
+    """Puts records on the queue without formatting them on the calling thread"""
+
+    def prepare(self, record):
+        # The queue stays in this process, so the listener can format the message and the
+        # exception later; only the correlation ID must be read now, from the caller's context.
+        # Records forwarded from a worker process already carry theirs
+        if getattr(record, "email_id", None) is None:
+            record.email_id = _correlation_id.get()
+        return record
+
+
+class _ProcessQueueHandler(QueueHandler):
+    """Puts the records of a worker process on a queue read by the parent process"""
+
+    def prepare(self, record):
+        # The record is pickled to the parent, so the message and the exception are formatted here
+        record.email_id = _correlation_id.get()
+        return super().prepare(record)
+
+
+class _ForwardHandler(logging.Handler):
+    """Hands the records of a worker process to the loggers of this process"""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def setup_logging(log_file=LOG_FILE, level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """This function sends the logs through a queue to a listener thread that writes them
+    Steps:
+        1. Create the rotating file and console handlers, in JSON or text format
+        2. Start a listener thread that takes the records from the queue and writes them
+        3. Replace the root handlers with one that only puts the records on the queue
+    Args:
+        log_file (str): The rotating log file
+        level (str): The minimum level, e.g. "INFO"
+        log_format (str): "json" or "text"
+    """
+    _stop_listener()
+
+    log_dir = os.path.dirname(log_file)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    formatter = JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5, encoding="utf-8")
+    file_handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    # Unbounded, so a slow disk never blocks the thread that logs
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    _listener["listener"] = listener
+    atexit.register(stop_logging)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(level)
+    root_logger.addHandler(_ContextQueueHandler(log_queue))
+
+
+def start_process_log_listener(context):
+    """This function creates the queue the worker processes log to, drained into this process's handlers
+    Args:
+        context: The multiprocessing context the worker processes are started with
+    Returns:
+        The queue, to pass to forward_process_logs in the initializer of the worker processes
+    """
+    log_queue = context.Queue()
+    listener = QueueListener(log_queue, _ForwardHandler())
+    listener.start()
+    _process_listeners.append(listener)
+    atexit.register(stop_logging)
+    return log_queue
+
+
+def forward_process_logs(log_queue, level=LOG_LEVEL):
+    """This function sends the logs of a worker process to its parent, as the initializer of the process
+    Args:
+        log_queue: The queue returned by start_process_log_listener in the parent
+        level (str): The minimum level, e.g. "INFO"
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(level)
+    root_logger.addHandler(_ProcessQueueHandler(log_queue))
+
+
+def stop_logging():
+    """This function writes the records left in the queues and stops the listener threads"""
+    while _process_listeners:
+        _process_listeners.pop().stop()
+    _stop_listener()
+
+
+def _stop_listener():
+    listener = _listener["listener"]
+    _listener["listener"] = None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,110 @@
+from info.config import TRAFFIC_RECORD_DIR
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+import re
+
+
+NOTIFICATIONS_FILE = "notifications.jsonl"
+MESSAGES_DIR = "messages"
+REDACTED = "REDACTED"
+# Keys whose values are secrets: the subscription's clientState, tokens, keys and credentials
+SECRET_KEYS = re.compile(r"clientstate|token|secret|password|authorization|datakey|signature", re.IGNORECASE)
+
+_record_lock = threading.Lock()
+
+
+def scrub(data):
+    """This function replaces the values of secret keys, at any depth
+    Args:
+        data: A JSON value
+    Returns:
+        A copy of the value with the secrets replaced by REDACTED
+    """
+    if isinstance(data, dict):
+        return {
+            key: REDACTED if SECRET_KEYS.search(key) and data[key] is not None else scrub(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, list):
+        return [scrub(value) for value in data]
+    return data
+
+
+def message_file(record_dir, email_id):
+    """This function returns the file of a recorded message
+    Graph IDs contain characters that are not valid in file names, so the file is named after their hash
+    """
+    name = hashlib.sha256(email_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(record_dir, MESSAGES_DIR, f"{name}.json")
+
+
+def record_notification(body, record_dir=None, mailbox=None):
+    """This function appends a webhook notification to the recording, when recording is enabled
+    Args:
+        body (dict): The body of the notification sent by Graph
+        record_dir (str): The recording, defaults to TRAFFIC_RECORD_DIR
+        mailbox (str): The mailbox named in the notification URL
+    """
+    record_dir = record_dir if record_dir is not None else TRAFFIC_RECORD_DIR
+    if not record_dir:
+        return
+
+    try:
+        entry = json.dumps({"received_at": time.time(), "mailbox": mailbox, "body": scrub(body)}, ensure_ascii=False)
+        with _record_lock:
+            os.makedirs(record_dir, exist_ok=True)
+            with open(os.path.join(record_dir, NOTIFICATIONS_FILE), "a", encoding="utf-8") as file:
+                file.write(entry + "\n")
+    except Exception as e:
+        logging.error(f"Error recording notification: {str(e)}")
+
+
+def record_message(email_id, message, record_dir=None):
+    """This function saves the Graph message of an email, with its attachments, when recording is enabled
+    Args:
+        email_id (str): The ID of the email
+        message (dict): The message returned by Graph
+        record_dir (str): The recording, defaults to TRAFFIC_RECORD_DIR
+    """
+    record_dir = record_dir if record_dir is not None else TRAFFIC_RECORD_DIR
+    if not record_dir:
+        return
+
+    try:
+        path = message_file(record_dir, email_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(dict(scrub(message), id=email_id), file, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+    except Exception as e:
+        logging.error(f"Error recording message {email_id}: {str(e)}")
+
+
+def load_recording(record_dir):
+    """This function reads a recording
+    Args:
+        record_dir (str): The recording
+    Returns:
+        tuple: (notifications, messages) where notifications is the list of
+        {received_at, mailbox, body} in arrival order and messages the Graph messages by email ID
+    """
+    notifications = []
+    path = os.path.join(record_dir, NOTIFICATIONS_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            notifications = [json.loads(line) for line in file if line.strip()]
+    notifications.sort(key=lambda entry: entry["received_at"])
+
+    messages = {}
+    messages_dir = os.path.join(record_dir, MESSAGES_DIR)
+    if os.path.isdir(messages_dir):
+        for name in os.listdir(messages_dir):
+            if name.endswith(".json"):
+                with open(os.path.join(messages_dir, name), "r", encoding="utf-8") as file:
+                    message = json.load(file)
+                messages[message["id"]] = message
+    return notifications, messages
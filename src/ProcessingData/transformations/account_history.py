@@ -0,0 +1,84 @@
+import pandas as pd
+
+
+HISTORY_COLUMNS = ['No_', 'Description', 'Usage', 'Last Used', 'Row Version']
+SUMMARY_COLUMNS = ['No_', 'Description', 'Usage', 'Share', 'Last Used']
+
+
+def merge_account_history(history_df, delta_df):
+    """This function merges newly fetched account history into the cached one
+    Steps:
+        1. Concatenate the cached and the new (No_, Description) rows
+        2. Keep the new row of each pair fetched again, since it holds the full usage of the pair
+    Args:
+        history_df (pd.DataFrame): Cached history with the HISTORY_COLUMNS
+        delta_df (pd.DataFrame): History of the pairs changed since the cached row version
+    Returns:
+        pd.DataFrame: The merged history
+    """
+    frames = [df for df in (history_df, delta_df) if df is not None and not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+
+    combined = pd.concat([df[HISTORY_COLUMNS] for df in frames], ignore_index=True)
+    combined['Description'] = combined['Description'].fillna('')
+
+    # Replaced rather than summed: a line edited after it was counted is fetched again with its pair
+    return (
+        combined
+        .drop_duplicates(['No_', 'Description'], keep='last')
+        .reset_index(drop=True)
+    )
+
+
+def summarize_account_history(history_df, max_descriptions=3):
+    """This function builds the per-account view of a vendor's history
+    Steps:
+        1. Sum the usage of each account and keep the last date it was used
+        2. Keep the most used descriptions of each account as representatives
+        3. Sort the accounts by usage and recency
+    Args:
+        history_df (pd.DataFrame): History with the HISTORY_COLUMNS
+        max_descriptions (int): Number of representative descriptions per account
+    Returns:
+        pd.DataFrame: One row per account with the SUMMARY_COLUMNS
+    """
+    if history_df is None or history_df.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+
+    ranked = history_df.sort_values(['No_', 'Usage', 'Last Used'], ascending=[True, False, False])
+    descriptions = (
+        ranked[ranked['Description'] != '']
+        .groupby('No_', sort=False)['Description']
+        .agg(lambda values: ' | '.join(values.head(max_descriptions)))
+    )
+
+    summary = (
+        history_df
+        .groupby('No_', as_index=False, sort=False)
+        .agg({'Usage': 'sum', 'Last Used': 'max'})
+    )
+    summary['Description'] = summary['No_'].map(descriptions).fillna('')
+    summary['Share'] = (summary['Usage'] / summary['Usage'].sum()).round(3)
+
+    summary = summary.sort_values(['Usage', 'Last Used'], ascending=[False, False])
+    return summary[SUMMARY_COLUMNS].reset_index(drop=True)
+
+
+def get_dominant_account(summary_df, min_share, min_usage):
+    """This function returns the account that clearly dominates a vendor's history
+    Args:
+        summary_df (pd.DataFrame): Summary built by summarize_account_history
+        min_share (float): Minimum share of the usage the top account must have
+        min_usage (int): Minimum number of lines the top account must have
+    Returns:
+        str: The dominant account number, or None if no account dominates
+    """
+    if summary_df is None or summary_df.empty:
+        return None
+
+    top = summary_df.iloc[0]
+    if top['Share'] >= min_share and top['Usage'] >= min_usage:
+        return str(top['No_'])
+
+    return None
@@ -0,0 +1,140 @@
+from datetime import datetime
+import threading
+import logging
+import re
+
+
+INVOICE_PREFIX = "FCA"
+INVOICE_DIGITS = 6
+
+_number_series = {}
+# Lowest next number of each series, set by numbers handed out before a restart and not in the database yet
+_number_floors = {}
+_number_series_lock = threading.Lock()
+
+
+def get_invoice_prefix(date=None):
+    """This function returns the number series prefix of a year, e.g. 'FCA25' for 2025
+    Args:
+        date (datetime): The date to get the prefix for, defaults to today
+    Returns:
+        str: The prefix of the number series
+    """
+    date = date or datetime.now()
+    return f"{INVOICE_PREFIX}{date:%y}"
+
+
+def get_highest_invoice_number(purchase_header_df, prefix="FCA25"):
+    """This function gets the highest invoice number and generates the next one
+    Steps:
+        1. Check if the purchase_header_df is empty or if the column 'No_' is not in the DataFrame
+        2. Extract the number part of every 'No_' that has the given prefix
+        3. Return the highest number plus 1, or 1 if no number has the prefix
+    Args:
+        purchase_header_df (pd.DataFrame): DataFrame with the purchase header data
+        prefix (str): The prefix of the number series
+    Returns:
+        int: The next invoice number
+    """
+    try:
+        if purchase_header_df is None or purchase_header_df.empty or 'No_' not in purchase_header_df.columns:
+            return 1
+
+        numbers = (
+            purchase_header_df['No_']
+            .astype(str)
+            .str.extract(rf'^{prefix}(\d+)$', expand=False)
+            .dropna()
+        )
+        if numbers.empty:
+            return 1
+
+        return int(numbers.astype(int).max()) + 1
+
+    except Exception as e:
+        print(f"Error generating invoice number: {str(e)}")
+        return 1
+
+
+def seed_number_series(purchase_header_df, prefix=None):
+    """This function seeds the number series of a prefix from the purchase headers in the database
+    Steps:
+        1. Scan the purchase headers for the highest number with the prefix
+        2. Move the series forward if the database is ahead of it, never backwards
+    Args:
+        purchase_header_df (pd.DataFrame): DataFrame with the purchase header data
+        prefix (str): The prefix of the number series, defaults to the current year's
+    Returns:
+        int: The next number of the series
+    """
+    prefix = prefix or get_invoice_prefix()
+    next_number = get_highest_invoice_number(purchase_header_df, prefix)
+
+    with _number_series_lock:
+        _number_series[prefix] = max(_number_series.get(prefix, 1), next_number, _number_floors.get(prefix, 1))
+        logging.info(f"Number series {prefix} seeded at {_number_series[prefix]}")
+        return _number_series[prefix]
+
+
+def allocate_invoice_numbers(count=1, purchase_header_df=None, date=None):
+    """This function reserves a contiguous block of invoice numbers
+    Steps:
+        1. Get the prefix of the year, so the series rolls over on the 1st of January
+        2. Seed the series from the purchase headers the first time the prefix is used
+        3. Reserve the numbers under the lock so concurrent threads never get the same number
+    Args:
+        count (int): How many numbers to reserve
+        purchase_header_df (pd.DataFrame): DataFrame used to seed the series the first time
+        date (datetime): The date used to pick the prefix, defaults to today
+    Returns:
+        list: The reserved invoice numbers, e.g. ['FCA25000123', 'FCA25000124']
+    """
+    prefix = get_invoice_prefix(date)
+
+    with _number_series_lock:
+        if prefix not in _number_series:
+            _number_series[prefix] = max(
+                get_highest_invoice_number(purchase_header_df, prefix), _number_floors.get(prefix, 1)
+            )
+            logging.info(f"Number series {prefix} seeded at {_number_series[prefix]}")
+
+        first_number = _number_series[prefix]
+        _number_series[prefix] = first_number + count
+
+    return [f"{prefix}{str(number).zfill(INVOICE_DIGITS)}" for number in range(first_number, first_number + count)]
+
+
+def allocate_invoice_number(purchase_header_df=None, date=None):
+    """This function reserves the next invoice number
+    Args:
+        purchase_header_df (pd.DataFrame): DataFrame used to seed the series the first time
+        date (datetime): The date used to pick the prefix, defaults to today
+    Returns:
+        str: The reserved invoice number
+    """
+    return allocate_invoice_numbers(1, purchase_header_df, date)[0]
+
+
+def reserve_invoice_numbers(numbers):
+    """This function moves the number series past numbers handed out before a restart
+    The series is seeded from the purchase headers, which do not have the numbers
+    of the invoices checkpointed before they were posted
+    Args:
+        numbers (list): The invoice numbers, e.g. ['FCA25000123']
+    """
+    with _number_series_lock:
+        for number in numbers:
+            match = re.match(rf'^({INVOICE_PREFIX}\d{{2}})(\d+)$', str(number))
+            if not match:
+                continue
+            prefix, next_number = match.group(1), int(match.group(2)) + 1
+            _number_floors[prefix] = max(_number_floors.get(prefix, 1), next_number)
+            if prefix in _number_series:
+                _number_series[prefix] = max(_number_series[prefix], next_number)
+
+
+def reset_number_series():
+    """This function forgets every seeded series, so the next allocation seeds it again"""
+    with _number_series_lock:
+        _number_series.clear()
+        _number_floors.clear()
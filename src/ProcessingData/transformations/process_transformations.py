@@ -1,6 +1,13 @@
 import pandas as pd
-from ProcessingData.API.navision_post_data import send_header_to_navision, send_line_to_navision
-from ProcessingData.transformations.transformations import transform_data
+from ProcessingData.API.navision_post_data import (
+    send_header_to_navision,
+    send_line_to_navision,
+    send_invoices_batch
+)
+from ProcessingData.API.navision_payloads import build_header_payloads, build_line_payloads
+from ProcessingData.transformations.transformations import transform_data, transform_batch
+from ProcessingData.deadline import DeadlineExceeded
+from info.config import NAVISION_USE_BATCH, NAVISION_BATCH_SIZE
 import logging
 
 
@@ -23,96 +30,61 @@ def process_invoice(invoice_df, vendors_df, purchase_header_df, purchase_header_
         header_df, line_df = transform_data(invoice_df, vendors_df, purchase_header_df, purchase_header_reg_df)
         if header_df is False:
             return False
-            
-        line_df['Type'] = "G/L Account"
-        line_df['FilteredTypeField'] = "G/L Account"
-        line_df['No'] = line_df['Account']
-        line_df = line_df.drop('Account', axis=1)
-        
-        successful_invoices = []
-        failed_invoices = []
-        
-        # Processa cada fatura separadamente
-        for _, header_row in header_df.iterrows():
-            try:
-                invoice_no = header_row["No_"]
-                invoice_lines = line_df[line_df["Document_No"] == invoice_no]
-                
-                if invoice_lines.empty:
-                    logging.error(f"No lines found for invoice {invoice_no}")
-                    failed_invoices.append({"no": invoice_no, "error": "No lines found"})
-                    continue
-                
-                # Prepara o payload do header
-                header_payload = {
-                    "Document_Type": str(header_row["Document Type"]),
-                    "No": str(header_row["No_"]), 
-                    "Buy_from_Vendor_No": str(header_row["Buy-from Vendor No_"]),
-                    "Document_Date": header_row["Document Date"].strftime("%Y-%m-%d"),
-                    "Vendor_Invoice_No": str(header_row["Vendor Invoice No_"])
-                }
-                header_payload = {k: v for k, v in header_payload.items() if v}
-                
-                # Prepara todos os payloads das linhas
-                line_payloads = []
-                line_no = 10000
-                
-                for _, line_row in invoice_lines.iterrows():
-                    try:
-                        if not str(line_row["Document_No"]).startswith('F'):
-                            line_payload = {
-                                "Document_Type": str(line_row["Document Type"]),
-                                "Document_No": str(line_row["Document_No"]),
-                                "Line_No": line_no,
-                                "Quantity": float(line_row["Quantity"]),
-                                "Direct_Unit_Cost": float(line_row["Direct_Unit_Cost"]),
-                                "Total_VAT_Amount": float(line_row["Total_VAT_Amount"]),
-                                "Type": str(line_row["Type"]),
-                                "FilteredTypeField": str(line_row["FilteredTypeField"]),
-                                "No": str(line_row["No"]),
-                                "VAT_Prod_Posting_Group": str(line_row["VAT_Prod_Posting_Group"]),
-                                "Withholding_Tax_Code": str(line_row["Withholding_Tax_Code"])
-                            }
-                        else:
-                            line_payload = {
-                                "Document_Type": str(line_row["Document Type"]),
-                                "Document_No": str(line_row["Document_No"]),
-                                "Line_No": line_no,
-                                "Quantity": float(line_row["Quantity"]),
-                                "Direct_Unit_Cost": float(line_row["Direct_Unit_Cost"]),
-                                "Total_VAT_Amount": float(line_row["Total_VAT_Amount"]),
-                                "Type": str(line_row["Type"]),
-                                "FilteredTypeField": str(line_row["FilteredTypeField"]),
-                                "No": str(line_row["No"]),
-                                "VAT_Prod_Posting_Group": str(line_row["VAT_Prod_Posting_Group"])
-                            }
-                        line_payload = {k: v for k, v in line_payload.items() if v}
-                        line_payloads.append((line_no, line_payload))
-                        line_no += 10000
-                    except Exception as e:
-                        logging.error(f"Error preparing line payload for invoice {invoice_no}: {str(e)}")
-                        raise
-                
-                # Se chegou até aqui, todos os payloads foram preparados com sucesso
-                # Agora podemos enviar o header e as linhas
-                
-                # Primeiro envia o header
-                send_header_to_navision(header_payload)
-                logging.info(f"Header sent successfully: {invoice_no}")
-                
-                # Depois envia todas as linhas
-                for line_no, line_payload in line_payloads:
-                    send_line_to_navision(line_payload)
-                    logging.info(f"Line sent successfully: {invoice_no} - {line_no}")
-                
-                successful_invoices.append(invoice_no)
-                
-            except Exception as e:
-                error_msg = str(e)
-                logging.error(f"Error processing invoice {invoice_no}: {error_msg}")
-                failed_invoices.append({"no": invoice_no, "error": error_msg})
-                continue
-        
+
+        return send_invoices_to_navision(header_df, line_df)
+
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.error(f"Error processing invoices: {str(e)}")
+        raise e
+
+
+def process_invoice_batch(invoice_dfs, vendors_df, purchase_header_df, purchase_header_reg_df):
+    """This function processes several invoices at once and sends each one to Navision
+    Steps:
+        1. Transform all the invoices in a single pass
+        2. Send the header and lines of each invoice
+    Args:
+        invoice_dfs (list): DataFrames containing invoice data, one per email
+        vendors_df (pd.DataFrame): DataFrame containing vendor information
+        purchase_header_df (pd.DataFrame): DataFrame with purchase headers
+        purchase_header_reg_df (pd.DataFrame): DataFrame with registered purchase headers
+    Returns:
+        list: The result of process_invoice for each invoice, in the same order
+    """
+    results = []
+    for header_df, line_df in transform_batch(invoice_dfs, vendors_df, purchase_header_df, purchase_header_reg_df):
+        if header_df is False:
+            results.append(False)
+            continue
+        try:
+            results.append(send_invoices_to_navision(header_df, line_df))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logging.error(f"Error processing invoices: {str(e)}")
+            results.append(False)
+    return results
+
+
+def send_invoices_to_navision(header_df, line_df):
+    """This function sends transformed invoices to Navision
+    Steps:
+        1. Prepare the header and line payloads of each invoice
+        2. Send the header and lines only if every payload is valid,
+           in one $batch changeset per invoice when NAVISION_USE_BATCH is set
+    Args:
+        header_df (pd.DataFrame): DataFrame with the header data
+        line_df (pd.DataFrame): DataFrame with the line data
+    Returns:
+        bool: True if at least one invoice was sent, False otherwise
+    """
+    try:
+        invoices, failed_invoices = build_invoice_payloads(header_df, line_df)
+        successful_invoices, failed = post_invoice_payloads(invoices)
+        failed_invoices.extend(failed)
+
         if failed_invoices:
             logging.warning(f"Some invoices failed to process: {failed_invoices}")
             
@@ -122,6 +94,136 @@ def process_invoice(invoice_df, vendors_df, purchase_header_df, purchase_header_
             
         return True
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"Error processing invoices: {str(e)}")
         raise e
+
+
+def build_invoice_payloads(header_df, line_df):
+    """This function prepares the header and line payloads of each invoice
+    Args:
+        header_df (pd.DataFrame): DataFrame with the header data
+        line_df (pd.DataFrame): DataFrame with the line data
+    Returns:
+        tuple: (list of (header_payload, line_payloads) tuples, list of {no, error} of the invoices without lines)
+    """
+    line_df = line_df.copy()
+    line_df['Type'] = "G/L Account"
+    line_df['FilteredTypeField'] = "G/L Account"
+    line_df['No'] = line_df['Account']
+    line_df = line_df.drop('Account', axis=1)
+    line_df['Line_No'] = (line_df.groupby('Document_No').cumcount() + 1) * 10000
+
+    # Prepara todos os payloads de uma vez, coluna a coluna
+    line_payloads_by_invoice = {}
+    for line_payload in build_line_payloads(line_df):
+        line_payloads_by_invoice.setdefault(line_payload["Document_No"], []).append(line_payload)
+
+    invoices = []
+    failed_invoices = []
+    for header_payload in build_header_payloads(header_df):
+        invoice_no = header_payload["No"]
+        line_payloads = line_payloads_by_invoice.get(invoice_no, [])
+        if not line_payloads:
+            logging.error(f"No lines found for invoice {invoice_no}")
+            failed_invoices.append({"no": invoice_no, "error": "No lines found"})
+            continue
+        invoices.append((header_payload, line_payloads))
+
+    return invoices, failed_invoices
+
+
+def post_invoice_payloads(invoices, on_posted=None):
+    """This function posts prepared invoices to Navision
+    Args:
+        invoices (list): (header_payload, line_payloads) tuples
+        on_posted (callable): Called with the number of each invoice as soon as it is posted, so it is
+            recorded even when the deadline interrupts the invoices after it
+    Returns:
+        tuple: (list of invoice numbers sent, list of {no, error} of the failed ones)
+    """
+    if NAVISION_USE_BATCH:
+        successful_invoices, failed_invoices = send_invoices_in_batches(invoices, on_posted)
+    else:
+        successful_invoices, failed_invoices = send_invoices_one_by_one(invoices, on_posted)
+
+    # The requests and NTLM handshakes are counted by the shared session, see /metrics:
+    # with several emails posting at once they cannot be told apart per call
+    logging.info(f"Invoices posted to Navision: {len(successful_invoices)}, failed: {len(failed_invoices)}")
+
+    return successful_invoices, failed_invoices
+
+
+def send_invoices_one_by_one(invoices, on_posted=None):
+    """This function sends each header and then each of its lines in separate requests
+    Args:
+        invoices (list): (header_payload, line_payloads) tuples
+        on_posted (callable): Called with the number of each invoice once it is posted
+    Returns:
+        tuple: (list of invoice numbers sent, list of {no, error} of the failed ones)
+    """
+    successful_invoices = []
+    failed_invoices = []
+
+    for header_payload, line_payloads in invoices:
+        invoice_no = header_payload["No"]
+        try:
+            # Primeiro envia o header
+            send_header_to_navision(header_payload)
+            logging.info(f"Header sent successfully: {invoice_no}")
+
+            # Depois envia todas as linhas
+            for line_payload in line_payloads:
+                send_line_to_navision(line_payload)
+                logging.info(f"Line sent successfully: {invoice_no} - {line_payload['Line_No']}")
+
+            successful_invoices.append(invoice_no)
+            if on_posted is not None:
+                on_posted(invoice_no)
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            error_msg = str(e)
+            logging.error(f"Error processing invoice {invoice_no}: {error_msg}")
+            failed_invoices.append({"no": invoice_no, "error": error_msg})
+
+    return successful_invoices, failed_invoices
+
+
+def send_invoices_in_batches(invoices, on_posted=None):
+    """This function sends the invoices in $batch requests of NAVISION_BATCH_SIZE invoices,
+    each invoice in its own changeset so a failing line never leaves an orphaned header
+    Args:
+        invoices (list): (header_payload, line_payloads) tuples
+        on_posted (callable): Called with the number of each invoice once it is posted
+    Returns:
+        tuple: (list of invoice numbers sent, list of {no, error} of the failed ones)
+    """
+    successful_invoices = []
+    failed_invoices = []
+
+    for start in range(0, len(invoices), NAVISION_BATCH_SIZE):
+        chunk = invoices[start:start + NAVISION_BATCH_SIZE]
+        try:
+            results = send_invoices_batch(chunk)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logging.error(f"Error sending batch to Navision: {str(e)}")
+            failed_invoices.extend({"no": header["No"], "error": str(e)} for header, _ in chunk)
+            continue
+
+        for result in results:
+            if result["success"]:
+                logging.info(f"Invoice sent successfully: {result['no']} ({len(result['responses'])} entities)")
+                successful_invoices.append(result["no"])
+                if on_posted is not None:
+                    on_posted(result["no"])
+            else:
+                logging.error(f"Error processing invoice {result['no']}: {result['error']}")
+                failed_invoices.append({"no": result["no"], "error": result["error"]})
+
+    return successful_invoices, failed_invoices
@@ -1,44 +1,6 @@
 import pandas as pd
 import numpy as np
-
-
-def get_highest_invoice_number(purchase_header_df):
-    """This function gets the highest invoice number and generates the next one
-    Steps:
-        1. Check if the purchase_header_df is empty or if the column 'No_' is not in the DataFrame
-        2. If the DataFrame is empty or the column 'No_' is not in the DataFrame, return 1
-        3. If the DataFrame is not empty and the column 'No_' is in the DataFrame, get the highest invoice number
-        4. If the highest invoice number contains 'FCA25', split the number and add 1 to the number part
-        5. If the highest invoice number does not contain 'FCA25', return 1
-    Args:
-        purchase_header_df (pd.DataFrame): DataFrame with the purchase header data
-    Returns:
-        int: The highest invoice number
-    """
-    try:
-        if purchase_header_df.empty or 'No_' not in purchase_header_df.columns:
-            return 1
-
-        mask = purchase_header_df['No_'].str.contains('FCA25', na=False)
-        filtered_df = purchase_header_df[mask]
-
-        if filtered_df.empty:
-            return 1
-
-        highest_invoice_number = filtered_df['No_'].max()
-
-        if 'FCA25' in highest_invoice_number:
-            number_part = highest_invoice_number.split('FCA25')[1]
-            try:
-                return int(number_part) + 1
-            except ValueError:
-                return 1
-        else:
-            return 1
-
-    except Exception as e:
-        print(f"Error generating invoice number: {str(e)}")
-        return 1
+from ProcessingData.transformations.number_series import allocate_invoice_numbers
 
 
 def transform_data(invoice_df, vendors_df, purchase_header_df, purchase_header_reg_df):
@@ -49,10 +11,11 @@ def transform_data(invoice_df, vendors_df, purchase_header_df, purchase_header_r
         3. Drop the column 'Emitente'
         4. Merge the invoice DataFrame with the vendor DataFrame on the column 'Name'
         5. Drop the rows where the column 'Vendor Invoice No_' is NaN
-        6. Get the highest invoice number and generate the next one
-        7. Create the header DataFrame
-        8. Create the line DataFrame
-        9. Validate the line DataFrame
+        6. Drop the invoices without any line of a known VAT rate
+        7. Allocate one document number per (vendor, vendor invoice) from the number series
+        8. Create the header DataFrame
+        9. Create the line DataFrame
+        10. Keep a single header per document, an invoice with several VAT rates has one row per rate
     Args:
         invoice_df (pd.DataFrame): DataFrame with the invoice data
         vendors_df (pd.DataFrame): DataFrame with the vendor data
@@ -65,7 +28,8 @@ def transform_data(invoice_df, vendors_df, purchase_header_df, purchase_header_r
     invoice_df = invoice_df.rename(columns={'Nº Fatura / ATCUD': 'Vendor Invoice No_'})
     
     invoice_df['Name'] = invoice_df['Emitente'].str.upper()
-    vendors_df['Name'] = vendors_df['Name'].str.upper()
+    # The vendors DataFrame is shared by the reference data cache, so it is not changed in place
+    vendors_df = vendors_df.assign(Name=vendors_df['Name'].str.upper())
     invoice_df = invoice_df.drop('Emitente', axis=1)
 
     merged_df = pd.merge(invoice_df, vendors_df, on='Name', how='left')
@@ -78,21 +42,74 @@ def transform_data(invoice_df, vendors_df, purchase_header_df, purchase_header_r
     if len(unique_invoices) == 0:
         return False, False
 
+    # Filtered before the numbers are allocated, so a dropped invoice leaves no gap in the series.
+    # Two vendors may use the same invoice number, so an invoice is identified by both
+    invoice_columns = ['No_', 'Vendor Invoice No_']
+    invoice_positions = unique_invoices.groupby(invoice_columns, sort=False, dropna=False).ngroup()
+    has_valid_line = get_vat_posting_group(unique_invoices).notna().groupby(invoice_positions).transform('any')
+    unique_invoices = unique_invoices[has_valid_line]
 
-    invoice_number = get_highest_invoice_number(purchase_header_df)
+    invoice_positions = unique_invoices.groupby(invoice_columns, sort=False, dropna=False).ngroup()
+    document_nos = allocate_invoice_numbers(invoice_positions.nunique(), purchase_header_df)
     unique_invoices = unique_invoices.rename(columns={'No_': 'No__'})
-    unique_invoices['No_'] = f'FCA25{str(invoice_number).zfill(6)}'
+    unique_invoices['No_'] = [document_nos[position] for position in invoice_positions]
 
     header_df = create_header_df(unique_invoices)
     line_df = create_line_df(unique_invoices)
-    
-    valid_docs = line_df[line_df['VAT_Prod_Posting_Group'].notna()]['Document_No']
-    header_df = header_df[header_df['No_'].isin(valid_docs)]
-    line_df = line_df[line_df['Document_No'].isin(valid_docs)]
+    header_df = header_df.drop_duplicates(subset='No_')
 
     return header_df, line_df
 
 
+def transform_batch(invoice_dfs, vendors_df, purchase_header_df, purchase_header_reg_df):
+    """This function transforms several invoices in a single pass
+    Steps:
+        1. Concatenate the invoices, tagging the rows of each one with its position in the batch
+        2. Drop invoices of the same vendor and number already present earlier in the same batch
+        3. Transform all of them at once with transform_data
+        4. Split the header and line DataFrames back per invoice
+    Args:
+        invoice_dfs (list): DataFrames with the invoice data, one per email
+        vendors_df (pd.DataFrame): DataFrame with the vendor data
+        purchase_header_df (pd.DataFrame): DataFrame with the purchase header data
+        purchase_header_reg_df (pd.DataFrame): DataFrame with the purchase header registration data
+    Returns:
+        list: One (header_df, line_df) tuple per invoice, (False, False) when it has nothing to send
+    """
+    results = [(False, False)] * len(invoice_dfs)
+    if not invoice_dfs:
+        return results
+
+    batch_df = pd.concat(
+        [df.assign(**{'Batch Key': key}) for key, df in enumerate(invoice_dfs)],
+        ignore_index=True
+    )
+    # Same vendor match as transform_data, so each header can be traced back to its invoice
+    vendor_nos = dict(zip(vendors_df['Name'].str.upper(), vendors_df['No_']))
+    batch_df['Batch Vendor'] = batch_df['Emitente'].str.upper().map(vendor_nos)
+    invoice_columns = ['Batch Vendor', 'Nº Fatura / ATCUD']
+    first_key = batch_df.groupby(invoice_columns, dropna=False)['Batch Key'].transform('min')
+    batch_df = batch_df[batch_df['Batch Key'] == first_key]
+
+    header_df, line_df = transform_data(
+        batch_df.drop(columns='Batch Vendor'), vendors_df, purchase_header_df, purchase_header_reg_df
+    )
+    if header_df is False:
+        return results
+
+    batch_keys = dict(zip(zip(batch_df['Batch Vendor'], batch_df['Nº Fatura / ATCUD']), batch_df['Batch Key']))
+    header_keys = pd.Series(
+        [batch_keys.get(key) for key in zip(header_df['Buy-from Vendor No_'], header_df['Vendor Invoice No_'])],
+        index=header_df.index
+    )
+    line_keys = line_df['Document_No'].map(dict(zip(header_df['No_'], header_keys)))
+
+    for key, invoice_headers in header_df.groupby(header_keys):
+        results[int(key)] = (invoice_headers, line_df[line_keys == key])
+
+    return results
+
+
 def create_header_df(unique_invoices):
     """This function creates the header DataFrame
     Steps:
@@ -114,6 +131,26 @@ def create_header_df(unique_invoices):
     return header_df
 
 
+def get_vat_posting_group(unique_invoices):
+    """This function gets the VAT_Prod_Posting_Group of each invoice row from its VAT percentage
+    Args:
+        unique_invoices (pd.DataFrame): DataFrame with the columns 'Base Tributável' and 'IVA'
+    Returns:
+        pd.Series: The posting group of each row, NaN when the rate is not a known one
+    """
+    vat_percentage = (
+        unique_invoices['IVA'].astype(float) / unique_invoices['Base Tributável'].astype(float) * 100
+    ).round(2)
+    groups = pd.Series(np.nan, index=unique_invoices.index, dtype=object)
+
+    groups[(vat_percentage >= 22.99) & (vat_percentage <= 23.01)] = 'OBS-NOR'
+    groups[(vat_percentage >= 21.99) & (vat_percentage <= 22.01)] = 'OBS-NORMAD'
+    groups[(vat_percentage >= 5.99) & (vat_percentage <= 6.01)] = 'OBS-RDZ'
+    groups[(vat_percentage >= -0.01) & (vat_percentage <= 0.01)] = 'OBS-ISEN'
+
+    return groups
+
+
 def create_line_df(unique_invoices):
     """This function creates the line DataFrame
     Steps:
@@ -148,19 +185,7 @@ def create_line_df(unique_invoices):
     )
 
     line_df['Total_VAT_Amount'] = iva
-    vat_percentage = (iva / line_df['Direct_Unit_Cost']) * 100
-
-    mask = (vat_percentage.round(2) >= 22.99) & (vat_percentage.round(2) <= 23.01)
-    line_df.loc[mask, 'VAT_Prod_Posting_Group'] = 'OBS-NOR'
-
-    mask = (vat_percentage.round(2) >= 21.99) & (vat_percentage.round(2) <= 22.01)
-    line_df.loc[mask, 'VAT_Prod_Posting_Group'] = 'OBS-NORMAD'
-
-    mask = (vat_percentage.round(2) >= 5.99) & (vat_percentage.round(2) <= 6.01)
-    line_df.loc[mask, 'VAT_Prod_Posting_Group'] = 'OBS-RDZ'
-
-    mask = (vat_percentage.round(2) >= -0.01) & (vat_percentage.round(2) <= 0.01)
-    line_df.loc[mask, 'VAT_Prod_Posting_Group'] = 'OBS-ISEN'
+    line_df['VAT_Prod_Posting_Group'] = get_vat_posting_group(unique_invoices)
 
     line_df['Withholding_Tax_Code'] = np.where(
         unique_invoices['No_'].str.startswith('F'),
@@ -0,0 +1,194 @@
+from orchestration import fetch_step, decode_step, classify_step, prepare_step, post_step
+from ProcessingData.stages import EmailJob, run_step
+from ProcessingData.deadline import Deadline, DeadlineExceeded, use_deadline, get_deadline, format_stage_times
+from ProcessingData.structured_logging import use_correlation_id
+from ProcessingData.mailboxes import get_mailbox, get_mailboxes, use_mailbox
+from ProcessingData.metrics import EMAILS_TOTAL, EMAILS_IN_FLIGHT
+from info.config import (
+    ASYNC_MAX_IN_FLIGHT,
+    ASYNC_CPU_WORKERS,
+    ASYNC_IO_WORKERS,
+    EMAIL_DEADLINE_SECONDS
+)
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import threading
+import logging
+import asyncio
+import sys
+
+
+class AsyncPipeline:
+    """Processes emails on an asyncio event loop
+
+    An email waits for its mailbox's quota and the in-flight limit on the loop,
+    holding no thread. It then goes through the steps of
+    orchestration.orchestrate_all_processes, with the same checkpoints, deadline,
+    throttling limiters and batchers: decoding runs on a CPU executor, and the
+    calls to Graph, ChatGPT, the database and Navision on an I/O executor. The
+    number of threads is fixed by ASYNC_CPU_WORKERS and ASYNC_IO_WORKERS,
+    whatever the number of emails in flight.
+    """
+
+    def __init__(self, max_in_flight=ASYNC_MAX_IN_FLIGHT, cpu_workers=ASYNC_CPU_WORKERS, io_workers=ASYNC_IO_WORKERS):
+        """
+        Args:
+            max_in_flight (int): Emails processed at the same time
+            cpu_workers (int): Threads decoding PDFs and QR codes
+            io_workers (int): Threads calling Graph, ChatGPT, the database and Navision
+        """
+        self.max_in_flight = max_in_flight
+        self.cpu_executor = ThreadPoolExecutor(cpu_workers, thread_name_prefix="async-cpu")
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix="async-io")
+        self.loop = None
+        self._slots = None
+        self._mailbox_slots = {}
+        self._mailbox_counts = {}
+        self._started = threading.Event()
+
+    async def open(self):
+        """This function creates the in-flight and mailbox limits on the running loop"""
+        self.loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._mailbox_slots = {
+            mailbox.name: asyncio.Semaphore(mailbox.max_concurrent) for mailbox in get_mailboxes()
+        }
+        self._mailbox_counts = {mailbox.name: {"queued": 0, "active": 0} for mailbox in get_mailboxes()}
+
+    async def close(self):
+        """This function shuts the executors down"""
+        self.cpu_executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=False)
+
+    async def _run(self, executor, function, *args):
+        # The copied context carries the email's deadline, mailbox and correlation ID into the executor thread
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(executor, functools.partial(context.run, function, *args))
+
+    async def orchestrate(self, email_id):
+        """This function runs the steps of orchestration.orchestrate_all_processes on the executors
+        Args:
+            email_id (str): The ID of the email
+        Returns:
+            bool: True if at least one invoice was posted
+        """
+        job = EmailJob(email_id, get_deadline())
+        steps = (
+            ("fetch", self.io_executor, fetch_step),
+            ("decode", self.cpu_executor, decode_step),
+            ("classify", self.io_executor, classify_step),
+            ("prepare", self.io_executor, prepare_step)
+        )
+        # Each step is profiled on the executor thread that runs it
+        for name, executor, step in steps:
+            if not await self._run(executor, run_step, step, job, name):
+                return False
+        await self._run(self.io_executor, run_step, post_step, job, "post")
+        return job.result
+
+    async def process_email(self, email_id, deadline=None, mailbox=None, on_done=None):
+        """This function processes an email within its mailbox's quota, the in-flight limit and its deadline
+        An email first waits for a slot of its mailbox, so a busy mailbox queues behind
+        its own quota and cannot take every in-flight slot from the others. The deadline
+        starts once the email has its slots, so the time waiting for them is not counted
+        Args:
+            email_id (str): The ID of the email
+            deadline (Deadline): The time budget of the email
+            mailbox (Mailbox): The mailbox of the email, defaults to the current one
+            on_done (callable): Called with the email ID, the result and the outcome when the email ends
+        Returns:
+            bool: True if the email was processed
+        """
+        deadline = deadline or Deadline(EMAIL_DEADLINE_SECONDS, email_id)
+        mailbox = mailbox or get_mailbox()
+        counts = self._mailbox_counts[mailbox.name]
+        result, outcome = False, None
+        try:
+            counts["queued"] += 1
+            async with self._mailbox_slots[mailbox.name], self._slots:
+                counts["queued"] -= 1
+                counts["active"] += 1
+                EMAILS_IN_FLIGHT.inc()
+                deadline.start()
+                try:
+                    with use_deadline(deadline), use_correlation_id(email_id), use_mailbox(mailbox):
+                        result = await self.orchestrate(email_id)
+                except DeadlineExceeded as e:
+                    logging.error(f"{str(e)} - stage times: {format_stage_times(deadline)}")
+                    outcome = "deadline_exceeded"
+                except Exception as e:
+                    logging.error(f"Error processing email {email_id}: {str(e)}")
+                    outcome = "error"
+                finally:
+                    counts["active"] -= 1
+                    EMAILS_IN_FLIGHT.dec()
+
+            EMAILS_TOTAL.inc(outcome=outcome or ("processed" if result else "failed"))
+            if outcome:
+                return False
+            if result:
+                logging.info(f"Email {email_id} processed successfully")
+            else:
+                logging.warning(f"Email {email_id} could not be processed")
+            return result
+        finally:
+            if on_done is not None:
+                on_done(email_id, result, outcome)
+
+    def start_in_background(self):
+        """This function runs the pipeline's event loop on a dedicated thread, for submit()"""
+        def run_loop():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.open())
+            self._started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run_loop, name="async-pipeline", daemon=True).start()
+        self._started.wait()
+
+    def submit(self, email_id, deadline=None, mailbox=None, on_done=None):
+        """This function schedules an email on the background loop without waiting for it
+        Args:
+            email_id (str): The ID of the email
+            deadline (Deadline): The time budget of the email
+            mailbox (Mailbox): The mailbox of the email
+            on_done (callable): Called with the email ID, the result and the outcome when the email ends
+        Returns:
+            concurrent.futures.Future: Resolves to the result of process_email
+        """
+        return asyncio.run_coroutine_threadsafe(self.process_email(email_id, deadline, mailbox, on_done), self.loop)
+
+    def mailbox_stats(self):
+        """This function returns the waiting and active emails of each mailbox
+        Returns:
+            dict: queued, active and max_concurrent, by mailbox name
+        """
+        return {
+            mailbox.name: dict(self._mailbox_counts.get(mailbox.name, {"queued": 0, "active": 0}),
+                               max_concurrent=mailbox.max_concurrent)
+            for mailbox in get_mailboxes()
+        }
+
+
+async def process_emails(email_ids):
+    """This function processes several emails concurrently on one event loop
+    Args:
+        email_ids (list): The IDs of the emails
+    Returns:
+        list: The result of each email, in the same order
+    """
+    pipeline = AsyncPipeline()
+    await pipeline.open()
+    try:
+        return await asyncio.gather(*(pipeline.process_email(email_id) for email_id in email_ids))
+    finally:
+        await pipeline.close()
+
+
+if __name__ == "__main__":
+    # Processes emails with the async pipeline: python src/async_orchestration.py <email_id> [<email_id> ...]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for email_id, result in zip(sys.argv[1:], asyncio.run(process_emails(sys.argv[1:]))):
+        logging.info(f"Email {email_id}: {result}")
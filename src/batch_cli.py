@@ -0,0 +1,141 @@
+from ProcessingData.local_files import find_files, load_email_file
+from ProcessingData.process_email import orchestrate_email_processing
+from ProcessingData.DFprocess import process_df
+from ProcessingData.API.graph_api import set_alerts_enabled
+from ProcessingData.structured_logging import use_correlation_id
+from ProcessingData.transformations.process_transformations import build_invoice_payloads, post_invoice_payloads
+from orchestration import transform_invoices_together
+from info.config import STAGE_CLASSIFY_WORKERS
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import logging
+import json
+import time
+import os
+
+
+def decode_file(path):
+    """This function reads a file and decodes its QR code and PDF text, in a worker process
+    Args:
+        path (str): The path of the .eml, .msg or .pdf file
+    Returns:
+        tuple: (path, response, error) where response is None if the file failed
+    """
+    email_details = load_email_file(path)
+    if email_details is None:
+        return path, None, "unreadable file"
+
+    with use_correlation_id(email_details["id"]):
+        response = orchestrate_email_processing(email_details["id"], email_details)
+    if response is None:
+        return path, None, "no attachments or QR code"
+
+    # The attachment bytes are not needed after decoding, so they are not sent back
+    response["email_details"] = dict(email_details, attachments=[
+        {key: value for key, value in attachment.items() if key != "content"}
+        for attachment in email_details["attachments"]
+    ])
+    return path, response, None
+
+
+def run_batch(input_dir, output_path, dry_run=False, workers=None):
+    """This function runs the invoice pipeline over a directory of email and PDF files
+    Steps:
+        1. Decode the files in parallel, one worker process per core
+        2. Validate the vendors and classify the accounts
+        3. Transform all the invoices together and build their Navision payloads
+        4. Post the payloads, unless it is a dry run
+        5. Write one JSON line per file to output_path and report the throughput
+    Args:
+        input_dir (str): The directory with the .eml, .msg and .pdf files
+        output_path (str): The JSON lines file with the results
+        dry_run (bool): True to skip posting to Navision and sending alert emails
+        workers (int): Number of decoding processes, defaults to the number of cores
+    Returns:
+        dict: The throughput report
+    """
+    set_alerts_enabled(not dry_run)
+    paths = find_files(input_dir)
+    results = {path: {"file": path, "status": "failed"} for path in paths}
+    timings = {}
+    started_at = time.monotonic()
+
+    stage_started_at = time.monotonic()
+    responses = {}
+    with ProcessPoolExecutor(workers or os.cpu_count(), initializer=set_alerts_enabled, initargs=(not dry_run,)) as pool:
+        for path, response, error in pool.map(decode_file, paths):
+            if response is None:
+                results[path]["error"] = error
+            else:
+                responses[path] = response
+                results[path]["qr_info"] = response.get("qr_info")
+    timings["decode"] = time.monotonic() - stage_started_at
+
+    stage_started_at = time.monotonic()
+    invoice_dfs = {}
+    with ThreadPoolExecutor(STAGE_CLASSIFY_WORKERS) as pool:
+        for path, df in zip(responses, pool.map(process_df, responses.values())):
+            if df is False or df is None:
+                results[path]["error"] = "invalid vendor, account or totals"
+            else:
+                invoice_dfs[path] = df
+                results[path]["account"] = str(df["Account"].iloc[0])
+    timings["classify"] = time.monotonic() - stage_started_at
+
+    stage_started_at = time.monotonic()
+    invoices_by_path = {}
+    transformed = transform_invoices_together(list(invoice_dfs.values())) if invoice_dfs else []
+    for path, (header_df, line_df) in zip(invoice_dfs, transformed):
+        if header_df is False:
+            results[path]["error"] = "invoice already exists in Navision"
+            continue
+        invoices, failed_invoices = build_invoice_payloads(header_df, line_df)
+        if failed_invoices:
+            results[path]["error"] = f"invalid payloads: {failed_invoices}"
+        invoices_by_path[path] = invoices
+        results[path]["invoices"] = [
+            {"header": header_payload, "lines": line_payloads} for header_payload, line_payloads in invoices
+        ]
+        results[path]["status"] = "dry run" if dry_run else "ready"
+    timings["transform"] = time.monotonic() - stage_started_at
+
+    if not dry_run:
+        stage_started_at = time.monotonic()
+        for path, invoices in invoices_by_path.items():
+            successful_invoices, failed_invoices = post_invoice_payloads(invoices)
+            results[path]["posted"] = successful_invoices
+            results[path]["status"] = "posted" if successful_invoices and not failed_invoices else "failed"
+            if failed_invoices:
+                results[path]["error"] = f"not posted: {failed_invoices}"
+        timings["post"] = time.monotonic() - stage_started_at
+
+    with open(output_path, "w", encoding="utf-8") as file:
+        for path in paths:
+            file.write(json.dumps(results[path], ensure_ascii=False, default=str) + "\n")
+
+    elapsed = time.monotonic() - started_at
+    invoice_count = sum(len(invoices) for invoices in invoices_by_path.values())
+    report = {
+        "files": len(paths),
+        "succeeded": sum(1 for result in results.values() if result["status"] != "failed"),
+        "invoices": invoice_count,
+        "seconds": round(elapsed, 2),
+        "files_per_second": round(len(paths) / elapsed, 2) if elapsed else 0,
+        "invoices_per_second": round(invoice_count / elapsed, 2) if elapsed else 0,
+        "stage_seconds": {name: round(seconds, 2) for name, seconds in timings.items()}
+    }
+    logging.info(f"Batch finished: {json.dumps(report)}")
+    return report
+
+
+if __name__ == "__main__":
+    # python src/batch_cli.py <input_dir> [-o results.jsonl] [--dry-run] [--workers N]
+    parser = argparse.ArgumentParser(description="Process a directory of .eml, .msg and .pdf invoices")
+    parser.add_argument("input_dir", help="Directory with the .eml, .msg and .pdf files")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSON lines file with the results")
+    parser.add_argument("--dry-run", action="store_true", help="Do not post to Navision or send alert emails")
+    parser.add_argument("--workers", type=int, default=None, help="Decoding processes, defaults to the number of cores")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    print(json.dumps(run_batch(args.input_dir, args.output, args.dry_run, args.workers), indent=2))
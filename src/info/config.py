@@ -9,22 +9,105 @@ load_dotenv()
 TENANT_ID = os.getenv("TENANT_ID")
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+# Azure AD authority the tokens are requested from, e.g. a local fake for load tests
+AZURE_AD_AUTHORITY = os.getenv("AZURE_AD_AUTHORITY", "https://login.microsoftonline.com").rstrip("/")
 
 # Webhook configuration
 WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 5048))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Seconds main.py waits for the webhook to listen before giving up
+WEBHOOK_READY_TIMEOUT = float(os.getenv("WEBHOOK_READY_TIMEOUT", 30))
 
 # Microsoft Graph API configuration
 GRAPH_API_BASE_URL = os.getenv("GRAPH_API_BASE_URL", "https://graph.microsoft.com/v1.0")
 SUBSCRIPTION_URL = f"{GRAPH_API_BASE_URL}/subscriptions"
 MAILBOX_USER_ID = os.getenv("MAILBOX_USER_ID")
+# Mailboxes served by this process, comma separated "name=user_id" or "name=user_id:max_concurrent",
+# e.g. "faturas=faturas@adc.pt:8,fornecedores=fornecedores@adc.pt:4". Without it, MAILBOX_USER_ID alone, named "default".
+# They must all belong to one company: every mailbox posts to NAVISION_COMPANY and reads the same database
+MAILBOXES = os.getenv("MAILBOXES", "")
+# Emails of one mailbox processed at the same time, unless its entry in MAILBOXES says otherwise
+MAILBOX_MAX_CONCURRENT = int(os.getenv("MAILBOX_MAX_CONCURRENT", 8))
+# Worker threads shared by the mailboxes when neither the async nor the staged pipeline is enabled
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", 16))
 
 # OpenAI configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 CHATGPT_MODEL = os.getenv("CHATGPT_MODEL", "gpt-4")
+# Maximum size of the classification prompt (accounts, email and PDF text)
+CHATGPT_PROMPT_TOKEN_BUDGET = int(os.getenv("CHATGPT_PROMPT_TOKEN_BUDGET", 3000))
+# Classification batching: invoices waiting for an account within the window share one request, 0 disables it
+CHATGPT_BATCH_WINDOW_SECONDS = float(os.getenv("CHATGPT_BATCH_WINDOW_SECONDS", 0))
+CHATGPT_BATCH_MAX_SIZE = int(os.getenv("CHATGPT_BATCH_MAX_SIZE", 8))
+
+# Cache of the accounts chosen by ChatGPT for recurring invoices
+DECISION_CACHE_TTL_SECONDS = int(os.getenv("DECISION_CACHE_TTL_SECONDS", 60 * 60 * 24 * 90))
+DECISION_CACHE_MAX_SIZE = int(os.getenv("DECISION_CACHE_MAX_SIZE", 5000))
+# JSON file where the decisions are kept between restarts, empty to keep them only in memory
+DECISION_CACHE_FILE = os.getenv("DECISION_CACHE_FILE", "")
+
+# Local classifier trained on the vendor history, tried before ChatGPT
+# Its prediction is used when its confidence reaches the threshold, above 1 disables it.
+# The confidence is the share of the matched words that agree on the account, so text that
+# mixes the words of several accounts stays below 0.8 and goes to ChatGPT
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", 0.8))
+
+# Directory where the result of each stage of an email is saved, empty to disable checkpoints.
+# The files hold the emails and their attachments unencrypted, so the directory must be private
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "")
+# Checkpoints of the emails not touched for this many hours are deleted, 0 keeps them
+CHECKPOINT_RETENTION_HOURS = float(os.getenv("CHECKPOINT_RETENTION_HOURS", 168))
+CHECKPOINT_SWEEP_SECONDS = int(os.getenv("CHECKPOINT_SWEEP_SECONDS", 3600))
+
+# Directory where the webhook notifications and the fetched Graph messages are recorded
+# with their secrets scrubbed, to replay them with benchmarks/replay_traffic.py. Empty disables it
+TRAFFIC_RECORD_DIR = os.getenv("TRAFFIC_RECORD_DIR", "")
+
+# Time budget of an email, from the moment a worker takes it until it is posted
+EMAIL_DEADLINE_SECONDS = float(os.getenv("EMAIL_DEADLINE_SECONDS", 300))
+# Longest an outbound HTTP call may take, shortened to what is left of the email's deadline
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", 30))
+
+# Adaptive concurrency of the calls to Graph and OpenAI
+THROTTLE_INITIAL_CONCURRENCY = int(os.getenv("THROTTLE_INITIAL_CONCURRENCY", 4))
+THROTTLE_MAX_CONCURRENCY = int(os.getenv("THROTTLE_MAX_CONCURRENCY", 32))
+# Retries of a throttled (429/503) call, waiting what the backend asked for
+THROTTLE_MAX_RETRIES = int(os.getenv("THROTTLE_MAX_RETRIES", 3))
+# Wait before the first retry when the backend does not send Retry-After, doubled on each retry
+THROTTLE_DEFAULT_DELAY_SECONDS = float(os.getenv("THROTTLE_DEFAULT_DELAY_SECONDS", 2))
+
+# Async pipeline: emails wait on an event loop and run their steps on fixed executors
+ASYNC_PIPELINE = os.getenv("ASYNC_PIPELINE", "False").lower() in ("true", "1", "t", "yes")
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 200))
+ASYNC_CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", os.cpu_count() or 2))
+# Threads calling Graph, ChatGPT and Navision, as many as the throttling limiters allow at most
+ASYNC_IO_WORKERS = int(os.getenv("ASYNC_IO_WORKERS", THROTTLE_MAX_CONCURRENCY))
+
+# Staged pipeline: each stage has its own workers and a queue of at most STAGE_QUEUE_SIZE emails
+STAGED_PIPELINE = os.getenv("STAGED_PIPELINE", "False").lower() in ("true", "1", "t", "yes")
+STAGE_FETCH_WORKERS = int(os.getenv("STAGE_FETCH_WORKERS", 8))
+STAGE_DECODE_PROCESSES = int(os.getenv("STAGE_DECODE_PROCESSES", os.cpu_count() or 2))
+STAGE_CLASSIFY_WORKERS = int(os.getenv("STAGE_CLASSIFY_WORKERS", 4))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", 50))
 
 # Logging configuration
 LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one JSON object per record, "text" the plain format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Share of the debug payloads (page samples, prompts, account lists) that are logged
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01))
+
+# Per-email profiling (CPU profile and memory allocations), written to PROFILING_DIR
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False").lower() in ("true", "1", "t", "yes")
+# Share of the emails profiled, and emails always profiled (comma separated IDs)
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_EMAIL_IDS = [email_id.strip() for email_id in os.getenv("PROFILING_EMAIL_IDS", "").split(",") if email_id.strip()]
+PROFILING_DIR = os.getenv("PROFILING_DIR", "logs/profiles")
+# Functions and allocation sites kept in each summary, and summaries kept for the debug endpoint
+PROFILING_TOP_ENTRIES = int(os.getenv("PROFILING_TOP_ENTRIES", 25))
+PROFILING_MAX_SUMMARIES = int(os.getenv("PROFILING_MAX_SUMMARIES", 50))
 
 # Application settings
 DEBUG_MODE = os.getenv("DEBUG_MODE", "True").lower() in ("true", "1", "t", "yes")
@@ -43,9 +126,45 @@ TABLES = {
     'purchase_header_reg': '[ADC$Purch_ Inv_ Header]'
 }
 
+# Account history cache
+ACCOUNT_HISTORY_REFRESH_SECONDS = int(os.getenv("ACCOUNT_HISTORY_REFRESH_SECONDS", 300))
+# An account with at least this share of the vendor's lines is used without asking ChatGPT
+ACCOUNT_DOMINANCE_SHARE = float(os.getenv("ACCOUNT_DOMINANCE_SHARE", 0.9))
+ACCOUNT_DOMINANCE_MIN_USAGE = int(os.getenv("ACCOUNT_DOMINANCE_MIN_USAGE", 5))
+
+# Reference data (vendors and purchase headers)
+# Seconds a synced table is used before its changed rows are fetched again, 0 syncs before every use
+REFERENCE_REFRESH_SECONDS = int(os.getenv("REFERENCE_REFRESH_SECONDS", 60))
+# Seconds the purchase headers may be old when an invoice is checked for duplicates,
+# 0 syncs their changed rows right before every check
+DUPLICATE_CHECK_MAX_AGE_SECONDS = float(os.getenv("DUPLICATE_CHECK_MAX_AGE_SECONDS", 0))
+# Directory of the local Arrow snapshots, empty to disable them
+REFERENCE_SNAPSHOT_DIR = os.getenv("REFERENCE_SNAPSHOT_DIR", "")
+REFERENCE_SNAPSHOT_SAVE_SECONDS = int(os.getenv("REFERENCE_SNAPSHOT_SAVE_SECONDS", 300))
+
+# Invoice batching: invoices ready within the window are transformed together, 0 disables it.
+# Not used by the staged pipeline, whose single post thread transforms one invoice at a time
+INVOICE_BATCH_WINDOW_SECONDS = float(os.getenv("INVOICE_BATCH_WINDOW_SECONDS", 0))
+INVOICE_BATCH_MAX_SIZE = int(os.getenv("INVOICE_BATCH_MAX_SIZE", 20))
+
+# Navision (Business Central OData) configuration
+NAVISION_API_URL = os.getenv("NAVISION_API_URL", "http://SRV004.ADC.local:7048/BC140/ODataV4/")
+NAVISION_COMPANY = os.getenv("NAVISION_COMPANY", "ADC")
+NAVISION_USERNAME = os.getenv("NAVISION_USERNAME")
+NAVISION_PASSWORD = os.getenv("NAVISION_PASSWORD")
+# Number of NTLM-authenticated connections kept open to Navision
+NAVISION_POOL_SIZE = int(os.getenv("NAVISION_POOL_SIZE", 4))
+
+# Navision: send each invoice as one OData $batch changeset (header and lines are created atomically).
+# Off by default until $batch is confirmed on the Business Central instance
+NAVISION_USE_BATCH = os.getenv("NAVISION_USE_BATCH", "False").lower() in ("true", "1", "t", "yes")
+# How many invoices are sent in the same $batch request
+NAVISION_BATCH_SIZE = int(os.getenv("NAVISION_BATCH_SIZE", 10))
+
 def check_config():
     """Check if all required configuration variables are set."""
-    missing_vars = [var for var in ["TENANT_ID", "CLIENT_ID", "CLIENT_SECRET", "OPENAI_API_KEY"] 
+    missing_vars = [var for var in ["TENANT_ID", "CLIENT_ID", "CLIENT_SECRET", "OPENAI_API_KEY",
+                                    "NAVISION_USERNAME", "NAVISION_PASSWORD"] 
                    if not globals().get(var)]
     if missing_vars:
         print(f"⚠️ AVISO: As seguintes variáveis de configuração não foram definidas: {', '.join(missing_vars)}")
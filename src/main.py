@@ -1,30 +1,41 @@
-from Hook.webhook import app, start_webhook, setup_logging
+import time
+
+# Taken before the other imports, so the startup metrics include them
+started_at = time.perf_counter()
+
+from Hook.webhook import start_webhook, setup_logging, warm_up, webhook_ready
 import logging
-from ProcessingData.process_email import fetch_email_details
-from ProcessingData.API.chatgpt import send_message
+from info.config import WEBHOOK_READY_TIMEOUT
 from ProcessingData.API.graph_api import subscribe_to_emails
+from ProcessingData.metrics import STARTUP_SECONDS
+from ProcessingData.mailboxes import get_mailboxes
 import threading
-import time
 
 
 if __name__ == "__main__":
     setup_logging()
-    
+
     try:
-        webhook_thread = threading.Thread(target=start_webhook)
+        webhook_thread = threading.Thread(target=start_webhook, kwargs={"started_at": started_at})
         webhook_thread.daemon = True
         webhook_thread.start()
-        
+
         logging.info("Waiting for webhook to start...")
-        time.sleep(2)
-        
-        logging.info("Registering webhook in Microsoft Graph...")
-        subscribe_to_emails()
-        
+        if not webhook_ready.wait(WEBHOOK_READY_TIMEOUT):
+            raise RuntimeError(f"Webhook not listening after {WEBHOOK_READY_TIMEOUT}s")
+
+        logging.info("Loading pipeline modules and reference data in the background...")
+        threading.Thread(target=warm_up, daemon=True).start()
+
+        for mailbox in get_mailboxes():
+            logging.info(f"Registering webhook in Microsoft Graph for mailbox {mailbox.name}...")
+            subscribe_to_emails(mailbox)
+        STARTUP_SECONDS.set(time.perf_counter() - started_at, phase="subscribed")
+
         logging.info("System started and waiting for emails...")
         while True:
             time.sleep(1)
-            
+
     except KeyboardInterrupt:
         logging.info("\nStopping system...")
     except Exception as e:
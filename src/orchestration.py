@@ -1,39 +1,360 @@
-from ProcessingData.process_email import orchestrate_email_processing
+from ProcessingData.process_email import (
+    orchestrate_email_processing,
+    fetch_email_details,
+    notify_email_not_found
+)
 from ProcessingData.DFprocess import process_df
-from ProcessingData.DB.conection import fetch_from_table
-from info.config import TABLES
-from ProcessingData.transformations.process_transformations import process_invoice
+from ProcessingData.DB.reference_data import get_reference_table
+from ProcessingData.transformations.transformations import transform_data, transform_batch
+from ProcessingData.transformations.process_transformations import build_invoice_payloads, post_invoice_payloads
+from ProcessingData.transformations.number_series import reserve_invoice_numbers
 from ProcessingData.API.graph_api import send_email
+from ProcessingData.batching import MicroBatcher
+from ProcessingData.checkpoints import (
+    save_checkpoint,
+    load_checkpoint,
+    load_stage_checkpoints,
+    discard_checkpoints,
+    DISPOSABLE_STAGES
+)
+from ProcessingData.deadline import Deadline, use_deadline, get_deadline, stage, check_deadline
+from ProcessingData.stages import EmailJob, Stage, StagedPipeline
+from ProcessingData.profiling import profile_email
+from ProcessingData.mailboxes import MailboxQueue, find_mailbox, use_mailbox
+from ProcessingData.metrics import record_observations, replay_observations
+from ProcessingData.structured_logging import start_process_log_listener, forward_process_logs
+from info.config import (
+    INVOICE_BATCH_WINDOW_SECONDS,
+    INVOICE_BATCH_MAX_SIZE,
+    STAGE_FETCH_WORKERS,
+    STAGE_DECODE_PROCESSES,
+    STAGE_CLASSIFY_WORKERS,
+    STAGE_QUEUE_SIZE,
+    DUPLICATE_CHECK_MAX_AGE_SECONDS
+)
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import logging
+import sys
+
+
+def transform_invoices_together(invoice_dfs):
+    """This function transforms a batch of invoices with a single load of the reference data
+    Args:
+        invoice_dfs (list): DataFrames containing invoice data, one per email
+    Returns:
+        list: One (header_df, line_df) tuple per invoice, in the same order
+    """
+    vendors_df = get_reference_table('vendors')
+    # The duplicate check needs the headers saved by other emails and users up to now
+    purchase_header_df = get_reference_table('purchase_header', max_age=DUPLICATE_CHECK_MAX_AGE_SECONDS)
+    purchase_header_reg_df = get_reference_table('purchase_header_reg', max_age=DUPLICATE_CHECK_MAX_AGE_SECONDS)
+    return transform_batch(invoice_dfs, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+
+invoice_batcher = MicroBatcher(
+    transform_invoices_together,
+    INVOICE_BATCH_WINDOW_SECONDS,
+    INVOICE_BATCH_MAX_SIZE,
+    name="invoice batch"
+)
+
+
+def transform_invoice(df):
+    """This function transforms an invoice, together with other invoices when batching is enabled
+    Args:
+        df (pd.DataFrame): The invoice data returned by process_df
+    Returns:
+        tuple: (header_df, line_df), or (False, False) if there is nothing to send
+    """
+    if INVOICE_BATCH_WINDOW_SECONDS > 0:
+        return invoice_batcher.submit(df)
+    return transform_single_invoice(df)
+
+
+def transform_single_invoice(df):
+    """This function transforms an invoice on its own, without waiting for the batch window
+    Args:
+        df (pd.DataFrame): The invoice data returned by process_df
+    Returns:
+        tuple: (header_df, line_df), or (False, False) if there is nothing to send
+    """
+    vendors_df = get_reference_table('vendors')
+    # The duplicate check needs the headers saved by other emails and users up to now
+    purchase_header_df = get_reference_table('purchase_header', max_age=DUPLICATE_CHECK_MAX_AGE_SECONDS)
+    purchase_header_reg_df = get_reference_table('purchase_header_reg', max_age=DUPLICATE_CHECK_MAX_AGE_SECONDS)
+    return transform_data(df, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+
+def reserve_checkpointed_invoice_numbers():
+    """This function keeps the number series from handing out again the numbers of checkpointed invoices
+    Their numbers were allocated before the restart but are not in Navision until they are posted,
+    so seeding the series from the purchase headers alone could give them to new invoices
+    """
+    numbers = [
+        header_payload["No"]
+        for invoices in load_stage_checkpoints("payloads")
+        for header_payload, _ in invoices
+    ]
+    reserve_invoice_numbers(numbers)
+    if numbers:
+        logging.info(f"Reserved {len(numbers)} invoice numbers of checkpointed emails")
+
+
+def notify_invalid_invoice(response):
+    """This function warns that the invoice of an email could not be sent to Navision
+    Args:
+        response (dict): The response from the email processing
+    """
+    sender = response.get('email_details', {}).get('sender', {})
+    sender_name = sender.get('name', sender.get('address', 'Unknown Sender'))
+
+    send_email(
+        "Invalid invoice",
+        f"Invoice sent by {sender_name} already exists in Navision"
+    )
+
+
+def fetch_step(job):
+    """This function fetches the email of a job, unless its payloads or details are checkpointed
+    Args:
+        job (EmailJob): The job
+    Returns:
+        bool: True to continue with the next step
+    """
+    job.invoices = load_checkpoint(job.email_id, "payloads")
+    if job.invoices is not None:
+        # Already reserved at startup, unless the checkpoint was written by another process
+        reserve_invoice_numbers([header_payload["No"] for header_payload, _ in job.invoices])
+        return True
+
+    job.email_details = load_checkpoint(job.email_id, "fetched")
+    if job.email_details is None:
+        check_deadline()
+        with stage("fetched"):
+            job.email_details = fetch_email_details(job.email_id)
+        if job.email_details is None:
+            notify_email_not_found(job.email_id)
+            return False
+        save_checkpoint(job.email_id, "fetched", job.email_details)
+    return True
+
+
+def decode_step(job, decode=orchestrate_email_processing):
+    """This function decodes the QR code and the text of the attachments of a job
+    Args:
+        job (EmailJob): The job
+        decode (callable): Receives the email ID and details and returns the decoded response
+    Returns:
+        bool: True to continue with the next step
+    """
+    if job.invoices is not None:
+        return True
+
+    job.response = load_checkpoint(job.email_id, "decoded")
+    if job.response is None:
+        check_deadline()
+        with stage("decoded"):
+            job.response = decode(job.email_id, job.email_details)
+        # Attachments cut short by the deadline are not kept, the retry decodes them again
+        check_deadline()
+        if job.response is None:
+            return False
+        save_checkpoint(job.email_id, "decoded", job.response)
+    return True
+
+
+def classify_step(job):
+    """This function processes the dataframe of a job and classifies its account
+    Args:
+        job (EmailJob): The job
+    Returns:
+        bool: True to continue with the next step
+    """
+    if job.invoices is not None:
+        return True
+
+    job.df = load_checkpoint(job.email_id, "classified")
+    if job.df is None:
+        check_deadline()
+        with stage("classified"):
+            job.df = process_df(job.response)
+        if job.df is None or job.df is False:
+            return False
+        save_checkpoint(job.email_id, "classified", job.df)
+    return True
+
+
+def prepare_step(job, transform=transform_invoice):
+    """This function transforms the invoice of a job and builds its Navision payloads
+    Args:
+        job (EmailJob): The job
+        transform (callable): Receives the invoice data and returns (header_df, line_df)
+    Returns:
+        bool: True to continue with the next step
+    """
+    if job.invoices is not None:
+        return True
+
+    check_deadline()
+    with stage("payloads"):
+        header_df, line_df = transform(job.df)
+        if header_df is False:
+            notify_invalid_invoice(job.response)
+            return False
+
+        job.invoices, failed_invoices = build_invoice_payloads(header_df, line_df)
+    if failed_invoices:
+        logging.warning(f"Some invoices failed to process: {failed_invoices}")
+    save_checkpoint(job.email_id, "payloads", job.invoices)
+    return True
+
+
+def post_step(job):
+    """This function posts the invoices of a job that were not posted yet and sets its result
+    Args:
+        job (EmailJob): The job
+    Returns:
+        bool: False, this is the last step
+    """
+    email_id = job.email_id
+    posted = list(load_checkpoint(email_id, "posted") or [])
+    pending = [invoice for invoice in job.invoices if invoice[0]["No"] not in posted]
+    failed_invoices = []
+
+    def record_posted(invoice_no):
+        # Saved after every invoice, so an email interrupted by its deadline never posts one twice
+        posted.append(invoice_no)
+        save_checkpoint(email_id, "posted", posted)
+
+    if pending:
+        check_deadline()
+        with stage("posted"):
+            _, failed_invoices = post_invoice_payloads(pending, on_posted=record_posted)
+        if failed_invoices:
+            logging.warning(f"Some invoices failed to process: {failed_invoices}")
+
+    if not posted:
+        logging.error("No invoices were processed successfully")
+        notify_invalid_invoice(job.response or load_checkpoint(email_id, "decoded") or {})
+        job.result = False
+        return False
+
+    # The small payloads and posted checkpoints are kept so a replay never posts twice
+    if not failed_invoices:
+        discard_checkpoints(email_id, DISPOSABLE_STAGES)
+    job.result = True
+    return False
 
 
 def orchestrate_all_processes(email_id):
     """This function orchestrates all the processes
     Steps:
-        1. Process the email
-        2. Process the dataframe
-        3. Process the invoice
-    Args:
-        email_id (str): The ID of the email 
-    """
-    response = orchestrate_email_processing(email_id)
-    if response is not None:
-        df = process_df(response)
-        if df is not None and df is not False:
-            vendors_df = fetch_from_table(TABLES['vendors'], 'dbo')
-            purchase_header_df = fetch_from_table(TABLES['purchase_header'], 'dbo')
-            purchase_header_reg_df = fetch_from_table(TABLES['purchase_header_reg'], 'dbo')
-            validation = process_invoice(df, vendors_df, purchase_header_df, purchase_header_reg_df)
-
-            if validation == False:
-                sender = response.get('email_details', {}).get('sender', {})
-                sender_name = sender.get('name', sender.get('address', 'Unknown Sender'))
-
-                send_email(
-                    "Invalid invoice",
-                    f"Invoice sent by {sender_name} already exists in Navision"
-                )
+        1. Fetch the email
+        2. Decode the QR code and the text of the attachments
+        3. Process the dataframe and classify the account
+        4. Transform the invoice and build the Navision payloads
+        5. Post the invoices that were not posted yet
+    The result of every stage is saved as a checkpoint, so a retry resumes
+    after the last completed stage and never fetches, decodes, calls ChatGPT
+    or posts the same invoice again. Each stage is timed against the email's
+    deadline, and DeadlineExceeded is raised before a stage starts once it has passed.
+    When profiling is enabled for the email, the whole run is profiled (see profiling.profile_email);
+    the staged and async pipelines profile each step instead.
+    Args:
+        email_id (str): The ID of the email
+    """
+    job = EmailJob(email_id, get_deadline())
+    with profile_email(email_id, selected=job.profiled):
+        for step in (fetch_step, decode_step, classify_step, prepare_step):
+            if not step(job):
                 return False
+        post_step(job)
+    return job.result
 
-            return True
 
-    return False
+def decode_in_subprocess(email_id, email_details, seconds_left, mailbox_name=None):
+    """This function decodes an email in a worker process, under what is left of its deadline
+    Args:
+        email_id (str): The ID of the email
+        email_details (dict): The details of the email
+        seconds_left (float): What is left of the email's deadline
+        mailbox_name (str): The mailbox of the email, which alerts are sent from
+    Returns:
+        tuple: (the decoded response or None, the histogram observations made while decoding).
+            The metrics of a worker process are not scraped, so the parent replays them
+    """
+    with use_deadline(Deadline(seconds_left, email_id)), use_mailbox(find_mailbox(mailbox_name)):
+        with record_observations() as observations:
+            response = orchestrate_email_processing(email_id, email_details)
+    return response, observations
+
+
+_staged_pipeline = {"pipeline": None}
+_staged_pipeline_lock = threading.Lock()
+
+
+def get_staged_pipeline():
+    """This function returns the staged pipeline, creating it on first use
+    Stages:
+        1. fetch: STAGE_FETCH_WORKERS threads calling Graph
+        2. decode: STAGE_DECODE_PROCESSES worker processes decoding PDFs and QR codes
+        3. classify: STAGE_CLASSIFY_WORKERS threads, which limits the calls to ChatGPT
+        4. post: a single thread, so invoice numbers are allocated and posted in order
+    The post stage transforms each invoice on its own: with a single thread,
+    the invoice batcher would only ever hold one invoice and add its window as delay.
+    Only the fetch queue has no limit, so accepting a notification never waits;
+    the others hold at most STAGE_QUEUE_SIZE emails each. The fetch queue has a
+    partition per mailbox, served in turn, and each mailbox has at most its
+    max_concurrent emails past it.
+    Returns:
+        StagedPipeline: The pipeline
+    """
+    with _staged_pipeline_lock:
+        if _staged_pipeline["pipeline"] is None:
+            # Spawned, not forked: a forked child would inherit the logging queue with no listener
+            # draining it, and any lock held by another thread. Its records go to this process instead
+            context = multiprocessing.get_context("spawn")
+            decode_pool = ProcessPoolExecutor(
+                STAGE_DECODE_PROCESSES,
+                mp_context=context,
+                initializer=forward_process_logs,
+                initargs=(start_process_log_listener(context),)
+            )
+
+            def decode_with_pool(job):
+                def decode(email_id, email_details):
+                    future = decode_pool.submit(
+                        decode_in_subprocess, email_id, email_details, job.deadline.remaining(), job.mailbox.name
+                    )
+                    response, observations = future.result()
+                    replay_observations(observations)
+                    return response
+                return decode_step(job, decode)
+
+            def prepare_and_post(job):
+                return prepare_step(job, transform_single_invoice) and post_step(job)
+
+            _staged_pipeline["pipeline"] = StagedPipeline([
+                Stage("fetch", fetch_step, STAGE_FETCH_WORKERS),
+                Stage("decode", decode_with_pool, STAGE_DECODE_PROCESSES, STAGE_QUEUE_SIZE),
+                Stage("classify", classify_step, STAGE_CLASSIFY_WORKERS, STAGE_QUEUE_SIZE),
+                Stage("post", prepare_and_post, 1, STAGE_QUEUE_SIZE)
+            ], admission=MailboxQueue())
+        return _staged_pipeline["pipeline"]
+
+
+def get_started_staged_pipeline():
+    """This function returns the staged pipeline if it was already created, without creating it
+    Returns:
+        StagedPipeline: The pipeline, or None
+    """
+    return _staged_pipeline["pipeline"]
+
+
+if __name__ == "__main__":
+    # Replays emails from their checkpoints: python src/orchestration.py <email_id> [<email_id> ...]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for replay_id in sys.argv[1:]:
+        logging.info(f"Replaying email {replay_id}: {orchestrate_all_processes(replay_id)}")
@@ -0,0 +1,113 @@
+import pytest
+import threading
+import pandas as pd
+from datetime import datetime
+from unittest.mock import patch
+from ProcessingData.DB import account_cache
+from ProcessingData.transformations.account_history import (
+    merge_account_history,
+    summarize_account_history,
+    get_dominant_account
+)
+
+
+def make_history(rows):
+    return pd.DataFrame(rows, columns=['No_', 'Description', 'Usage', 'Last Used', 'Row Version'])
+
+
+def test_merge_account_history_replaces_usage():
+    cached = make_history([
+        ("62211", "Eletricidade", 10, datetime(2025, 1, 31), 100),
+        ("62212", "Água", 2, datetime(2024, 12, 31), 90)
+    ])
+    delta = make_history([
+        ("62211", "Eletricidade", 11, datetime(2025, 2, 28), 120)
+    ])
+
+    merged = merge_account_history(cached, delta)
+    row = merged[merged['No_'] == "62211"].iloc[0]
+
+    # The delta holds the full usage of each pair it returns
+    assert len(merged) == 2
+    assert row['Usage'] == 11
+    assert row['Last Used'] == datetime(2025, 2, 28)
+    assert merged['Row Version'].max() == 120
+
+
+def test_summarize_account_history_ranks_accounts():
+    history = make_history([
+        ("62211", "Eletricidade", 8, datetime(2025, 1, 31), 100),
+        ("62211", "Energia", 4, datetime(2024, 6, 30), 80),
+        ("62212", "Água", 3, datetime(2025, 2, 28), 110)
+    ])
+
+    summary = summarize_account_history(history)
+
+    assert summary['No_'].tolist() == ["62211", "62212"]
+    assert summary.iloc[0]['Usage'] == 12
+    assert summary.iloc[0]['Description'] == "Eletricidade | Energia"
+    assert summary.iloc[0]['Share'] == pytest.approx(0.8)
+
+
+def test_get_dominant_account():
+    history = make_history([
+        ("62211", "Eletricidade", 19, datetime(2025, 1, 31), 100),
+        ("62212", "Água", 1, datetime(2025, 2, 28), 110)
+    ])
+    summary = summarize_account_history(history)
+
+    assert get_dominant_account(summary, 0.9, 5) == "62211"
+    assert get_dominant_account(summary, 0.99, 5) is None
+    assert get_dominant_account(summary, 0.9, 50) is None
+    assert get_dominant_account(summarize_account_history(None), 0.9, 5) is None
+
+
+@pytest.fixture
+def empty_account_cache():
+    account_cache.clear_account_cache()
+    yield
+    account_cache.clear_account_cache()
+
+
+def test_account_history_is_fetched_outside_the_lock(empty_account_cache):
+    cached = make_history([("62211", "Eletricidade", 10, datetime(2025, 1, 31), 100)])
+    account_cache._account_history_cache["V002"] = {
+        "history": cached, "summary": None, "row_version": 100, "refreshed_at": datetime.utcnow()
+    }
+    querying, release = threading.Event(), threading.Event()
+
+    def slow_fetch(vendor_id, since_row_version=0):
+        querying.set()
+        release.wait(2)
+        return cached, 150
+
+    with patch.object(account_cache, "fetch_account_history", slow_fetch):
+        thread = threading.Thread(target=account_cache.get_account_history, args=("V001",))
+        thread.start()
+        assert querying.wait(2)
+        # Another vendor is served while the query of V001 is running
+        assert account_cache.get_account_history("V002") is cached
+        release.set()
+        thread.join(timeout=2)
+
+    assert account_cache._account_history_cache["V001"]["row_version"] == 150
+
+
+def test_account_history_keeps_the_watermark_of_the_query(empty_account_cache, monkeypatch):
+    monkeypatch.setattr(account_cache, "ACCOUNT_HISTORY_REFRESH_SECONDS", 0)
+    first = make_history([("62211", "Eletricidade", 10, datetime(2025, 1, 31), 100)])
+    edited = make_history([("62211", "Eletricidade", 10, datetime(2025, 1, 31), 130)])
+    calls = []
+
+    def fetch(vendor_id, since_row_version=0):
+        calls.append(since_row_version)
+        return (first, 90) if len(calls) == 1 else (edited, 140)
+
+    with patch.object(account_cache, "fetch_account_history", fetch):
+        account_cache.get_account_history("V001")
+        history = account_cache.get_account_history("V001")
+
+    # The next query starts below the oldest open transaction, not at the highest row version read
+    assert calls == [0, 90]
+    # The edited line is not counted twice
+    assert history['Usage'].tolist() == [10]
@@ -0,0 +1,84 @@
+import threading
+import time
+import asyncio
+import async_orchestration
+from async_orchestration import AsyncPipeline
+from ProcessingData.deadline import DeadlineExceeded
+
+
+def run_pipeline(monkeypatch, steps, email_id="email-1"):
+    for name, step in steps.items():
+        monkeypatch.setattr(async_orchestration, name, step)
+    finished = []
+
+    async def main():
+        pipeline = AsyncPipeline(max_in_flight=2, cpu_workers=1, io_workers=2)
+        await pipeline.open()
+        try:
+            result = await pipeline.process_email(email_id, on_done=lambda *args: finished.append(args))
+        finally:
+            await pipeline.close()
+        return result
+
+    return asyncio.run(main()), finished
+
+
+def test_async_pipeline_runs_the_shared_steps(monkeypatch):
+    threads = []
+
+    def step(name, proceed=True):
+        def run(job):
+            threads.append((name, threading.current_thread().name.split("_")[0]))
+            return proceed
+        return run
+
+    def post(job):
+        job.result = True
+        return False
+
+    result, finished = run_pipeline(monkeypatch, {
+        "fetch_step": step("fetch"),
+        "decode_step": step("decode"),
+        "classify_step": step("classify"),
+        "prepare_step": step("prepare"),
+        "post_step": post
+    })
+
+    assert result is True
+    assert threads == [("fetch", "async-io"), ("decode", "async-cpu"),
+                       ("classify", "async-io"), ("prepare", "async-io")]
+    assert finished == [("email-1", True, None)]
+
+
+def test_deadline_exceeded_in_a_step_is_reported_as_the_outcome(monkeypatch):
+    def expired(job):
+        raise DeadlineExceeded("Deadline of email email-1 exceeded during stage 'fetched'")
+
+    result, finished = run_pipeline(monkeypatch, {"fetch_step": expired})
+
+    assert result is False
+    assert finished == [("email-1", False, "deadline_exceeded")]
+
+
+def test_webhook_starts_a_single_async_pipeline(monkeypatch):
+    from Hook import webhook
+
+    started = []
+
+    class SlowPipeline:
+        def start_in_background(self):
+            time.sleep(0.05)
+            started.append(self)
+
+    monkeypatch.setattr(async_orchestration, "AsyncPipeline", SlowPipeline)
+    monkeypatch.setitem(webhook._async_pipeline, "pipeline", None)
+    pipelines = []
+
+    threads = [threading.Thread(target=lambda: pipelines.append(webhook.get_async_pipeline())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=2)
+
+    assert len(started) == 1
+    assert all(pipeline is started[0] for pipeline in pipelines)
@@ -0,0 +1,82 @@
+import pytest
+import threading
+from ProcessingData.batching import MicroBatcher
+from ProcessingData.deadline import Deadline, use_deadline, get_deadline
+
+
+def test_micro_batcher_flushes_on_max_size():
+    batches = []
+
+    def process(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(process, window_seconds=5, max_size=4)
+    results = {}
+
+    def worker(value):
+        results[value] = batcher.submit(value)
+
+    threads = [threading.Thread(target=worker, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=2)
+
+    assert results == {0: 0, 1: 2, 2: 4, 3: 6}
+    assert len(batches) == 1
+
+
+def test_micro_batcher_flushes_after_window():
+    batcher = MicroBatcher(lambda items: [item + 1 for item in items], window_seconds=0.01, max_size=100)
+
+    assert batcher.submit(1) == 2
+
+
+def test_micro_batcher_propagates_errors():
+    def process(items):
+        raise RuntimeError("Navision down")
+
+    batcher = MicroBatcher(process, window_seconds=0.01, max_size=100)
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(1)
+
+
+def test_micro_batcher_runs_under_the_latest_deadline():
+    seen = []
+
+    def process(items):
+        seen.append(get_deadline())
+        return items
+
+    batcher = MicroBatcher(process, window_seconds=5, max_size=2)
+    short, long = Deadline(1, email_id="short"), Deadline(60, email_id="long")
+
+    def worker(deadline):
+        with use_deadline(deadline):
+            batcher.submit(deadline.email_id)
+
+    first = threading.Thread(target=worker, args=(long,))
+    first.start()
+    # The short deadline fills the batch, so the flush runs in its thread
+    worker(short)
+    first.join(timeout=2)
+
+    assert seen == [long]
+
+
+def test_micro_batcher_timer_flush_keeps_the_deadline():
+    seen = []
+
+    def process(items):
+        seen.append(get_deadline())
+        return items
+
+    batcher = MicroBatcher(process, window_seconds=0.01, max_size=100)
+    deadline = Deadline(60, email_id="email")
+
+    with use_deadline(deadline):
+        batcher.submit(1)
+
+    assert seen == [deadline]
@@ -0,0 +1,64 @@
+import json
+import pandas as pd
+from unittest.mock import patch, Mock
+from ProcessingData.API.chatgpt import send_messages_batch, parse_batch_answer
+from ProcessingData.API.prompt_builder import estimate_tokens
+from info.config import CHATGPT_BATCH_MAX_SIZE, CHATGPT_PROMPT_TOKEN_BUDGET
+
+
+def make_invoice(subject, accounts):
+    return ({"sender": "fornecedor@example.com", "subject": subject, "body": ""},
+            pd.DataFrame({'No_': accounts, 'Description': [''] * len(accounts)}),
+            [])
+
+
+INVOICES = [
+    make_invoice("Eletricidade", ["62211", "62212"]),
+    make_invoice("Viaturas", ["62213", "62214"]),
+]
+
+
+def completion(content):
+    response = Mock(status_code=200, text="")
+    response.json.return_value = {"choices": [{"message": {"content": content}}]}
+    return response
+
+
+def test_parse_batch_answer_validates_each_invoice():
+    assert parse_batch_answer('```json\n["62211", "62211"]\n```', INVOICES) == ["62211", None]
+    assert parse_batch_answer('not json', INVOICES) == [None, None]
+
+
+@patch('requests.post')
+def test_batch_uses_a_single_request(mock_post):
+    mock_post.return_value = completion('["62212", "62213"]')
+
+    assert send_messages_batch(INVOICES) == ["62212", "62213"]
+    assert mock_post.call_count == 1
+    prompt = mock_post.call_args.kwargs["json"]["messages"][1]["content"]
+    assert "## Fatura 1" in prompt and "## Fatura 2" in prompt
+
+
+@patch('requests.post')
+def test_batch_falls_back_to_individual_calls(mock_post):
+    mock_post.side_effect = [completion('["62212", "99999"]'), completion("62214")]
+
+    assert send_messages_batch(INVOICES) == ["62212", "62214"]
+    assert mock_post.call_count == 2
+
+
+@patch('requests.post')
+def test_full_batch_prompt_respects_budget(mock_post):
+    large_invoice = (
+        {"sender": "fornecedor@example.com", "subject": "Fatura", "body": "<p>" + "texto " * 5000 + "</p>"},
+        pd.DataFrame({'No_': ['62211', '62212'], 'Description': ['Eletricidade', 'Água']}),
+        [{"filename": "fatura.pdf", "text": "linha qualquer\n" * 5000 + "Total: 10,00"}],
+    )
+    invoices = [large_invoice] * CHATGPT_BATCH_MAX_SIZE
+    mock_post.return_value = completion(json.dumps(["62211"] * CHATGPT_BATCH_MAX_SIZE))
+
+    assert send_messages_batch(invoices) == ["62211"] * CHATGPT_BATCH_MAX_SIZE
+    assert mock_post.call_count == 1
+    prompt = mock_post.call_args.kwargs["json"]["messages"][1]["content"]
+    assert estimate_tokens(prompt) <= CHATGPT_PROMPT_TOKEN_BUDGET
+    assert prompt.count("Total: 10,00") == CHATGPT_BATCH_MAX_SIZE
@@ -0,0 +1,99 @@
+import time
+import os
+import pytest
+import pandas as pd
+from ProcessingData import checkpoints
+from ProcessingData.checkpoints import (
+    save_checkpoint,
+    load_checkpoint,
+    get_last_stage,
+    discard_checkpoints
+)
+from ProcessingData.transformations.number_series import allocate_invoice_number, get_invoice_prefix, reset_number_series
+
+
+EMAIL_ID = "AAMkAGI2TG93AAA="
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_save_and_load_checkpoint():
+    df = pd.DataFrame({'Account': ['62211'], 'Total': [123.0]})
+
+    save_checkpoint(EMAIL_ID, "classified", df)
+
+    pd.testing.assert_frame_equal(load_checkpoint(EMAIL_ID, "classified"), df)
+    assert load_checkpoint(EMAIL_ID, "payloads") is None
+
+
+def test_get_last_stage():
+    assert get_last_stage(EMAIL_ID) is None
+
+    save_checkpoint(EMAIL_ID, "fetched", {"id": EMAIL_ID})
+    save_checkpoint(EMAIL_ID, "decoded", {"qr_info": "A:1*B:2"})
+
+    assert get_last_stage(EMAIL_ID) == "decoded"
+
+
+def test_discard_checkpoints():
+    save_checkpoint(EMAIL_ID, "fetched", {"id": EMAIL_ID})
+    save_checkpoint(EMAIL_ID, "posted", ["FCA25000011"])
+
+    discard_checkpoints(EMAIL_ID, ["fetched"])
+    assert load_checkpoint(EMAIL_ID, "fetched") is None
+    assert load_checkpoint(EMAIL_ID, "posted") == ["FCA25000011"]
+
+    discard_checkpoints(EMAIL_ID)
+    assert get_last_stage(EMAIL_ID) is None
+
+
+def test_checkpoints_disabled(monkeypatch):
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", "")
+
+    save_checkpoint(EMAIL_ID, "fetched", {"id": EMAIL_ID})
+    assert load_checkpoint(EMAIL_ID, "fetched") is None
+
+
+def test_checkpoints_are_json_with_bytes_and_dataframes(checkpoint_dir):
+    details = {"id": EMAIL_ID, "attachments": [{"name": "invoice.pdf", "content": b"%PDF-1.7\x00\xff"}]}
+    df = pd.DataFrame({'Account': ['62211'], 'Total': [123.0], 'Date': pd.to_datetime(['2025-03-01'])})
+
+    save_checkpoint(EMAIL_ID, "fetched", details)
+    save_checkpoint(EMAIL_ID, "classified", df)
+
+    assert load_checkpoint(EMAIL_ID, "fetched") == details
+    pd.testing.assert_frame_equal(load_checkpoint(EMAIL_ID, "classified"), df.astype({'Date': 'datetime64[ns]'}))
+    assert sorted(path.name for path in checkpoint_dir.rglob("*.json")) == ["classified.json", "fetched.json"]
+
+
+def test_sweep_checkpoints_deletes_only_old_emails(checkpoint_dir):
+    save_checkpoint(EMAIL_ID, "posted", ["FCA25000011"])
+    save_checkpoint("recent", "posted", ["FCA25000012"])
+    old = time.time() - 10 * 3600
+    for path in checkpoints._checkpoint_dir(EMAIL_ID), checkpoints._checkpoint_path(EMAIL_ID, "posted"):
+        os.utime(path, (old, old))
+    os.utime(os.path.join(checkpoints._checkpoint_dir(EMAIL_ID), "email_id.txt"), (old, old))
+
+    assert checkpoints.sweep_checkpoints(max_age_hours=5) == 1
+    assert get_last_stage(EMAIL_ID) is None
+    assert load_checkpoint("recent", "posted") == ["FCA25000012"]
+
+
+def test_checkpointed_invoice_numbers_are_reserved_at_startup():
+    from orchestration import reserve_checkpointed_invoice_numbers
+
+    prefix = get_invoice_prefix()
+    save_checkpoint(EMAIL_ID, "payloads", [({"No": f"{prefix}000007"}, [{"Document_No": f"{prefix}000007"}])])
+    save_checkpoint("AAMkOTHER=", "payloads", [({"No": f"{prefix}000003"}, [])])
+    reset_number_series()
+    try:
+        reserve_checkpointed_invoice_numbers()
+
+        # The database does not have them yet, the series continues after them anyway
+        assert allocate_invoice_number(pd.DataFrame({'No_': [f"{prefix}000001"]})) == f"{prefix}000008"
+    finally:
+        reset_number_series()
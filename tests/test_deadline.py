@@ -0,0 +1,107 @@
+import time
+import pytest
+from ProcessingData.deadline import (
+    Deadline,
+    DeadlineExceeded,
+    use_deadline,
+    get_timeout,
+    check_deadline,
+    deadline_exceeded,
+    stage
+)
+
+
+def test_timeout_without_deadline_is_the_default():
+    assert get_timeout(30) == 30
+    assert not deadline_exceeded()
+
+
+def test_timeout_is_limited_by_the_deadline():
+    with use_deadline(Deadline(5, "email-1")):
+        assert 4 < get_timeout(30) <= 5
+        assert get_timeout(2) == 2
+
+
+def test_expired_deadline_records_the_stage():
+    deadline = Deadline(0.05, "email-1")
+
+    with use_deadline(deadline):
+        with stage("fetched"):
+            pass
+        with stage("decoded"):
+            time.sleep(0.1)
+
+        assert deadline_exceeded()
+        with pytest.raises(DeadlineExceeded, match="decoded"):
+            check_deadline()
+        with pytest.raises(DeadlineExceeded):
+            get_timeout()
+
+    assert deadline.exhausted_by == "decoded"
+    assert set(deadline.stages) == {"fetched", "decoded"}
+    assert not deadline_exceeded()
+
+
+def test_start_leaves_out_the_time_waiting():
+    deadline = Deadline(0.05, "email-1")
+    time.sleep(0.06)
+    assert deadline.expired()
+
+    deadline.start()
+    assert not deadline.expired()
+
+
+def test_exceeded_email_is_reported_and_can_be_redelivered(monkeypatch):
+    from Hook import webhook
+    from ProcessingData import process_email
+    from ProcessingData.mailboxes import get_mailbox
+
+    reported = []
+    monkeypatch.setattr(process_email, "notify_deadline_exceeded", lambda email_id, deadline: reported.append(email_id))
+    mailbox = get_mailbox()
+    monkeypatch.setattr(webhook, "processed_emails", {(mailbox.name, "AAA"): {"timestamp": None}})
+
+    webhook.finish_email("AAA", False, mailbox, "deadline_exceeded", Deadline(0, "AAA"))
+
+    assert reported == ["AAA"]
+    assert not webhook.is_already_processed("AAA", mailbox)
+
+
+def test_deadline_exceeded_while_posting_is_not_reported_as_an_invalid_invoice(tmp_path, monkeypatch):
+    from unittest.mock import Mock
+    from Hook import webhook
+    import orchestration
+    from ProcessingData import checkpoints, process_email
+    from ProcessingData.API import navision_post_data
+    from ProcessingData.transformations import process_transformations
+    from ProcessingData.mailboxes import get_mailbox
+
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", str(tmp_path))
+    invoices = [({"No": number}, [{"Document_No": number, "Line_No": 10000}]) for number in ("FCA1", "FCA2")]
+    checkpoints.save_checkpoint("AAA", "payloads", invoices)
+
+    session = Mock()
+    session.post.return_value = Mock(status_code=201)
+    calls = []
+
+    def slow_session():
+        # The second invoice starts after the deadline has passed
+        calls.append(1)
+        if len(calls) == 3:
+            time.sleep(0.3)
+        return session
+
+    alerts, reported = [], []
+    monkeypatch.setattr(navision_post_data, "get_navision_session", slow_session)
+    monkeypatch.setattr(orchestration, "send_email", lambda subject, message: alerts.append(subject))
+    monkeypatch.setattr(process_email, "notify_deadline_exceeded", lambda email_id, deadline: reported.append(email_id))
+    monkeypatch.setattr(process_transformations, "NAVISION_USE_BATCH", False)
+    mailbox = get_mailbox()
+    monkeypatch.setattr(webhook, "processed_emails", {(mailbox.name, "AAA"): {"timestamp": None}})
+
+    webhook.process_email_background("AAA", {}, Deadline(0.2, "AAA"), mailbox)
+
+    assert alerts == []
+    assert reported == ["AAA"]
+    assert not webhook.is_already_processed("AAA", mailbox)
+    assert checkpoints.load_checkpoint("AAA", "posted") == ["FCA1"]
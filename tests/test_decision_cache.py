@@ -0,0 +1,87 @@
+import pytest
+import pandas as pd
+from ProcessingData.API import decision_cache
+from ProcessingData.API.decision_cache import (
+    build_invoice_fingerprint,
+    get_cached_decision,
+    store_decision,
+    clear_decision_cache
+)
+
+
+ACCOUNTS = ["62211", "62212"]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_FILE", "")
+    clear_decision_cache()
+    yield
+    clear_decision_cache()
+
+
+def make_qr(total):
+    return pd.DataFrame({'D': ['FT'], 'I7': [str(total)], 'I8': [str(total * 0.23)]})
+
+
+def test_fingerprint_is_stable_for_recurring_invoices():
+    january = build_invoice_fingerprint(
+        make_qr(100), {"subject": "Fatura 2025/001 eletricidade janeiro"},
+        [{"text": "Consumo de eletricidade 01/01/2025 a 31/01/2025"}]
+    )
+    february = build_invoice_fingerprint(
+        make_qr(87), {"subject": "Fatura 2025/044 eletricidade fevereiro"},
+        [{"text": "Consumo de eletricidade 01/02/2025 a 28/02/2025"}]
+    )
+    water = build_invoice_fingerprint(
+        make_qr(100), {"subject": "Fatura 2025/002 agua janeiro"},
+        [{"text": "Consumo de agua 01/01/2025 a 31/01/2025"}]
+    )
+
+    assert january == february
+    assert january != water
+
+
+def test_cached_decision_round_trip():
+    assert get_cached_decision("V001", "abc", ACCOUNTS) is None
+
+    store_decision("V001", "abc", ACCOUNTS, "62212")
+
+    assert get_cached_decision("V001", "abc", ACCOUNTS) == "62212"
+    assert get_cached_decision("V002", "abc", ACCOUNTS) is None
+
+
+def test_cached_decision_invalidated_by_new_account():
+    store_decision("V001", "abc", ACCOUNTS, "62212")
+
+    assert get_cached_decision("V001", "abc", ACCOUNTS + ["62213"]) is None
+
+
+def test_cached_decision_expires(monkeypatch):
+    store_decision("V001", "abc", ACCOUNTS, "62212")
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_TTL_SECONDS", 0)
+
+    assert get_cached_decision("V001", "abc", ACCOUNTS) is None
+
+
+def test_cache_is_size_bounded(monkeypatch):
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_MAX_SIZE", 2)
+
+    store_decision("V001", "a", ACCOUNTS, "62211")
+    store_decision("V001", "b", ACCOUNTS, "62211")
+    get_cached_decision("V001", "a", ACCOUNTS)
+    store_decision("V001", "c", ACCOUNTS, "62211")
+
+    assert get_cached_decision("V001", "b", ACCOUNTS) is None
+    assert get_cached_decision("V001", "a", ACCOUNTS) == "62211"
+
+
+def test_cache_persists_to_disk(tmp_path, monkeypatch):
+    path = str(tmp_path / "decisions.json")
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_FILE", path)
+    store_decision("V001", "abc", ACCOUNTS, "62212")
+
+    decision_cache._decision_cache.clear()
+    decision_cache._decision_cache_state["loaded"] = False
+
+    assert get_cached_decision("V001", "abc", ACCOUNTS) == "62212"
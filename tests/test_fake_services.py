@@ -0,0 +1,107 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fake_services import FakeState, create_app, email_details_to_message
+from ProcessingData.API.navision_post_data import build_batch_request, parse_batch_response
+from ProcessingData.API.prompt_builder import build_prompt, build_batch_prompt
+from ProcessingData.process_email import parse_email_data
+
+
+HEADER = {"Document_Type": "Invoice", "No": "FCA25000011", "Buy_from_Vendor_No": "V001"}
+LINES = [{"Document_Type": "Invoice", "Document_No": "FCA25000011", "Line_No": 10000, "Direct_Unit_Cost": 5.0}]
+EMAIL = {
+    "id": "email-1",
+    "subject": "Fatura 1",
+    "sender": {"name": "Vendor", "address": "vendor@example.com"},
+    "body": "<p>Fatura</p>",
+    "attachments": [{"name": "invoice.pdf", "contentType": "application/pdf", "content": b"%PDF-1.4", "size": 8}]
+}
+
+
+@pytest.fixture
+def state():
+    return FakeState(seed=1)
+
+
+@pytest.fixture
+def client(state):
+    return create_app(state).test_client()
+
+
+def test_token_and_message_with_attachments(client, state):
+    state.add_message(email_details_to_message(EMAIL))
+
+    token = client.post("/aad/tenant/oauth2/v2.0/token", data={"grant_type": "client_credentials"})
+    message = client.get("/graph/v1.0/users/me/messages/email-1?$expand=attachments").get_json()
+
+    assert token.get_json()["access_token"].startswith("fake-")
+    details = parse_email_data("email-1", message)
+    assert details["attachments"][0]["content"] == b"%PDF-1.4"
+    assert details["sender"]["address"] == "vendor@example.com"
+    assert client.get("/graph/v1.0/users/me/messages/missing").status_code == 404
+
+
+def test_throttling_is_injected_and_recorded(client, state):
+    state.behaviour["openai"].update({"throttle_rate": 1, "retry_after": 2.5})
+
+    response = client.post("/openai/v1/chat/completions", json={"messages": [{"role": "user", "content": "x"}]})
+
+    assert response.status_code == 429
+    assert response.headers["retry-after-ms"] == "2500"
+    assert [(entry["service"], entry["status"]) for entry in state.requests] == [("openai", 429)]
+
+
+def test_chat_answers_a_candidate_account(client):
+    accounts = pd.DataFrame({"No_": ["62220", "62210"], "Description": ["Transportes", "Manutenção"], "Usage": [3, 9]})
+
+    single = client.post("/openai/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": build_prompt(EMAIL, accounts, [], 1000)}]
+    }).get_json()
+    batch = client.post("/openai/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": build_batch_prompt([(EMAIL, accounts, []), (EMAIL, accounts[:1], [])], 1000)}]
+    }).get_json()
+
+    assert single["choices"][0]["message"]["content"] == "62210"
+    assert batch["choices"][0]["message"]["content"] == '["62210", "62220"]'
+
+
+def test_navision_batch_round_trip(client, state):
+    body, boundary = build_batch_request([(HEADER, LINES), (HEADER, LINES)])
+
+    response = client.post(
+        "/navision/ODataV4/$batch", data=body,
+        headers={"Content-Type": f"multipart/mixed; boundary={boundary}"}
+    )
+    changesets = parse_batch_response(response.headers["Content-Type"], response.data)
+
+    assert [answer["status"] for answer in changesets[0]] == [201, 201]
+    # The second changeset posts the same header again
+    assert [answer["status"] for answer in changesets[1]] == [400]
+    assert list(state.invoices) == ["FCA25000011"]
+    assert len(state.lines) == 1
+
+
+def test_graph_batch_runs_each_request(client, state):
+    state.add_message(email_details_to_message(EMAIL))
+
+    response = client.post("/graph/v1.0/$batch", json={"requests": [
+        {"id": "1", "method": "GET", "url": "/users/me/messages/email-1"},
+        {"id": "2", "method": "GET", "url": "/users/me/messages/missing"}
+    ]}).get_json()
+
+    assert [(answer["id"], answer["status"]) for answer in response["responses"]] == [("1", 200), ("2", 404)]
+    assert len(state.requests) == 1
+
+
+def test_delta_returns_only_new_messages(client, state):
+    state.add_message(email_details_to_message(EMAIL))
+    first = client.get("/graph/v1.0/users/me/mailFolders/inbox/messages/delta").get_json()
+    state.add_message(email_details_to_message(dict(EMAIL, id="email-2")))
+    second = client.get(first["@odata.deltaLink"]).get_json()
+
+    assert [message["id"] for message in first["value"]] == ["email-1"]
+    assert [message["id"] for message in second["value"]] == ["email-2"]
@@ -0,0 +1,127 @@
+import pytest
+import pandas as pd
+from unittest.mock import patch
+from ProcessingData.DFprocess import choose_account
+from ProcessingData.local_classifier import (
+    classify_locally,
+    extract_features,
+    reset_local_models
+)
+from info.config import LOCAL_CLASSIFIER_THRESHOLD
+
+
+@pytest.fixture(autouse=True)
+def empty_models():
+    reset_local_models()
+    yield
+    reset_local_models()
+
+
+def make_history(rows):
+    return pd.DataFrame(rows, columns=['No_', 'Description', 'Usage'])
+
+
+HISTORY = make_history([
+    ("62211", "Consumo de eletricidade", 12),
+    ("62212", "Consumo de agua", 8),
+    ("62213", "Manutencao de viaturas oficina", 4),
+])
+
+
+def test_features_ignore_accents_and_case():
+    assert extract_features("Manutenção Viaturas") == extract_features("manutencao viaturas")
+
+
+def test_predicts_account_from_pdf_text():
+    account, confidence = classify_locally(
+        "V001", HISTORY, {"subject": "Fatura janeiro"},
+        [{"text": "Consumo de agua da rede publica"}]
+    )
+
+    assert account == "62212"
+    assert confidence > 0.5
+
+
+def test_unknown_text_is_not_classified():
+    account, confidence = classify_locally("V001", HISTORY, {"subject": "Fatura"}, [{"text": "12345 67890"}])
+
+    assert account is None
+    assert confidence == 0.0
+
+
+def test_history_is_trained_incrementally():
+    classify_locally("V001", HISTORY, {}, [])
+    before = classify_locally("V001", HISTORY, {}, [{"text": "manutencao viaturas"}])
+
+    # The same history does not count twice, only the new usage is added
+    grown = make_history([
+        ("62211", "Consumo de eletricidade", 12),
+        ("62212", "Consumo de agua", 8),
+        ("62213", "Manutencao de viaturas oficina", 40),
+    ])
+    after = classify_locally("V001", grown, {}, [{"text": "manutencao viaturas"}])
+
+    assert before[0] == after[0] == "62213"
+    assert after[1] > before[1]
+
+
+def test_vendors_have_separate_models():
+    classify_locally("V001", HISTORY, {}, [])
+    other = make_history([("62299", "Consumo de agua engarrafada", 3)])
+
+    account, _ = classify_locally("V002", other, {}, [{"text": "consumo de agua"}])
+
+    assert account == "62299"
+
+
+def test_text_about_the_minority_account_outweighs_the_prior():
+    history = make_history([
+        ("62211", "Consumo de eletricidade", 200),
+        ("62213", "Manutencao de viaturas oficina", 2),
+    ])
+
+    account, confidence = classify_locally(
+        "V001", history, {"subject": "Fatura"}, [{"text": "Manutencao de viaturas na oficina"}]
+    )
+
+    assert account == "62213"
+    assert confidence > 0.8
+
+
+# Texts labelled by hand: the clear ones must pass the threshold with the right account,
+# the ambiguous ones must stay below it
+VALIDATION = [
+    ("Manutencao das viaturas na oficina", "62213"),
+    ("Consumo de eletricidade janeiro", "62211"),
+    ("fatura consumo agua gas natural energia eletricidade", None),
+    ("Consumo de agua e eletricidade", None),
+]
+
+
+@pytest.mark.parametrize("text, expected", VALIDATION)
+def test_confidence_is_calibrated_on_the_validation_texts(text, expected):
+    account, confidence = classify_locally("V001", HISTORY, {"subject": "Fatura"}, [{"text": text}])
+
+    if expected:
+        assert account == expected
+        assert confidence >= LOCAL_CLASSIFIER_THRESHOLD
+    else:
+        assert confidence < LOCAL_CLASSIFIER_THRESHOLD
+
+
+def test_ambiguous_text_falls_through_to_chatgpt():
+    df = pd.DataFrame({"Vendor No_": ["V001"]})
+    response = {
+        "email_details": {"subject": "Fatura"},
+        "pdf_texts": [{"text": "fatura consumo agua gas natural energia eletricidade"}]
+    }
+
+    with patch("ProcessingData.DFprocess.get_account_summary", return_value=HISTORY), \
+            patch("ProcessingData.DFprocess.get_account_history", return_value=HISTORY), \
+            patch("ProcessingData.DFprocess.get_dominant_account", return_value=None), \
+            patch("ProcessingData.DFprocess.build_invoice_fingerprint", return_value="fingerprint"), \
+            patch("ProcessingData.DFprocess.get_cached_decision", return_value=None):
+        account_number, account_vendor, _ = choose_account(df, response)
+
+    assert account_number is None
+    assert account_vendor is HISTORY
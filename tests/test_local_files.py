@@ -0,0 +1,43 @@
+from email.message import EmailMessage
+from ProcessingData.local_files import find_files, load_email_file
+
+
+def write_eml(path):
+    message = EmailMessage()
+    message["From"] = "Fornecedor Lda <faturas@fornecedor.pt>"
+    message["Subject"] = "Fatura FT 2025/10"
+    message["Date"] = "Mon, 03 Feb 2025 10:00:00 +0000"
+    message.set_content("Segue a fatura em anexo")
+    message.add_attachment(b"%PDF-1.4 fake", maintype="application", subtype="pdf", filename="fatura.pdf")
+    path.write_bytes(bytes(message))
+
+
+def test_load_eml(tmp_path):
+    write_eml(tmp_path / "email.eml")
+
+    details = load_email_file(str(tmp_path / "email.eml"))
+
+    assert details["sender"] == {"name": "Fornecedor Lda", "address": "faturas@fornecedor.pt"}
+    assert details["subject"] == "Fatura FT 2025/10"
+    assert details["receivedDateTime"].startswith("2025-02-03T10:00:00")
+    assert details["attachments"] == [
+        {"name": "fatura.pdf", "contentType": "application/pdf", "content": b"%PDF-1.4 fake", "size": 13}
+    ]
+
+
+def test_load_pdf(tmp_path):
+    (tmp_path / "FT 2025-11.pdf").write_bytes(b"%PDF-1.4 fake")
+
+    details = load_email_file(str(tmp_path / "FT 2025-11.pdf"))
+
+    assert details["subject"] == "FT 2025-11"
+    assert details["attachments"][0]["contentType"] == "application/pdf"
+
+
+def test_find_files(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.PDF").write_bytes(b"")
+    (tmp_path / "sub" / "b.eml").write_bytes(b"")
+    (tmp_path / "notes.txt").write_bytes(b"")
+
+    assert find_files(str(tmp_path)) == [str(tmp_path / "a.PDF"), str(tmp_path / "sub" / "b.eml")]
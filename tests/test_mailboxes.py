@@ -0,0 +1,172 @@
+import threading
+import sys
+import pytest
+
+from ProcessingData import mailboxes
+from ProcessingData.mailboxes import Mailbox, MailboxQueue, parse_mailboxes, resolve_mailbox, get_mailbox, use_mailbox
+from ProcessingData.stages import Stage, StagedPipeline
+
+
+ADC = Mailbox("adc", "faturas@adc.pt", 2)
+BETA = Mailbox("beta", "11111111-2222-3333-4444-555555555555", 1)
+
+
+class Item:
+    def __init__(self, mailbox, number):
+        self.mailbox = mailbox
+        self.number = number
+
+
+def test_parse_mailboxes():
+    parsed = parse_mailboxes("adc=faturas@adc.pt:4, beta=faturas@beta.pt", default_max_concurrent=8)
+
+    assert [(m.name, m.user_id, m.max_concurrent) for m in parsed] == [
+        ("adc", "faturas@adc.pt", 4), ("beta", "faturas@beta.pt", 8)
+    ]
+    assert [(m.name, m.user_id) for m in parse_mailboxes("", "me@adc.pt")] == [("default", "me@adc.pt")]
+    with pytest.raises(ValueError):
+        parse_mailboxes("adc=a@adc.pt,adc=b@adc.pt")
+    with pytest.raises(ValueError):
+        parse_mailboxes("faturas@adc.pt")
+
+
+def test_resolve_mailbox(monkeypatch):
+    monkeypatch.setattr(mailboxes, "_mailboxes", [ADC, BETA])
+
+    assert resolve_mailbox("beta", "Users/faturas@adc.pt/Messages/1") is BETA
+    assert resolve_mailbox(None, f"Users/{BETA.user_id.upper()}/Messages/1") is BETA
+    assert resolve_mailbox("unknown", "Users/other/Messages/1") is ADC
+    assert get_mailbox() is ADC
+    with use_mailbox(BETA):
+        assert get_mailbox() is BETA
+
+
+def test_queue_takes_mailboxes_in_turn_within_their_quota():
+    queue = MailboxQueue([ADC, BETA])
+    for number in range(5):
+        queue.put(Item(ADC, number))
+    queue.put(Item(BETA, 0))
+    queue.put(Item(BETA, 1))
+
+    taken = [queue.get() for _ in range(3)]
+
+    # adc and beta alternate until each reached its quota
+    assert [(item.mailbox.name, item.number) for item in taken] == [("adc", 0), ("beta", 0), ("adc", 1)]
+    assert queue.stats()["adc"] == {"queued": 3, "active": 2, "max_concurrent": 2}
+
+    waiter = threading.Thread(target=lambda: taken.append(queue.get()))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+
+    queue.release(taken[1])
+    waiter.join(2)
+    assert (taken[-1].mailbox.name, taken[-1].number) == ("beta", 1)
+
+
+def test_busy_mailbox_does_not_fill_the_pipeline():
+    release = threading.Event()
+    started = []
+
+    def work(job):
+        started.append(job.mailbox.name)
+        release.wait(2)
+        job.result = True
+        return False
+
+    pipeline = StagedPipeline([Stage("work", work, 4)], admission=MailboxQueue([ADC, BETA]))
+    jobs = [pipeline.submit(f"adc-{index}", mailbox=ADC) for index in range(6)]
+    jobs.append(pipeline.submit("beta-0", mailbox=BETA))
+
+    for _ in range(50):
+        if len(started) == 3:
+            break
+        threading.Event().wait(0.02)
+    # Four workers, but adc only gets its two slots and beta is not kept waiting
+    assert sorted(started) == ["adc", "adc", "beta"]
+
+    release.set()
+    for job in jobs:
+        assert job.done.wait(2)
+    assert pipeline.admission.stats()["adc"]["active"] == 0
+
+
+def test_webhook_dedups_and_queues_per_mailbox(monkeypatch):
+    from Hook import webhook
+
+    monkeypatch.setattr(mailboxes, "_mailboxes", [ADC, BETA])
+    monkeypatch.setattr(webhook, "ASYNC_PIPELINE", False)
+    monkeypatch.setattr(webhook, "STAGED_PIPELINE", False)
+    monkeypatch.setattr(webhook, "processed_emails", {})
+    monkeypatch.setitem(webhook._email_queue, "queue", None)
+    processed = []
+    done = threading.Event()
+
+    def process(email_id, event, deadline=None, mailbox=None):
+        processed.append((mailbox.name, email_id))
+        webhook.mark_finished(email_id, True, mailbox)
+        if len(processed) == 2:
+            done.set()
+
+    monkeypatch.setattr(webhook, "process_email_background", process)
+    client = webhook.app.test_client()
+    notification = {"value": [{"resource": "Users/x/Messages/AAA"}]}
+
+    client.post("/webhook?mailbox=adc", json=notification)
+    client.post("/webhook?mailbox=adc", json=notification)
+    client.post("/webhook?mailbox=beta", json=notification)
+
+    assert done.wait(2)
+    assert sorted(processed) == [("adc", "AAA"), ("beta", "AAA")]
+    assert client.get("/emails/AAA?mailbox=beta").get_json()["succeeded"] is True
+    assert client.get("/emails/BBB?mailbox=beta").status_code == 404
+
+
+def test_webhook_submits_outside_the_processing_lock(monkeypatch):
+    from Hook import webhook
+
+    monkeypatch.setattr(mailboxes, "_mailboxes", [ADC])
+    monkeypatch.setattr(webhook, "ASYNC_PIPELINE", False)
+    monkeypatch.setattr(webhook, "STAGED_PIPELINE", True)
+    monkeypatch.setattr(webhook, "processed_emails", {})
+    lock_held = []
+
+    class Pipeline:
+        def submit(self, email_id, deadline, on_done=None, mailbox=None):
+            lock_held.append(webhook.processing_lock.locked())
+
+    def get_pipeline():
+        lock_held.append(webhook.processing_lock.locked())
+        return Pipeline()
+
+    monkeypatch.setattr(webhook, "get_staged_pipeline", get_pipeline)
+    client = webhook.app.test_client()
+
+    client.post("/webhook?mailbox=adc", json={"value": [{"resource": "Users/x/Messages/AAA"}]})
+
+    assert lock_held == [False, False]
+    assert ("adc", "AAA") in webhook.processed_emails
+
+
+def test_scrapes_do_not_start_the_pipeline(monkeypatch):
+    from Hook import webhook
+
+    monkeypatch.setattr(mailboxes, "_mailboxes", [ADC, BETA])
+    monkeypatch.setattr(webhook, "ASYNC_PIPELINE", False)
+    monkeypatch.setattr(webhook, "STAGED_PIPELINE", True)
+    monkeypatch.delitem(sys.modules, "orchestration", raising=False)
+    monkeypatch.delitem(sys.modules, "ProcessingData.API.navision_post_data", raising=False)
+
+    def get_pipeline():
+        raise AssertionError("the scrape created the pipeline")
+
+    monkeypatch.setattr(webhook, "get_staged_pipeline", get_pipeline)
+    client = webhook.app.test_client()
+
+    assert client.get("/mailboxes").get_json() == {
+        "adc": {"queued": 0, "active": 0, "max_concurrent": 2},
+        "beta": {"queued": 0, "active": 0, "max_concurrent": 1}
+    }
+    assert 'invoice_mailbox_queued{mailbox="adc"} 0' in client.get("/metrics").get_data(as_text=True)
+    assert "orchestration" not in sys.modules
+    assert "ProcessingData.API.navision_post_data" not in sys.modules
@@ -0,0 +1,83 @@
+from ProcessingData.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    register_collector,
+    render_metrics,
+    record_observations,
+    replay_observations
+)
+
+
+def test_counter_renders_each_label_set():
+    counter = Counter("test_emails_total", "Emails", ["outcome"])
+    counter.inc(outcome="processed")
+    counter.inc(2, outcome="processed")
+    counter.inc(outcome="failed")
+
+    text = render_metrics()
+
+    assert "# TYPE test_emails_total counter" in text
+    assert 'test_emails_total{outcome="processed"} 3.0' in text
+    assert 'test_emails_total{outcome="failed"} 1.0' in text
+
+
+def test_gauge_goes_up_and_down():
+    gauge = Gauge("test_in_flight", "In flight")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert "test_in_flight 1.0" in render_metrics()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_stage_seconds", "Stage time", ["stage"], buckets=(0.1, 1))
+    histogram.observe(0.05, stage="fetched")
+    histogram.observe(0.5, stage="fetched")
+    histogram.observe(5, stage="fetched")
+
+    text = render_metrics()
+
+    assert 'test_stage_seconds_bucket{stage="fetched",le="0.1"} 1' in text
+    assert 'test_stage_seconds_bucket{stage="fetched",le="1.0"} 2' in text
+    assert 'test_stage_seconds_bucket{stage="fetched",le="+Inf"} 3' in text
+    assert 'test_stage_seconds_count{stage="fetched"} 3' in text
+    assert 'test_stage_seconds_sum{stage="fetched"} 5.55' in text
+
+
+def test_histogram_times_a_block():
+    histogram = Histogram("test_block_seconds", "Block time")
+    with histogram.time():
+        pass
+
+    assert "test_block_seconds_count 1" in render_metrics()
+
+
+def test_label_values_are_escaped():
+    counter = Counter("test_alerts_total", "Alerts", ["reason"])
+    counter.inc(reason='Vendor "X"\nnot found')
+
+    assert 'test_alerts_total{reason="Vendor \\"X\\" not found"} 1.0' in render_metrics()
+
+
+def test_collectors_are_rendered_and_failures_are_skipped():
+    register_collector(lambda: [("test_cache_size", "gauge", "Cache size", [({"cache": "decisions"}, 7)])])
+    register_collector(lambda: 1 / 0)
+
+    text = render_metrics()
+
+    assert "# TYPE test_cache_size gauge" in text
+    assert 'test_cache_size{cache="decisions"} 7.0' in text
+
+
+def test_observations_recorded_elsewhere_are_replayed():
+    histogram = Histogram("test_replayed_seconds", "Replayed", labels=("path",), buckets=(1, 5))
+
+    with record_observations() as observations:
+        histogram.observe(0.5, path="fast")
+    assert observations == [("test_replayed_seconds", 0.5, {"path": "fast"})]
+
+    replay_observations(observations + [("test_unknown_seconds", 1, {})])
+
+    assert 'test_replayed_seconds_count{path="fast"} 2' in render_metrics()
@@ -0,0 +1,67 @@
+import pytest
+import json
+import numpy as np
+import pandas as pd
+from ProcessingData.API.navision_payloads import (
+    build_header_payloads,
+    build_line_payloads,
+    serialize_payload
+)
+
+
+def test_build_header_payloads():
+    header_df = pd.DataFrame({
+        'No_': ['FCA25000011'],
+        'Document Type': ['Invoice'],
+        'Buy-from Vendor No_': ['V001'],
+        'Document Date': pd.to_datetime(['20250301'], format='%Y%m%d'),
+        'Vendor Invoice No_': ['FT 2025/2']
+    })
+
+    assert build_header_payloads(header_df) == [{
+        "Document_Type": "Invoice",
+        "No": "FCA25000011",
+        "Buy_from_Vendor_No": "V001",
+        "Document_Date": "2025-03-01",
+        "Vendor_Invoice_No": "FT 2025/2"
+    }]
+
+
+def test_build_line_payloads_keeps_zero_values():
+    line_df = pd.DataFrame({
+        'Document_No': ['FCA25000011', 'FCA25000011'],
+        'Document Type': ['Invoice', 'Invoice'],
+        'Line_No': [10000, 20000],
+        'Quantity': [1, 1],
+        'Direct_Unit_Cost': [10.0, 5.0],
+        'Total_VAT_Amount': [0.0, 1.15],
+        'Type': ['G/L Account', 'G/L Account'],
+        'FilteredTypeField': ['G/L Account', 'G/L Account'],
+        'No': ['62211', '62211'],
+        'VAT_Prod_Posting_Group': ['OBS-ISEN', np.nan],
+        'Withholding_Tax_Code': ['IRSINDEP23', 'IRSINDEP23']
+    })
+
+    payloads = build_line_payloads(line_df)
+
+    assert payloads[0]["Total_VAT_Amount"] == 0.0
+    assert payloads[0]["Line_No"] == 10000
+    assert payloads[0]["VAT_Prod_Posting_Group"] == "OBS-ISEN"
+    assert "VAT_Prod_Posting_Group" not in payloads[1]
+    # Only sent for documents that are not numbered by the FCA series
+    assert "Withholding_Tax_Code" not in payloads[0]
+
+
+def test_build_line_payloads_sends_withholding_tax_code():
+    line_df = pd.DataFrame({
+        'Document_No': ['PI0001'],
+        'Withholding_Tax_Code': ['IRSINDEP23']
+    })
+
+    assert build_line_payloads(line_df) == [{"Document_No": "PI0001", "Withholding_Tax_Code": "IRSINDEP23"}]
+
+
+def test_serialize_payload():
+    payload = {"No": "FCA25000011", "Description": "Eletricidade", "Quantity": 1.0}
+
+    assert json.loads(serialize_payload(payload)) == payload
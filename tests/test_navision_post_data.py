@@ -0,0 +1,123 @@
+import pytest
+from ProcessingData.API.navision_post_data import (
+    build_batch_request,
+    parse_batch_response,
+    send_invoices_batch,
+    post_to_navision,
+    get_navision_session,
+    reset_navision_session,
+    get_navision_session_stats,
+    _count_handshake
+)
+from unittest.mock import patch, MagicMock
+
+
+HEADER = {"Document_Type": "Invoice", "No": "FCA25000011", "Buy_from_Vendor_No": "V001"}
+LINES = [
+    {"Document_Type": "Invoice", "Document_No": "FCA25000011", "Line_No": 10000, "Direct_Unit_Cost": 0.0},
+    {"Document_Type": "Invoice", "Document_No": "FCA25000011", "Line_No": 20000, "Direct_Unit_Cost": 5.0}
+]
+
+
+def http_part(content_id, status_line, body):
+    return (
+        "Content-Type: application/http\r\n"
+        "Content-Transfer-Encoding: binary\r\n"
+        f"Content-ID: {content_id}\r\n\r\n"
+        f"HTTP/1.1 {status_line}\r\n"
+        "Content-Type: application/json\r\n\r\n"
+        f"{body}\r\n"
+    )
+
+
+def batch_response(changesets):
+    body = ""
+    for index, parts in enumerate(changesets):
+        body += "--batchresponse_1\r\n"
+        if len(parts) == 1 and parts[0][1].startswith("4"):
+            body += http_part(*parts[0])
+            continue
+        body += f"Content-Type: multipart/mixed; boundary=changesetresponse_{index}\r\n\r\n"
+        for part in parts:
+            body += f"--changesetresponse_{index}\r\n" + http_part(*part)
+        body += f"--changesetresponse_{index}--\r\n"
+    body += "--batchresponse_1--\r\n"
+    return body.encode()
+
+
+def test_build_batch_request():
+    body, boundary = build_batch_request([(HEADER, LINES)])
+    text = body.decode()
+
+    assert text.startswith(f"--{boundary}\r\n")
+    assert text.endswith(f"--{boundary}--\r\n")
+    assert text.count("POST Company('ADC')/Fatura_Compra HTTP/1.1") == 1
+    assert text.count("POST Company('ADC')/Linhas_Fatura_Compra HTTP/1.1") == 2
+    assert "Content-ID: 3" in text
+
+
+def test_parse_batch_response():
+    content = batch_response([
+        [("1", "201 Created", '{"No": "FCA25000011"}'), ("2", "201 Created", '{"Line_No": 10000}')],
+        [("1", "400 Bad Request", '{"error": {"message": "Vendor blocked"}}')]
+    ])
+
+    changesets = parse_batch_response("multipart/mixed; boundary=batchresponse_1", content)
+
+    assert len(changesets) == 2
+    assert [response["status"] for response in changesets[0]] == [201, 201]
+    assert changesets[0][0]["body"] == {"No": "FCA25000011"}
+    assert changesets[1][0]["status"] == 400
+
+
+def test_send_invoices_batch():
+    second_header = dict(HEADER, No="FCA25000012")
+    content = batch_response([
+        [("1", "201 Created", "{}"), ("2", "201 Created", "{}"), ("3", "201 Created", "{}")],
+        [("1", "400 Bad Request", '{"error": {"message": "Vendor blocked"}}')]
+    ])
+
+    with patch('ProcessingData.API.navision_post_data.get_navision_session') as mock_session:
+        mock_post = mock_session.return_value.post
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.headers = {"Content-Type": "multipart/mixed; boundary=batchresponse_1"}
+        mock_post.return_value.content = content
+
+        results = send_invoices_batch([(HEADER, LINES), (second_header, LINES[:1])])
+
+    assert mock_post.call_count == 1
+    assert results[0]["success"] is True
+    assert results[1]["success"] is False
+    assert results[1]["error"] == {"error": {"message": "Vendor blocked"}}
+
+
+def test_get_navision_session_is_reused():
+    reset_navision_session()
+    try:
+        assert get_navision_session() is get_navision_session()
+    finally:
+        reset_navision_session()
+
+
+def test_count_handshake():
+    before = get_navision_session_stats()
+    challenged = MagicMock(history=[MagicMock(status_code=401)])
+    reused = MagicMock(history=[])
+
+    _count_handshake(challenged)
+    _count_handshake(reused)
+    after = get_navision_session_stats()
+
+    assert after["requests"] - before["requests"] == 2
+    assert after["handshakes"] - before["handshakes"] == 1
+
+
+def test_post_to_navision_authenticates_again_on_401():
+    with patch('ProcessingData.API.navision_post_data.get_navision_session') as mock_session:
+        with patch('ProcessingData.API.navision_post_data.reset_navision_session') as mock_reset:
+            mock_session.return_value.post.side_effect = [MagicMock(status_code=401), MagicMock(status_code=201)]
+
+            response = post_to_navision("http://navision/$batch", b"{}", {})
+
+            assert response.status_code == 201
+            mock_reset.assert_called_once()
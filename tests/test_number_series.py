@@ -0,0 +1,81 @@
+import pytest
+import pandas as pd
+import threading
+from datetime import datetime
+from ProcessingData.transformations.number_series import (
+    get_highest_invoice_number,
+    allocate_invoice_numbers,
+    allocate_invoice_number,
+    seed_number_series,
+    reserve_invoice_numbers,
+    reset_number_series
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_series():
+    reset_number_series()
+    yield
+    reset_number_series()
+
+
+def test_get_highest_invoice_number():
+    df = pd.DataFrame({'No_': ['FCA25000009', 'FCA25000010', 'FCA24000999', 'XPTO']})
+
+    assert get_highest_invoice_number(df, 'FCA25') == 11
+    assert get_highest_invoice_number(df, 'FCA24') == 1000
+    assert get_highest_invoice_number(df, 'FCA26') == 1
+    assert get_highest_invoice_number(pd.DataFrame(), 'FCA25') == 1
+
+
+def test_allocate_invoice_numbers_seeds_once():
+    df = pd.DataFrame({'No_': ['FCA25000010']})
+    date = datetime(2025, 5, 1)
+
+    assert allocate_invoice_number(df, date) == 'FCA25000011'
+    # The database is only scanned the first time
+    assert allocate_invoice_numbers(2, pd.DataFrame({'No_': ['FCA25000500']}), date) == ['FCA25000012', 'FCA25000013']
+
+
+def test_allocate_invoice_numbers_rolls_over_year():
+    df = pd.DataFrame({'No_': ['FCA25000010']})
+
+    assert allocate_invoice_number(df, datetime(2025, 12, 31)) == 'FCA25000011'
+    assert allocate_invoice_number(df, datetime(2026, 1, 1)) == 'FCA26000001'
+
+
+def test_seed_number_series_never_goes_backwards():
+    date = datetime(2025, 5, 1)
+    allocate_invoice_numbers(5, pd.DataFrame({'No_': ['FCA25000010']}), date)
+
+    assert seed_number_series(pd.DataFrame({'No_': ['FCA25000002']}), 'FCA25') == 16
+    assert seed_number_series(pd.DataFrame({'No_': ['FCA25000100']}), 'FCA25') == 101
+
+
+def test_allocate_invoice_numbers_is_thread_safe():
+    date = datetime(2025, 5, 1)
+    allocated = []
+
+    def worker():
+        for _ in range(200):
+            allocated.append(allocate_invoice_number(None, date))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(allocated)) == 1600
+
+
+def test_reserved_numbers_are_not_handed_out_again():
+    date = datetime(2025, 5, 1)
+    # Numbered before a restart, checkpointed but not posted yet
+    reserve_invoice_numbers(['FCA25000020', 'FCA25000021', 'XPTO'])
+
+    assert allocate_invoice_number(pd.DataFrame({'No_': ['FCA25000010']}), date) == 'FCA25000022'
+    assert seed_number_series(pd.DataFrame({'No_': ['FCA25000010']}), 'FCA25') == 23
+
+    reserve_invoice_numbers(['FCA25000040'])
+    assert allocate_invoice_number(None, date) == 'FCA25000041'
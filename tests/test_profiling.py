@@ -0,0 +1,85 @@
+import json
+import tracemalloc
+import pytest
+from ProcessingData import profiling
+from ProcessingData.profiling import profile_email, should_profile, get_profiling_summaries
+from ProcessingData.stages import Stage, StagedPipeline
+
+
+@pytest.fixture
+def enabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 0)
+    monkeypatch.setattr(profiling, "PROFILING_EMAIL_IDS", ["slow-email"])
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    profiling._summaries.clear()
+    return tmp_path
+
+
+def allocate():
+    return [str(number) * 10 for number in range(20000)]
+
+
+def test_disabled_by_default():
+    assert not should_profile("slow-email")
+
+
+def test_only_selected_emails_are_profiled(enabled, monkeypatch):
+    assert should_profile("slow-email")
+    assert not should_profile("other-email")
+
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 1)
+    assert should_profile("other-email")
+
+
+def test_profile_is_written_and_summarized(enabled):
+    with profile_email("slow-email"):
+        kept = allocate()
+
+    summary = get_profiling_summaries()[0]
+    assert summary["email_id"] == "slow-email"
+    assert any("allocate" in row["function"] for row in summary["top_functions"])
+    assert any("test_profiling.py" in row["site"] for row in summary["top_allocations"])
+    assert summary["profile_file"].endswith(".prof")
+
+    files = sorted(path.suffix for path in enabled.iterdir())
+    assert files == [".json", ".prof"]
+    assert json.loads(next(enabled.glob("*.json")).read_text())["email_id"] == "slow-email"
+    assert not tracemalloc.is_tracing()
+    assert len(kept) == 20000
+
+
+def test_other_emails_are_not_profiled(enabled):
+    with profile_email("other-email"):
+        allocate()
+
+    assert get_profiling_summaries() == []
+    assert list(enabled.iterdir()) == []
+
+
+def test_profile_is_kept_when_the_block_fails(enabled):
+    with pytest.raises(ValueError):
+        with profile_email("slow-email"):
+            raise ValueError("bad invoice")
+
+    assert len(get_profiling_summaries("slow-email")) == 1
+    assert get_profiling_summaries("other-email") == []
+
+
+def test_staged_pipeline_profiles_each_step(enabled):
+    def fetch(job):
+        job.kept = allocate()
+        return True
+
+    def post(job):
+        job.result = True
+        return False
+
+    pipeline = StagedPipeline([Stage("fetch", fetch, 1), Stage("post", post, 1)])
+    profiled, other = pipeline.submit("slow-email"), pipeline.submit("other-email")
+
+    assert profiled.done.wait(2) and other.done.wait(2)
+    summaries = get_profiling_summaries()
+    assert sorted(summary["step"] for summary in summaries) == ["fetch", "post"]
+    assert all(summary["email_id"] == "slow-email" for summary in summaries)
+    assert any("allocate" in row["function"] for row in get_profiling_summaries()[-1]["top_functions"])
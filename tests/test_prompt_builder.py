@@ -0,0 +1,59 @@
+import pytest
+import pandas as pd
+from datetime import datetime
+from ProcessingData.API.prompt_builder import (
+    build_prompt,
+    estimate_tokens,
+    rank_accounts,
+    select_pdf_windows,
+    strip_html
+)
+
+
+def test_strip_html():
+    body = "<html><head><style>p {color: red}</style></head><body><p>Segue a fatura&nbsp;de março</p><br><p>Obrigado</p></body></html>"
+
+    assert strip_html(body) == "Segue a fatura de março\nObrigado"
+
+
+def test_rank_accounts_dedupes_raw_history():
+    history = pd.DataFrame({
+        'No_': ['62212', '62211', '62211', '62211'],
+        'Description': ['Água', 'Eletricidade', 'Eletricidade', 'Eletricidade']
+    })
+
+    assert rank_accounts(history) == ["62211 - Eletricidade (usada 3x)", "62212 - Água (usada 1x)"]
+
+
+def test_rank_accounts_uses_summary_usage():
+    summary = pd.DataFrame({
+        'No_': ['62212', '62211'],
+        'Description': ['Água', ''],
+        'Usage': [2, 10],
+        'Last Used': [datetime(2025, 1, 1), datetime(2025, 2, 1)]
+    })
+
+    assert rank_accounts(summary) == ["62211 (usada 10x)", "62212 - Água (usada 2x)"]
+
+
+def test_select_pdf_windows_keeps_items_and_totals():
+    filler = "\n".join(f"Cláusula {i} do contrato de fornecimento" for i in range(300))
+    text = f"{filler}\nDescrição: Serviço de limpeza\nTotal a pagar: 123,00\n{filler}"
+
+    selected = select_pdf_windows(text, 100)
+
+    assert "Serviço de limpeza" in selected
+    assert "Total a pagar" in selected
+    assert estimate_tokens(selected) <= 100
+
+
+def test_build_prompt_respects_budget():
+    accounts = pd.DataFrame({'No_': ['62211', '62212'], 'Description': ['Eletricidade', 'Água']})
+    email_details = {"sender": "fornecedor@example.com", "subject": "Fatura", "body": "<p>" + "texto " * 5000 + "</p>"}
+    pdf_texts = [{"filename": "fatura.pdf", "text": "linha qualquer\n" * 5000 + "Total: 10,00"}]
+
+    prompt = build_prompt(email_details, accounts, pdf_texts, 1500)
+
+    assert estimate_tokens(prompt) <= 1500
+    assert "62211 - Eletricidade" in prompt
+    assert "Total: 10,00" in prompt
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+import threading
+import pandas as pd
+
+from ProcessingData.DB import reference_data
+
+
+def _entry(rows, refreshed_at):
+    df = pd.DataFrame({"No_": rows, "timestamp": list(range(1, len(rows) + 1))})
+    return {"df": df, "row_version": len(rows), "refreshed_at": refreshed_at}
+
+
+def test_stale_table_is_served_while_another_thread_syncs(monkeypatch):
+    stale = _entry(["V1"], datetime.utcnow() - timedelta(days=1))
+    monkeypatch.setitem(reference_data._reference_cache, "vendors", stale)
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_changes(table, schema, since_row_version):
+        fetching.set()
+        release.wait(5)
+        return pd.DataFrame({"No_": ["V2"], "timestamp": [2]}), 2
+
+    monkeypatch.setattr(reference_data, "fetch_table_changes", slow_changes)
+    syncer = threading.Thread(target=reference_data.get_reference_table, args=("vendors",))
+    syncer.start()
+    assert fetching.wait(5)
+
+    # The cache lock is free during the fetch, and the other callers get the stale table
+    assert reference_data._reference_lock.acquire(timeout=1)
+    reference_data._reference_lock.release()
+    assert list(reference_data.get_reference_table("vendors")["No_"]) == ["V1"]
+
+    release.set()
+    syncer.join(5)
+    assert sorted(reference_data.get_reference_table("vendors")["No_"]) == ["V1", "V2"]
+
+
+def test_snapshot_is_not_saved_on_the_request_path(monkeypatch):
+    monkeypatch.setitem(reference_data._reference_cache, "vendors", _entry(["V1"], datetime.utcnow()))
+    monkeypatch.setattr(reference_data, "REFERENCE_SNAPSHOT_DIR", "snapshots")
+    saves = []
+    monkeypatch.setattr(reference_data, "save_reference_snapshot", lambda: saves.append(1))
+
+    assert list(reference_data.get_reference_table("vendors")["No_"]) == ["V1"]
+    assert saves == []
+
+
+def test_duplicate_check_syncs_a_table_refreshed_before_it(monkeypatch):
+    monkeypatch.setitem(reference_data._reference_cache, "purchase_header_reg", _entry(["F1"], datetime.utcnow()))
+    monkeypatch.setattr(
+        reference_data, "fetch_table_changes",
+        lambda table, schema, since_row_version: (pd.DataFrame({"No_": ["F2"], "timestamp": [2]}), 2)
+    )
+
+    # Fresh enough for the other lookups, but not for the duplicate check
+    assert list(reference_data.get_reference_table("purchase_header_reg")["No_"]) == ["F1"]
+    assert sorted(reference_data.get_reference_table("purchase_header_reg", max_age=0)["No_"]) == ["F1", "F2"]
+
+
+def test_duplicate_check_waits_for_the_sync_in_progress(monkeypatch):
+    stale = _entry(["F1"], datetime.utcnow() - timedelta(days=1))
+    monkeypatch.setitem(reference_data._reference_cache, "purchase_header_reg", stale)
+    fetching = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_changes(table, schema, since_row_version):
+        calls.append(since_row_version)
+        fetching.set()
+        release.wait(5)
+        return pd.DataFrame({"No_": ["F2"], "timestamp": [2]}), 2
+
+    monkeypatch.setattr(reference_data, "fetch_table_changes", slow_changes)
+    syncer = threading.Thread(target=reference_data.get_reference_table, args=("purchase_header_reg",))
+    syncer.start()
+    assert fetching.wait(5)
+    threading.Timer(0.1, release.set).start()
+
+    # Instead of the stale table, it waits and then syncs what was committed up to its call
+    assert sorted(reference_data.get_reference_table("purchase_header_reg", max_age=0)["No_"]) == ["F1", "F2"]
+    syncer.join(5)
+    assert calls == [1, 2]
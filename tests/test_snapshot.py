@@ -0,0 +1,43 @@
+import pytest
+import pandas as pd
+from ProcessingData.DB.snapshot import (
+    apply_table_changes,
+    get_row_version,
+    read_snapshot,
+    write_snapshot
+)
+
+
+def test_apply_table_changes_upserts_rows():
+    cached = pd.DataFrame({'No_': ['V1', 'V2'], 'Name': ['Alpha', 'Beta'], 'Row Version': [1, 2]})
+    changes = pd.DataFrame({'No_': ['V2', 'V3'], 'Name': ['Beta Lda', 'Gama'], 'Row Version': [5, 6]})
+
+    synced = apply_table_changes(cached, changes, ['No_'])
+
+    assert synced['No_'].tolist() == ['V1', 'V2', 'V3']
+    assert synced.loc[synced['No_'] == 'V2', 'Name'].iloc[0] == 'Beta Lda'
+    assert get_row_version(synced) == 6
+
+
+def test_apply_table_changes_prunes_deleted_rows():
+    cached = pd.DataFrame({'No_': ['FCA25000001', 'FCA25000002'], 'Row Version': [1, 2]})
+    keys = pd.DataFrame({'No_': ['FCA25000002']})
+
+    synced = apply_table_changes(cached, pd.DataFrame(), ['No_'], keys)
+
+    assert synced['No_'].tolist() == ['FCA25000002']
+
+
+def test_snapshot_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = pd.DataFrame({'No_': ['V1', 'V2'], 'Name': ['Alpha', 'Beta'], 'Row Version': [10, 12]})
+
+    assert write_snapshot(str(tmp_path), 'vendors', df, 12)
+    loaded, watermark = read_snapshot(str(tmp_path), 'vendors')
+
+    assert watermark == 12
+    pd.testing.assert_frame_equal(loaded, df)
+
+
+def test_read_snapshot_missing(tmp_path):
+    assert read_snapshot(str(tmp_path), 'vendors') == (None, 0)
@@ -0,0 +1,63 @@
+import threading
+from ProcessingData.stages import EmailJob, Stage, StagedPipeline
+
+
+def test_jobs_go_through_every_stage():
+    seen = []
+
+    def first(job):
+        seen.append(("first", job.email_id))
+        return True
+
+    def last(job):
+        seen.append(("last", job.email_id))
+        job.result = True
+        return False
+
+    pipeline = StagedPipeline([Stage("first", first, 2), Stage("last", last, 1, 5)])
+    jobs = [pipeline.submit(f"email-{index}") for index in range(5)]
+
+    for job in jobs:
+        assert job.done.wait(2)
+        assert job.result is True
+    assert sorted(seen) == sorted([(name, f"email-{index}") for index in range(5) for name in ("first", "last")])
+
+
+def test_failed_step_finishes_the_job():
+    def failing(job):
+        raise ValueError("boom")
+
+    second_called = threading.Event()
+    pipeline = StagedPipeline([Stage("failing", failing, 1), Stage("second", lambda job: second_called.set(), 1)])
+    job = pipeline.submit("email-1")
+
+    assert job.done.wait(2)
+    assert job.result is False
+    assert not second_called.is_set()
+
+
+def test_full_queue_holds_back_the_previous_stage():
+    release = threading.Event()
+
+    def slow(job):
+        release.wait(2)
+        return False
+
+    pipeline = StagedPipeline([Stage("fast", lambda job: True, 1), Stage("slow", slow, 1, 1)])
+    jobs = [pipeline.submit(f"email-{index}") for index in range(4)]
+
+    # One job in the slow stage, one in its queue and one waiting in the fast worker
+    for _ in range(50):
+        stats = pipeline.stats()
+        if stats["slow"]["busy"] == 1 and stats["slow"]["queued"] == 1 and stats["fast"]["busy"] == 1:
+            break
+        threading.Event().wait(0.02)
+    assert (stats["slow"]["busy"], stats["slow"]["queued"], stats["fast"]["busy"]) == (1, 1, 1)
+
+    release.set()
+    for job in jobs:
+        assert job.done.wait(2)
+
+
+def test_job_has_a_deadline():
+    assert EmailJob("email-1").deadline.remaining() > 0
@@ -0,0 +1,83 @@
+import subprocess
+import threading
+import socket
+import types
+import sys
+import os
+import requests
+
+from ProcessingData.metrics import render_metrics
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def test_webhook_import_does_not_load_the_pipeline():
+    code = (
+        "import sys, Hook.webhook; "
+        "print(sorted(m for m in ('pandas', 'cv2', 'fitz', 'pyodbc', 'orchestration', "
+        "'ProcessingData.DB.conection') if m in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+
+    assert output.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_webhook_signals_readiness_and_answers_validation():
+    from Hook.webhook import start_webhook, webhook_ready
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    threading.Thread(target=start_webhook, kwargs={"port": port, "started_at": 0.0}, daemon=True).start()
+
+    assert webhook_ready.wait(10)
+    response = requests.get(f"http://127.0.0.1:{port}/webhook?validationToken=abc", timeout=5)
+    assert response.text == "abc"
+    assert 'invoice_startup_seconds{phase="webhook_ready"}' in render_metrics()
+
+
+def test_database_connects_on_first_query(monkeypatch):
+    connects = []
+    cursor = types.SimpleNamespace(
+        execute=lambda query, *args: None, fetchall=lambda: [("V001", "Name")], description=[("No_",), ("Name",)]
+    )
+
+    def connect(connection_string):
+        connects.append(connection_string)
+        return types.SimpleNamespace(cursor=lambda: cursor)
+
+    monkeypatch.setitem(sys.modules, "pyodbc", types.SimpleNamespace(connect=connect))
+    from ProcessingData.DB import conection
+    monkeypatch.setattr(conection, "_connection", threading.local())
+
+    assert connects == []
+    first = conection.fetch_from_table("Vendor", "dbo")
+    conection.fetch_from_table("Vendor", "dbo")
+
+    assert len(connects) == 1
+    assert first.to_dict("records") == [{"No_": "V001", "Name": "Name"}]
+
+
+def test_each_thread_has_its_own_database_connection(monkeypatch):
+    connections = []
+
+    def connect(connection_string):
+        connection = types.SimpleNamespace(cursor=lambda: object())
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setitem(sys.modules, "pyodbc", types.SimpleNamespace(connect=connect))
+    from ProcessingData.DB import conection
+    monkeypatch.setattr(conection, "_connection", threading.local())
+    cursors = []
+
+    threads = [threading.Thread(target=lambda: cursors.append(conection.get_cursor())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        thread.join(timeout=2)
+    cursors.append(conection.get_cursor())
+    cursors.append(conection.get_cursor())
+
+    assert len(connections) == 3
+    assert len({id(cursor) for cursor in cursors}) == 3
@@ -0,0 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import json
+import logging
+import threading
+import pytest
+from ProcessingData import structured_logging
+from ProcessingData.structured_logging import (
+    setup_logging,
+    stop_logging,
+    use_correlation_id,
+    debug_sampled,
+    start_process_log_listener,
+    forward_process_logs
+)
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    root_logger = logging.getLogger()
+    handlers, level = list(root_logger.handlers), root_logger.level
+    path = tmp_path / "app.log"
+    yield path
+    stop_logging()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    for handler in handlers:
+        root_logger.addHandler(handler)
+    root_logger.setLevel(level)
+
+
+def read_records(path):
+    stop_logging()
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_records_are_json_with_the_email_id(log_file):
+    setup_logging(str(log_file), "INFO", "json")
+
+    with use_correlation_id("email-1"):
+        logging.info("Processing %s", "invoice.pdf")
+    logging.info("Idle")
+
+    records = read_records(log_file)
+    assert records[0]["message"] == "Processing invoice.pdf"
+    assert records[0]["email_id"] == "email-1"
+    assert records[0]["level"] == "INFO"
+    assert records[1]["email_id"] is None
+
+
+def test_email_id_is_read_from_the_logging_thread(log_file):
+    setup_logging(str(log_file), "INFO", "json")
+
+    def work(email_id):
+        with use_correlation_id(email_id):
+            logging.info("Fetched")
+
+    threads = [threading.Thread(target=work, args=(f"email-{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(record["email_id"] for record in read_records(log_file)) == [f"email-{i}" for i in range(4)]
+
+
+def test_exceptions_are_kept(log_file):
+    setup_logging(str(log_file), "INFO", "json")
+
+    try:
+        raise ValueError("bad page")
+    except ValueError:
+        logging.exception("Error processing PDF")
+
+    record = read_records(log_file)[0]
+    assert "ValueError: bad page" in record["exception"]
+
+
+def test_debug_payloads_are_not_formatted_below_debug(log_file, monkeypatch):
+    setup_logging(str(log_file), "INFO", "json")
+    monkeypatch.setattr(structured_logging, "LOG_DEBUG_SAMPLE_RATE", 1)
+
+    class Payload:
+        def __str__(self):
+            raise AssertionError("formatted")
+
+    debug_sampled("Sample: %s", Payload())
+
+    assert read_records(log_file) == []
+
+
+def test_debug_payloads_are_sampled(log_file, monkeypatch):
+    setup_logging(str(log_file), "DEBUG", "json")
+    monkeypatch.setattr(structured_logging, "LOG_DEBUG_SAMPLE_RATE", 0)
+    debug_sampled("Never logged")
+    monkeypatch.setattr(structured_logging, "LOG_DEBUG_SAMPLE_RATE", 1)
+    debug_sampled("Sample text: %.5s", "abcdefghij")
+
+    assert [record["message"] for record in read_records(log_file)] == ["Sample text: abcde"]
+
+
+def log_in_worker(email_id):
+    with use_correlation_id(email_id):
+        logging.info("Decoded in a worker process")
+        try:
+            raise ValueError("bad PDF")
+        except ValueError:
+            logging.exception("Decoding failed")
+
+
+def test_worker_process_records_reach_the_parent(log_file):
+    setup_logging(str(log_file), "INFO", "json")
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(1, mp_context=context, initializer=forward_process_logs,
+                             initargs=(start_process_log_listener(context),)) as pool:
+        pool.submit(log_in_worker, "email-7").result(timeout=60)
+
+    records = read_records(log_file)
+    assert [record["message"].splitlines()[0] for record in records] == [
+        "Decoded in a worker process", "Decoding failed"
+    ]
+    assert all(record["email_id"] == "email-7" for record in records)
+    assert "ValueError: bad PDF" in records[1]["message"]
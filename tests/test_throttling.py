@@ -0,0 +1,82 @@
+import threading
+import time
+from unittest.mock import patch, Mock
+from ProcessingData.API import throttling
+from ProcessingData.API.throttling import AdaptiveLimiter, parse_retry_after, send_with_throttling
+from ProcessingData.deadline import Deadline, use_deadline, get_timeout
+
+
+def make_response(status_code, headers=None):
+    return Mock(status_code=status_code, headers=headers or {})
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(make_response(429, {"Retry-After": "3"})) == 3
+    assert parse_retry_after(make_response(429, {"retry-after-ms": "250"})) == 0.25
+    assert parse_retry_after(make_response(429, {"x-ratelimit-reset-tokens": "1m30s"})) == 90
+    assert parse_retry_after(make_response(503)) is None
+
+
+def test_limit_decreases_on_throttling_and_grows_back():
+    limiter = AdaptiveLimiter("test", initial_limit=8, max_limit=16)
+
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.stats()["limit"] == 4
+
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.stats()["limit"] > 4
+
+
+def test_limiter_caps_calls_in_flight():
+    limiter = AdaptiveLimiter("test", initial_limit=2, max_limit=2)
+    limiter.acquire()
+    limiter.acquire()
+
+    acquired = threading.Event()
+    threading.Thread(target=lambda: (limiter.acquire(), acquired.set()), daemon=True).start()
+    assert not acquired.wait(0.1)
+
+    limiter.release()
+    assert acquired.wait(1)
+
+
+@patch('requests.get')
+def test_throttled_request_is_retried_after_the_delay(mock_get, monkeypatch):
+    monkeypatch.setattr(throttling, "_limiters", {})
+    mock_get.side_effect = [make_response(429, {"Retry-After": "0.1"}), make_response(200)]
+
+    started_at = time.monotonic()
+    response = send_with_throttling("graph", "get", "https://graph.example/messages/1", timeout=5)
+
+    assert response.status_code == 200
+    assert mock_get.call_count == 2
+    assert time.monotonic() - started_at >= 0.1
+    assert throttling.get_throttling_stats()["graph"]["throttled"] == 1
+
+
+@patch('requests.get')
+def test_retry_timeout_is_recomputed_from_the_deadline(mock_get, monkeypatch):
+    monkeypatch.setattr(throttling, "_limiters", {})
+    mock_get.side_effect = [make_response(429, {"Retry-After": "0.3"}), make_response(200)]
+
+    with use_deadline(Deadline(2, "email-1")):
+        response = send_with_throttling("graph", "get", "https://graph.example/messages/1", timeout=get_timeout())
+
+    assert response.status_code == 200
+    first_timeout, retry_timeout = (call.kwargs["timeout"] for call in mock_get.call_args_list)
+    assert retry_timeout <= first_timeout - 0.3
+
+
+@patch('requests.get')
+def test_retry_is_abandoned_when_the_wait_outlasts_the_deadline(mock_get, monkeypatch):
+    monkeypatch.setattr(throttling, "_limiters", {})
+    mock_get.side_effect = [make_response(429, {"Retry-After": "5"}), make_response(200)]
+
+    with use_deadline(Deadline(1, "email-1")):
+        response = send_with_throttling("graph", "get", "https://graph.example/messages/1", timeout=get_timeout())
+
+    assert response.status_code == 429
+    assert mock_get.call_count == 1
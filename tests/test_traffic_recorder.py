@@ -0,0 +1,44 @@
+from ProcessingData.traffic_recorder import (
+    REDACTED, scrub, record_notification, record_message, load_recording, message_file
+)
+
+
+NOTIFICATION = {"value": [{
+    "subscriptionId": "sub-1",
+    "clientState": "EmailMonitoringApp",
+    "resource": "Users/me/Messages/AAMk=/1",
+    "encryptedContent": {"data": "x", "dataKey": "key", "dataSignature": "sig"}
+}]}
+
+
+def test_scrub_replaces_secrets_at_any_depth():
+    scrubbed = scrub(NOTIFICATION)
+
+    event = scrubbed["value"][0]
+    assert event["clientState"] == REDACTED
+    assert event["encryptedContent"] == {"data": "x", "dataKey": REDACTED, "dataSignature": REDACTED}
+    assert event["resource"] == "Users/me/Messages/AAMk=/1"
+    assert NOTIFICATION["value"][0]["clientState"] == "EmailMonitoringApp"
+
+
+def test_recording_round_trip(tmp_path):
+    record_dir = str(tmp_path)
+    record_notification({"value": [{"resource": "Users/me/Messages/b"}]}, record_dir)
+    record_notification(NOTIFICATION, record_dir)
+    record_message("AAMk=/1", {"subject": "Fatura", "attachments": [{"name": "a.pdf", "contentBytes": "JVBE"}]}, record_dir)
+
+    notifications, messages = load_recording(record_dir)
+
+    assert [entry["body"]["value"][0]["resource"] for entry in notifications] == [
+        "Users/me/Messages/b", "Users/me/Messages/AAMk=/1"
+    ]
+    assert notifications[1]["body"]["value"][0]["clientState"] == REDACTED
+    assert messages["AAMk=/1"]["attachments"][0]["contentBytes"] == "JVBE"
+    assert message_file(record_dir, "AAMk=/1").startswith(str(tmp_path / "messages"))
+
+
+def test_recording_is_disabled_without_a_directory(tmp_path):
+    record_notification(NOTIFICATION, "")
+    record_message("id", {"subject": "x"}, "")
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,106 @@
+import pytest
+import pandas as pd
+from ProcessingData.transformations.transformations import transform_data, transform_batch
+from ProcessingData.transformations.number_series import reset_number_series, get_invoice_prefix
+
+
+@pytest.fixture(autouse=True)
+def clean_series():
+    reset_number_series()
+    yield
+    reset_number_series()
+
+
+@pytest.fixture
+def vendors_df():
+    return pd.DataFrame({
+        'No_': ['V001', 'V002'],
+        'Name': ['Fornecedor A', 'Fornecedor B'],
+        'VAT Registration No_': ['500000001', '500000002']
+    })
+
+
+@pytest.fixture
+def purchase_header_df():
+    return pd.DataFrame({'No_': ['FCA24000010'], 'Vendor Invoice No_': ['FT 2025/1']})
+
+
+@pytest.fixture
+def purchase_header_reg_df():
+    return pd.DataFrame({'No_': ['FCA24000999'], 'Vendor Invoice No_': ['FT 2024/9']})
+
+
+def make_invoice(vendor, invoice_no, rates):
+    return pd.DataFrame([
+        {
+            'Emitente': vendor,
+            'Nº Fatura / ATCUD': invoice_no,
+            'Data Emissão': '20250301',
+            'Base Tributável': base,
+            'IVA': vat,
+            'Account': '62211'
+        }
+        for base, vat in rates
+    ])
+
+
+def test_transform_data_keeps_one_header_per_invoice(vendors_df, purchase_header_df, purchase_header_reg_df):
+    invoice = make_invoice('Fornecedor A', 'FT 2025/2', [(100.0, 23.0), (50.0, 3.0)])
+
+    header_df, line_df = transform_data(invoice, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+    assert len(header_df) == 1
+    assert len(line_df) == 2
+    assert line_df['VAT_Prod_Posting_Group'].tolist() == ['OBS-NOR', 'OBS-RDZ']
+    assert 'Name' in vendors_df.columns and vendors_df['Name'].iloc[0] == 'Fornecedor A'
+
+
+def test_transform_batch_splits_results_per_invoice(vendors_df, purchase_header_df, purchase_header_reg_df):
+    invoices = [
+        make_invoice('Fornecedor A', 'FT 2025/2', [(100.0, 23.0)]),
+        make_invoice('Fornecedor B', 'FT 2025/1', [(100.0, 23.0)]),  # already in Navision
+        make_invoice('Fornecedor B', 'FB 7', [(100.0, 6.0), (10.0, 0.0)]),
+        make_invoice('Fornecedor A', 'FT 2025/2', [(100.0, 23.0)])   # same invoice sent twice
+    ]
+
+    results = transform_batch(invoices, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+    first_header, first_lines = results[0]
+    third_header, third_lines = results[2]
+    assert first_header['Buy-from Vendor No_'].tolist() == ['V001']
+    assert len(first_lines) == 1
+    assert third_header['Buy-from Vendor No_'].tolist() == ['V002']
+    assert len(third_lines) == 2
+    assert results[1] == (False, False)
+    assert results[3] == (False, False)
+    prefix = get_invoice_prefix()
+    assert sorted([first_header['No_'].iloc[0], third_header['No_'].iloc[0]]) == [f'{prefix}000001', f'{prefix}000002']
+
+
+def test_dropped_invoices_leave_no_gap_in_the_series(vendors_df, purchase_header_df, purchase_header_reg_df):
+    invoices = [
+        make_invoice('Fornecedor A', 'FT 2025/2', [(100.0, 17.0)]),  # unknown VAT rate
+        make_invoice('Fornecedor B', 'FB 7', [(100.0, 23.0)])
+    ]
+
+    results = transform_batch(invoices, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+    assert results[0] == (False, False)
+    assert results[1][0]['No_'].tolist() == [f'{get_invoice_prefix()}000001']
+
+
+def test_vendors_with_the_same_invoice_number_are_both_kept(vendors_df, purchase_header_df, purchase_header_reg_df):
+    invoices = [
+        make_invoice('Fornecedor A', 'FT 2025/5', [(100.0, 23.0)]),
+        make_invoice('Fornecedor B', 'FT 2025/5', [(200.0, 46.0), (10.0, 0.0)])
+    ]
+
+    results = transform_batch(invoices, vendors_df, purchase_header_df, purchase_header_reg_df)
+
+    first_header, first_lines = results[0]
+    second_header, second_lines = results[1]
+    assert first_header['Buy-from Vendor No_'].tolist() == ['V001']
+    assert first_lines['Direct_Unit_Cost'].tolist() == [100.0]
+    assert second_header['Buy-from Vendor No_'].tolist() == ['V002']
+    assert second_lines['Direct_Unit_Cost'].tolist() == [200.0, 10.0]
+    assert first_header['No_'].iloc[0] != second_header['No_'].iloc[0]